@@ -0,0 +1,161 @@
+import base64
+import os
+import random
+import struct
+from typing import List
+
+from mutagen.easyid3 import EasyID3
+from mutagen.flac import FLAC, Picture
+from mutagen.id3 import APIC, ID3, TPE1
+from mutagen.ogg import OggPage
+from mutagen.oggvorbis import OggVorbis
+
+FORMATS = ["mp3", "flac", "ogg"]
+
+# MPEG-1 Layer III, 128 kbit/s, 44.1 kHz, no padding: every frame is 417 bytes long
+_MP3_FRAME = b"\xff\xfb\x90\x00" + b"\x00" * 413
+
+
+def _mp3(path: str, frames: int) -> None:
+    """
+    Write an untagged mp3 made of silent frames
+    """
+    with open(path, "wb") as file:
+        file.write(_MP3_FRAME * frames)
+
+
+def _flac(path: str, frames: int) -> None:
+    """
+    Write a flac with only the STREAMINFO block
+    """
+    # STREAMINFO: block sizes, frame sizes, 44.1 kHz / 2 channels / 16 bits, total samples, md5
+    samples = frames * 1152
+    info = struct.pack(">HH", 4096, 4096) + b"\x00" * 6
+    info += struct.pack(">Q", (44100 << 44) | (1 << 41) | (15 << 36) | samples) + b"\x00" * 16
+    with open(path, "wb") as file:
+        file.write(b"fLaC" + bytes([0x80]) + struct.pack(">I", len(info))[1:] + info)
+
+
+def _ogg(path: str, frames: int) -> None:
+    """
+    Write an ogg vorbis with the three header packets and an empty audio page
+    """
+    identification = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 2, 44100, 0, 128000, 0, 0xB8, 1)
+    comment = b"\x03vorbis" + struct.pack("<I", 0) + struct.pack("<I", 0) + b"\x01"
+    setup = b"\x05vorbis" + b"\x00" * 32
+
+    pages = [OggPage(), OggPage(), OggPage()]
+    pages[0].packets = [identification]
+    pages[0].first = True
+    pages[1].packets = [comment, setup]
+    pages[2].packets = [b"\x00" * 64]
+    pages[2].position = frames * 1152
+    pages[2].last = True
+    for sequence, page in enumerate(pages):
+        page.serial = 1
+        page.sequence = sequence
+        if sequence < 2:
+            page.position = 0
+
+    with open(path, "wb") as file:
+        file.write(b"".join(page.write() for page in pages))
+
+
+def _tag(path: str, fmt: str, tags: dict) -> None:
+    """
+    Write the tags, None values are skipped
+    """
+    if fmt == "mp3":
+        file = EasyID3()
+    elif fmt == "flac":
+        file = FLAC(path)
+    else:
+        file = OggVorbis(path)
+
+    for key, value in tags.items():
+        if value is not None:
+            file[key] = value
+
+    if fmt == "mp3":
+        file.save(path)
+    else:
+        file.save()
+
+
+def generate(directory: str, size: int, formats: List[str] = None, albums_size: int = 12, art_size: int = 0,
+             seed: int = 0) -> List[str]:
+    """
+    Create a synthetic tagged library
+    Args:
+        directory: where the files are created
+        size: how many files are created
+        formats: the formats used, cycled
+        albums_size: how many tracks every album has
+        art_size: the size in bytes of an embedded cover, 0 for none
+        seed: the seed of the random tags
+
+    Returns:
+        The paths of the created files
+    """
+    rng = random.Random(seed)
+    formats = formats or FORMATS
+    paths = []
+
+    for i in range(size):
+        fmt = formats[i % len(formats)]
+        album = i // albums_size
+        folder = os.path.join(directory, f"artist{album % 97}", f"album{album}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{i % albums_size + 1:02d} track{i}.{fmt}")
+
+        # Every seventh track has a guest, a multi-value artist frame
+        artists = [f"Artist {album % 97}"] + ([f"Guest {i % 13}"] if i % 7 == 6 else [])
+
+        {"mp3": _mp3, "flac": _flac, "ogg": _ogg}[fmt](path, frames=rng.randint(40, 80))
+        _tag(path, fmt, {
+            "title": f"Track {i}",
+            "album": f"Album {album}",
+            "artist": artists,
+            "date": str(random.Random(f"{seed}:{album}").randint(1960, 2021)),  # The same for the whole album
+            "isrc": f"QZ{rng.randint(0, 10 ** 10 - 1):010d}" if rng.random() < 0.7 else None,
+            "tracknumber": str(i % albums_size + 1)
+        })
+        if fmt == "mp3" and len(artists) > 1:
+            _utf16_artists(path, artists)
+        if art_size:
+            _add_art(path, fmt, rng.randbytes(art_size))
+
+        paths.append(path)
+
+    return paths
+
+
+def _add_art(path: str, fmt: str, data: bytes) -> None:
+    """
+    Embed a front cover
+    """
+    if fmt == "mp3":
+        tags = ID3(path)
+        tags.add(APIC(encoding=3, mime="image/jpeg", type=3, desc="Cover", data=data))
+        tags.save(path)
+    elif fmt == "flac":
+        file = FLAC(path)
+        picture = Picture()
+        picture.type, picture.mime, picture.data = 3, "image/jpeg", data
+        file.add_picture(picture)
+        file.save()
+    else:
+        file = OggVorbis(path)
+        picture = Picture()
+        picture.type, picture.mime, picture.data = 3, "image/jpeg", data
+        file["metadata_block_picture"] = [base64.b64encode(picture.write()).decode("ascii")]
+        file.save()
+
+
+def _utf16_artists(path: str, artists: List[str]) -> None:
+    """
+    Rewrite the artist frame as UTF-16, where every value has its own BOM
+    """
+    tags = ID3(path)
+    tags.add(TPE1(encoding=1, text=artists))
+    tags.save(path)
@@ -0,0 +1,142 @@
+"""
+End-to-end benchmark of pylister on a synthetic library and a local Spotify stand-in.
+
+Usage:
+    python -m benchmarks.run --size 2000 --latency 0.02 --rate-limit 0.01 --json bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import nullcontext
+from typing import Callable
+
+import mutagen
+
+from pylister.albums import AlbumResolver
+from pylister.analysis import AnalysisCache
+from pylister.api import API
+from pylister.clustering import cluster, prepare_data
+from pylister.metrics import metrics
+from pylister.transport import RecordingTransport, ReplayTransport, SessionTransport
+from pylister.utils import create_playlist, load_folder, load_folder_parallel
+
+from .library import FORMATS, generate
+from .server import SpotifyStandIn
+
+MODE = ["energy", "danceability", "tempo"]
+
+
+def timed(results: dict, stage: str, function: Callable, *args, **kwargs):
+    """
+    Run a function and store its wall and cpu time under the stage name
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    out = function(*args, **kwargs)
+    results[stage] = {"wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu}
+    logging.info(f"{stage}: {results[stage]['wall']:.3f}s")
+    return out
+
+
+def check_tags(songs: list) -> dict:
+    """
+    Compare the artists read by the fast tag reader with the ones mutagen reads
+    """
+    mismatched = 0
+    for song in songs:
+        expected = ", ".join(mutagen.File(song["path"], easy=True)["artist"])
+        if song["artist"] != expected:
+            logging.error(f"{song['path']}: artist {song['artist']!r}, expected {expected!r}")
+            mismatched += 1
+
+    return {"checked": len(songs), "mismatched": mismatched}
+
+
+def run(args: argparse.Namespace) -> dict:
+    """
+    Run every stage and collect the timings
+    """
+    results = {"params": vars(args).copy(), "stages": {}}
+    stages = results["stages"]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        library = os.path.join(tmp, "library")
+        timed(stages, "generate", generate, library, args.size, formats=args.formats, art_size=args.art_size)
+
+        songs = timed(stages, "load_folder", lambda: list(load_folder(library)))
+        results["tags"] = check_tags(songs)
+        if args.workers:
+            timed(stages, "load_folder_parallel", lambda: list(load_folder_parallel(library, args.workers)))
+
+        # A replayed archive needs no server
+        server = nullcontext() if args.replay else SpotifyStandIn(latency=args.latency, rate_limit=args.rate_limit,
+                                                                  miss_rate=args.miss_rate)
+        with server:
+            url = "http://replay" if args.replay else server.url
+            spotipy = API(workers=args.api_workers, rate=args.rate, api_url=url, accounts_url=url)
+            if args.replay:
+                spotipy.transport = ReplayTransport(args.replay, rate_limits=not args.skip_rate_limits)
+            elif args.record:
+                spotipy.transport = RecordingTransport(args.record, SessionTransport(spotipy.session))
+            spotipy._ID = spotipy._SECRET = "0" * 32
+            spotipy.auth()
+
+            if args.albums:
+                found, _ = timed(stages, "resolve_albums", AlbumResolver(spotipy).resolve_bulk, songs)
+            else:
+                found, _ = timed(stages, "resolve", spotipy.search_bulk, songs)
+            timed(stages, "feature_bulk", spotipy.feature_bulk, found)
+            if args.analysis:
+                spotipy.analyses = AnalysisCache(os.path.join(tmp, "analyses"))
+                timed(stages, "analysis_bulk", spotipy.analysis_bulk, found)
+                results["analyses"] = {"bytes": sum(song["analysis"].nbytes for song in found if song["analysis"])}
+            spotipy.transport.close()
+            results["requests"] = {} if args.replay else dict(server.requests)
+
+        timed(stages, "prepare_data", prepare_data, found, MODE)
+        clusters = timed(stages, "cluster", cluster, found, args.clusters, MODE)
+        timed(stages, "create_playlist", create_playlist, clusters, os.path.join(tmp, "playlist.m3u"))
+
+    results["songs"] = {"files": args.size, "parsed": len(songs), "found": len(found)}
+    results["metrics"] = metrics.report()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1000, help="number of files in the library")
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=FORMATS)
+    parser.add_argument("--art-size", type=int, default=0, help="bytes of embedded cover art per file")
+    parser.add_argument("--workers", type=int, default=0, help="also time load_folder_parallel with this pool")
+    parser.add_argument("--api-workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=1000, help="client side requests per second")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--miss-rate", type=float, default=0.0, help="probability of a search without results")
+    parser.add_argument("--albums", action="store_true", help="resolve album by album instead of track by track")
+    parser.add_argument("--analysis", action="store_true", help="also get and cache the audio analyses")
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--record", help="record the http exchanges to this archive")
+    parser.add_argument("--replay", help="replay the http exchanges of this archive instead of using the stand-in")
+    parser.add_argument("--skip-rate-limits", action="store_true", help="do not replay the recorded 429 responses")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    results = run(args)
+
+    print(f"{'stage':<22}{'wall (s)':>10}{'cpu (s)':>10}")
+    for stage, timing in results["stages"].items():
+        print(f"{stage:<22}{timing['wall']:>10.3f}{timing['cpu']:>10.3f}")
+    print(f"requests: {results['requests']}")
+    print(f"tags: {results['tags']}")
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
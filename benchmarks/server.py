@@ -0,0 +1,214 @@
+import hashlib
+import json
+import random
+import re
+import string
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+_ALPHABET = string.ascii_letters + string.digits
+
+
+def fake_id(text: str) -> str:
+    """
+    Deterministic 22 chars base62 id of a text
+    """
+    number = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest(), "big")
+    out = []
+    for _ in range(22):
+        number, digit = divmod(number, 62)
+        out.append(_ALPHABET[digit])
+    return "".join(out)
+
+
+def fake_features(spotify_id: str) -> dict:
+    """
+    Deterministic audio features of an id, shaped like the Web API payload
+    """
+    rng = random.Random(spotify_id)
+    return {
+        "danceability": rng.random(), "energy": rng.random(), "key": rng.randint(0, 11),
+        "loudness": rng.uniform(-30, 0), "mode": rng.randint(0, 1), "speechiness": rng.random(),
+        "acousticness": rng.random(), "instrumentalness": rng.random(), "liveness": rng.random(),
+        "valence": rng.random(), "tempo": rng.uniform(60, 200), "type": "audio_features", "id": spotify_id,
+        "uri": f"spotify:track:{spotify_id}", "track_href": "", "analysis_url": "", "duration_ms": 200000,
+        "time_signature": 4
+    }
+
+
+def fake_analysis(spotify_id: str, segments: int = 800) -> dict:
+    """
+    Deterministic audio analysis of an id, shaped like the Web API payload, with as many segments as a 3 minutes track
+    """
+    rng = random.Random(spotify_id)
+    tempo = rng.uniform(60, 200)
+    beat = 60 / tempo
+    duration = 200.0
+    step = duration / segments
+    return {
+        "track": {"duration": duration, "tempo": tempo, "key": rng.randint(0, 11), "mode": rng.randint(0, 1),
+                  "time_signature": 4},
+        "bars": [{"start": i * 4 * beat, "duration": 4 * beat, "confidence": rng.random()}
+                 for i in range(int(duration / beat / 4))],
+        "beats": [{"start": i * beat, "duration": beat, "confidence": rng.random()} for i in range(int(duration / beat))],
+        "sections": [{"start": i * 40.0, "duration": 40.0, "loudness": rng.uniform(-20, 0), "tempo": tempo,
+                      "key": rng.randint(0, 11), "mode": rng.randint(0, 1), "time_signature": 4} for i in range(5)],
+        "segments": [{"start": i * step, "duration": step, "loudness_start": rng.uniform(-60, 0),
+                      "loudness_max": rng.uniform(-30, 0), "loudness_max_time": rng.random() * step,
+                      "pitches": [rng.random() for _ in range(12)],
+                      "timbre": [rng.uniform(-100, 100) for _ in range(12)]} for i in range(segments)]
+    }
+
+
+class SpotifyStandIn:
+    """
+    Local HTTP server implementing the token, search, album tracks, audio-features and
+    audio-analysis endpoints of the Spotify Web API.
+    Albums follow the layout of library.generate: "Album n" holds the tracks "Track i" with i // albums_size == n
+    Args:
+        latency: seconds added to every response
+        rate_limit: probability of answering 429 to a request
+        retry_after: the Retry-After value of the 429 responses
+        miss_rate: probability of a search without results
+        seed: the seed of the random 429 responses
+        albums_size: how many tracks every album has
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0, retry_after: float = 0.1,
+                 miss_rate: float = 0.0, seed: int = 0, albums_size: int = 12):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.miss_rate = miss_rate
+        self.albums_size = albums_size
+
+        self.requests = {"token": 0, "search": 0, "albums": 0, "audio-features": 0, "audio-analysis": 0,
+                         "429": 0}
+        self._albums = {}  # album id: album number
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self) -> "SpotifyStandIn":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "SpotifyStandIn":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _count(self, endpoint: str) -> bool:
+        """
+        Count a request and decide if it is rate limited
+        """
+        with self._lock:
+            self.requests[endpoint] += 1
+            limited = endpoint != "token" and self._rng.random() < self.rate_limit
+            if limited:
+                self.requests["429"] += 1
+        return limited
+
+    def _search(self, query: str, kind: str = "track") -> dict:
+        if kind == "album":
+            album = re.match(r"album:Album (\d+)\b", query)
+            if album is None or random.Random(query).random() < self.miss_rate:
+                return {"albums": {"items": []}}
+            album_id = fake_id(f"album:{album.group(1)}")
+            with self._lock:
+                self._albums[album_id] = int(album.group(1))
+            return {"albums": {"items": [{"id": album_id}]}}
+
+        if random.Random(query).random() < self.miss_rate:
+            return {"tracks": {"items": []}}
+        return {"tracks": {"items": [{"id": fake_id(query)}]}}
+
+    def _album_tracks(self, album_id: str, offset: int, limit: int) -> dict:
+        album = self._albums.get(album_id)
+        if album is None:
+            return None
+
+        numbers = range(offset, min(offset + limit, self.albums_size))
+        items = [{"id": fake_id(f"track:{album}:{k}"), "name": f"Track {album * self.albums_size + k}",
+                  "track_number": k + 1, "disc_number": 1} for k in numbers]
+        more = offset + limit < self.albums_size
+        return {"items": items, "next": f"{self.url}/v1/albums/{album_id}/tracks?offset={offset + limit}&limit={limit}"
+                if more else None}
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def _reply(self, status: int, payload: dict = None, headers: dict = None) -> None:
+                body = json.dumps(payload or {}).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self) -> None:
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if urlsplit(self.path).path != "/api/token":
+                    return self._reply(404)
+
+                stand_in._count("token")
+                time.sleep(stand_in.latency)
+                self._reply(200, {"access_token": "stand-in", "token_type": "Bearer", "expires_in": 3600})
+
+            def do_GET(self) -> None:
+                url = urlsplit(self.path)
+                path = url.path.rstrip("/")
+                query = parse_qs(url.query)
+
+                if path == "/v1/search":
+                    endpoint = "search"
+                elif path == "/v1/audio-features":
+                    endpoint = "audio-features"
+                elif re.fullmatch(r"/v1/albums/\w+/tracks", path):
+                    endpoint = "albums"
+                elif re.fullmatch(r"/v1/audio-analysis/\w+", path):
+                    endpoint = "audio-analysis"
+                else:
+                    return self._reply(404)
+
+                if self.headers.get("Authorization") != "Bearer stand-in":
+                    return self._reply(401)
+
+                time.sleep(stand_in.latency)
+                if stand_in._count(endpoint):
+                    return self._reply(429, headers={"Retry-After": str(stand_in.retry_after)})
+
+                if endpoint == "search":
+                    self._reply(200, stand_in._search(query.get("q", [""])[0], query.get("type", ["track"])[0]))
+                elif endpoint == "albums":
+                    tracks = stand_in._album_tracks(path.split("/")[3], int(query.get("offset", ["0"])[0]),
+                                                    int(query.get("limit", ["20"])[0]))
+                    self._reply(404 if tracks is None else 200, tracks)
+                elif endpoint == "audio-analysis":
+                    self._reply(200, fake_analysis(path.split("/")[3]))
+                else:
+                    ids = query.get("ids", [""])[0].split(",")
+                    self._reply(200, {"audio_features": [fake_features(i) for i in ids]})
+
+        return Handler
@@ -0,0 +1,222 @@
+import logging
+import re
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from .api import API, AuthError, FatalError, RetryableError
+from .cache import LookupCache
+from .metrics import metrics
+from .song import Song
+
+# Album artists meaning "no single artist", searched without the artist
+_COMPILATIONS = {"various artists", "various", "va", "v.a.", "compilation"}
+# "(Remastered 2011)", "[Live]", "- 2011 Remaster" and similar suffixes
+_SUFFIX = re.compile(r"\s*(\(.*?\)|\[.*?\])|\s+-\s+.*$")
+
+
+def album_key(song: Song) -> Optional[Tuple[str, str, object]]:
+    """
+    Get the album a song belongs to
+    Args:
+        song: the Song object
+
+    Returns:
+        A tuple (album, album artist, year) of normalized values, None if the song has no album
+    """
+    if not song["album"]:
+        return None
+
+    artist = song["albumartist"] or song["artist"]
+    return LookupCache.normalize(song["album"]), LookupCache.normalize(artist or ""), song["year"]
+
+
+def simplify_title(title: str) -> str:
+    """
+    Normalize a track title and drop its version suffixes, so "Song (2011 Remaster)" matches "Song"
+    Args:
+        title: the title
+
+    Returns:
+        The simplified title
+    """
+    title = LookupCache.normalize(title)
+    simple = _SUFFIX.sub("", title).strip()
+    return simple or title
+
+
+class AlbumGrouper:
+    """
+    Group a stream of parsed songs by album. The files of an album are scanned together, so an album is considered
+    complete once window songs have been added after its last one, and the grouper never holds many albums at once
+    Args:
+        window: how many songs are added after the last song of an album before it is released
+    """
+
+    def __init__(self, window: int = 100):
+        self.window = window
+        self._albums: "OrderedDict[tuple, Tuple[List[Song], int]]" = OrderedDict()
+        self._added = 0
+
+    def add(self, song: Song) -> List[List[Song]]:
+        """
+        Add a song
+        Args:
+            song: the Song object
+
+        Returns:
+            The groups now complete, songs without album are a group on their own
+        """
+        self._added += 1
+        key = album_key(song)
+        if key is None:
+            return [[song]]
+
+        songs = self._albums.pop(key, ([], 0))[0]
+        songs.append(song)
+        self._albums[key] = (songs, self._added)
+
+        ready = []
+        while self._albums:
+            key, (songs, last) = next(iter(self._albums.items()))
+            if self._added - last < self.window:
+                break
+            del self._albums[key]
+            ready.append(songs)
+
+        return ready
+
+    def flush(self) -> List[List[Song]]:
+        """
+        Release every group still held
+        Returns:
+            The groups
+        """
+        groups = [songs for songs, _ in self._albums.values()]
+        self._albums.clear()
+        return groups
+
+
+class AlbumResolver:
+    """
+    Resolve the songs of a local album with an album search and its tracklist, instead of one or two searches
+    per song. Songs are matched to the album tracks by title and track number, the unmatched ones are left
+    to the per-track search
+    Args:
+        spotipy: the API object used to search
+        min_tracks: albums with fewer local songs are left to the per-track search
+    """
+
+    def __init__(self, spotipy: API, min_tracks: int = 3):
+        self.spotipy = spotipy
+        self.min_tracks = min_tracks
+
+    def resolve(self, songs: List[Song]) -> List[Song]:
+        """
+        Set the spotify id of the songs of an album
+        Args:
+            songs: the Song objects of one album, as grouped by AlbumGrouper
+
+        Returns:
+            The songs not matched to a track of the album
+        """
+        if len(songs) < self.min_tracks:
+            return songs
+
+        first = songs[0]
+        artist = first["albumartist"] or first["artist"]
+        if LookupCache.normalize(artist or "") in _COMPILATIONS:
+            artist = None
+
+        try:
+            album_id = self.spotipy.search_album(first["album"], artist, first["year"])
+            if album_id is None and first["year"]:
+                # Reissues often have a different year on Spotify
+                album_id = self.spotipy.search_album(first["album"], artist, None)
+            if album_id is None:
+                logging.debug(f"Album {first['album']} - {artist} not found, searching its songs one by one")
+                return songs
+
+            tracks = self.spotipy.album_tracks(album_id)
+        except AuthError:
+            raise
+        except (RetryableError, FatalError) as e:
+            logging.error(f"Search of album {first['album']} - {artist} failed ({e}), searching its songs one by one")
+            return songs
+
+        leftovers = match_tracks(songs, tracks)
+        metrics.count("album_songs_matched", len(songs) - len(leftovers))
+        logging.debug(f"Album {first['album']} - {artist}: {len(songs) - len(leftovers)}/{len(songs)} songs matched")
+
+        return leftovers
+
+    def resolve_bulk(self, songs: List[Song]) -> Tuple[List[Song], List[Song]]:
+        """
+        Resolve many songs album by album concurrently, the songs left are searched one by one with search_bulk
+        Args:
+            songs: the Song objects
+
+        Returns:
+            The songs found and the songs not found, in the given order
+        """
+        albums = defaultdict(list)
+        leftovers = []
+        for song in songs:
+            key = album_key(song)
+            if key is None:
+                leftovers.append(song)
+            else:
+                albums[key].append(song)
+
+        with ThreadPoolExecutor(max_workers=self.spotipy.workers) as pool:
+            for left in pool.map(self.resolve, albums.values()):
+                leftovers += left
+
+        _, missing = self.spotipy.search_bulk(leftovers)
+        missing_ids = set(map(id, missing))
+
+        return [song for song in songs if id(song) not in missing_ids], missing
+
+
+def match_tracks(songs: List[Song], tracks: List[dict]) -> List[Song]:
+    """
+    Match local songs to the tracks of an album, setting their spotify id.
+    A song matches the track with the same simplified title, or the track with the same number whose title
+    contains its title or is contained in it
+    Args:
+        songs: the Song objects of the album
+        tracks: the track objects of the album
+
+    Returns:
+        The songs not matched
+    """
+    by_title = {}
+    by_number = defaultdict(list)
+    for track in tracks:
+        if track["id"] is None:
+            continue
+        by_title.setdefault(simplify_title(track["name"]), track)
+        by_number[track["track_number"]].append(track)
+
+    used = set()
+    leftovers = []
+    for song in songs:
+        title = simplify_title(song["title"])
+        track = by_title.get(title)
+        if track is None or track["id"] in used:
+            track = next((candidate for candidate in by_number.get(song["track"], [])
+                          if candidate["id"] not in used and _similar(title, simplify_title(candidate["name"]))),
+                         None)
+
+        if track is None:
+            leftovers.append(song)
+            continue
+
+        used.add(track["id"])
+        song["spotify_id"] = track["id"]
+
+    return leftovers
+
+
+def _similar(a: str, b: str) -> bool:
+    return bool(a) and bool(b) and (a in b or b in a)
@@ -0,0 +1,244 @@
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+# Columns of the arrays, in order
+SECTION_COLUMNS = ["start", "duration", "loudness", "tempo", "key", "mode", "time_signature"]
+SEGMENT_COLUMNS = ["loudness_start", "loudness_max", "loudness_max_time"]
+
+
+class Analysis:
+    """
+    Audio analysis of a track stored as compact NumPy arrays instead of the nested json of the audio-analysis
+    endpoint, about 2 KB per track instead of half a megabyte.
+    Beat and bar starts are kept as uint16 millisecond steps (uint32 if a step is longer than a minute), the loudness,
+    pitches and timbre of the segments are averaged per section, weighted by the segment durations: float16 loudness
+    and timbre, uint8 pitches (0-255 for 0-1)
+    Args:
+        duration: the length of the track in seconds
+        tempo: the overall tempo, in beats per minute
+        key: the overall key, -1 if unknown
+        mode: 1 for major, 0 for minor
+        time_signature: the beats per bar
+        beat_steps: the milliseconds between the beat starts, the first one from the start of the track
+        bar_steps: the milliseconds between the bar starts, the first one from the start of the track
+        sections: the (sections, 7) float32 array with the SECTION_COLUMNS
+        loudness: the (sections, 3) array with the SEGMENT_COLUMNS
+        pitches: the (sections, 12) chroma array
+        timbre: the (sections, 12) timbre array
+    """
+
+    def __init__(self, duration: float, tempo: float, key: int, mode: int, time_signature: int,
+                 beat_steps: np.ndarray, bar_steps: np.ndarray, sections: np.ndarray, loudness: np.ndarray,
+                 pitches: np.ndarray, timbre: np.ndarray):
+        self.duration = duration
+        self.tempo = tempo
+        self.key = key
+        self.mode = mode
+        self.time_signature = time_signature
+
+        self.beat_steps = beat_steps
+        self.bar_steps = bar_steps
+        self.sections = sections
+        self.loudness = loudness
+        self.pitches = pitches
+        self.timbre = timbre
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Analysis":
+        """
+        Convert an audio-analysis payload
+        Args:
+            data: the json object of the audio-analysis endpoint
+
+        Returns:
+            An Analysis object
+        """
+        track = data.get("track", {})
+        sections = np.array([[section.get(column, 0) for column in SECTION_COLUMNS]
+                             for section in data.get("sections", [])], dtype=np.float32).reshape(-1, 7)
+        segments = data.get("segments", [])
+        # The section of every segment is the last one starting before it
+        times = _intervals(segments)
+        section = np.searchsorted(sections[:, 0], times[:, 0], side="right") - 1
+        weights = times[:, 1]
+
+        pitches = _pool(np.array([segment.get("pitches", [0] * 12) for segment in segments],
+                                 dtype=np.float32).reshape(-1, 12), section, weights, len(sections))
+
+        return cls(
+            duration=float(track.get("duration", 0)),
+            tempo=float(track.get("tempo", 0)),
+            key=int(track.get("key", -1)),
+            mode=int(track.get("mode", 0)),
+            time_signature=int(track.get("time_signature", 4)),
+            beat_steps=_steps(data.get("beats", [])),
+            bar_steps=_steps(data.get("bars", [])),
+            sections=sections,
+            loudness=_pool(np.array([[segment.get(column, 0) for column in SEGMENT_COLUMNS] for segment in segments],
+                                    dtype=np.float32).reshape(-1, 3), section, weights, len(sections)
+                           ).astype(np.float16),
+            pitches=np.round(pitches.clip(0, 1) * 255).astype(np.uint8),
+            timbre=_pool(np.array([segment.get("timbre", [0] * 12) for segment in segments],
+                                  dtype=np.float32).reshape(-1, 12), section, weights, len(sections)
+                         ).astype(np.float16)
+        )
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the arrays
+        """
+        return sum(array.nbytes for array in (self.beat_steps, self.bar_steps, self.sections, self.loudness,
+                                               self.pitches, self.timbre))
+
+    def beats(self) -> np.ndarray:
+        """
+        Get the beat starts
+        Returns:
+            The float32 array of the starts in seconds
+        """
+        return _starts(self.beat_steps)
+
+    def bars(self) -> np.ndarray:
+        """
+        Get the bar starts
+        Returns:
+            The float32 array of the starts in seconds
+        """
+        return _starts(self.bar_steps)
+
+    def chroma(self) -> np.ndarray:
+        """
+        Get the pitches as floats
+        Returns:
+            The (sections, 12) float32 array in 0-1
+        """
+        return self.pitches.astype(np.float32) / 255
+
+    def to_arrays(self) -> dict:
+        """
+        Get the fields as arrays, as saved by AnalysisCache
+        Returns:
+            A dict name: array
+        """
+        return {
+            "summary": np.array([self.duration, self.tempo, self.key, self.mode, self.time_signature],
+                                dtype=np.float32),
+            "beat_steps": self.beat_steps,
+            "bar_steps": self.bar_steps,
+            "sections": self.sections,
+            "loudness": self.loudness,
+            "pitches": self.pitches,
+            "timbre": self.timbre
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "Analysis":
+        """
+        Rebuild an analysis saved with to_arrays
+        Args:
+            arrays: a mapping name: array, e.g. an opened npz file
+
+        Returns:
+            An Analysis object
+        """
+        duration, tempo, key, mode, time_signature = arrays["summary"].tolist()
+        return cls(duration, tempo, int(key), int(mode), int(time_signature),
+                   **{name: arrays[name] for name in ("beat_steps", "bar_steps", "sections", "loudness", "pitches",
+                                                      "timbre")})
+
+
+def _intervals(items: list) -> np.ndarray:
+    """
+    Get the start and duration of time intervals
+    """
+    return np.array([[item.get("start", 0), item.get("duration", 0)] for item in items],
+                    dtype=np.float32).reshape(-1, 2)
+
+
+def _steps(items: list) -> np.ndarray:
+    """
+    Get the milliseconds between the starts of time intervals, rounding the starts and not the steps so the error
+    does not add up
+    """
+    starts = np.round(np.array([item.get("start", 0) for item in items], dtype=np.float64) * 1000).astype(np.int64)
+    steps = np.diff(starts, prepend=0).clip(0)
+    return steps.astype(np.uint16 if not len(steps) or steps.max() <= np.iinfo(np.uint16).max else np.uint32)
+
+
+def _starts(steps: np.ndarray) -> np.ndarray:
+    """
+    Get the starts in seconds back from their millisecond steps
+    """
+    return (np.cumsum(steps, dtype=np.int64) / 1000).astype(np.float32)
+
+
+def _pool(values: np.ndarray, groups: np.ndarray, weights: np.ndarray, size: int) -> np.ndarray:
+    """
+    Weighted mean of the rows of each group, rows outside the groups (e.g. before the first section) join the
+    nearest one
+    """
+    sums = np.zeros((size, values.shape[1]), dtype=np.float64)
+    totals = np.zeros(size, dtype=np.float64)
+    if size:
+        groups = groups.clip(0, size - 1)
+        np.add.at(sums, groups, values * weights[:, None])
+        np.add.at(totals, groups, weights)
+    return (sums / np.maximum(totals, 1e-9)[:, None]).astype(np.float32)
+
+
+class AnalysisCache:
+    """
+    On-disk cache of the analyses, one compressed .npz per track, so an analysis is requested only once
+    Args:
+        directory: where the files are kept, created if needed
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, spotify_id: str) -> str:
+        # Two levels of directories keep each one small on big libraries
+        return os.path.join(self.directory, spotify_id[:2], f"{spotify_id}.npz")
+
+    def __contains__(self, spotify_id: str) -> bool:
+        return os.path.isfile(self._filename(spotify_id))
+
+    def get(self, spotify_id: str) -> Optional[Analysis]:
+        """
+        Load the analysis of a track
+        Args:
+            spotify_id: the spotify id of the track
+
+        Returns:
+            The Analysis object, None if it is not cached
+        """
+        try:
+            with np.load(self._filename(spotify_id)) as arrays:
+                return Analysis.from_arrays(arrays)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Cached analysis of {spotify_id} is unreadable ({e!r}), it will be requested again")
+            return None
+
+    def put(self, spotify_id: str, analysis: Analysis) -> None:
+        """
+        Save the analysis of a track
+        Args:
+            spotify_id: the spotify id of the track
+            analysis: the Analysis object
+
+        Returns:
+            None
+        """
+        filename = self._filename(spotify_id)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        tmp = f"{filename}.tmp.npz"
+        np.savez_compressed(tmp, **analysis.to_arrays())
+        os.replace(tmp, filename)
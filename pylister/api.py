@@ -1,23 +1,98 @@
 import base64
 import logging
-from typing import List
-from requests import Session, post
-
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from pylister.analysis import Analysis, AnalysisCache
+from pylister.cache import LookupCache
+from pylister.metrics import metrics
+from pylister.ratelimit import TokenBucket
 from pylister.song import Song
+from pylister.transport import SessionTransport, Transport
+
+
+class APIError(ValueError):
+    """
+    A request to the Spotify Web API failed
+    """
+
+
+class RetryableError(APIError):
+    """
+    A request failed for a transient reason (rate limit, server error, network) and can be tried again later
+    """
+
+
+class FatalError(APIError):
+    """
+    A request failed and retrying it will not help (bad credentials, bad request)
+    """
+
+
+class AuthError(FatalError):
+    """
+    The credentials were rejected, every other request would fail too
+    """
 
 
 class API:
+    """
+    Client of the Spotify Web API
+    Args:
+        cache: a LookupCache checked before any request
+        workers: how many requests can run concurrently
+        rate: the maximum number of requests per second
+        api_url: the base url of the Web API, e.g. to use a local stand-in
+        accounts_url: the base url of the accounts service
+        transport: sends the requests, e.g. a RecordingTransport or a ReplayTransport; defaults to the session
+        analyses: an AnalysisCache keeping the audio analyses, which are large and requested one track at a time
+    """
     _ID = None  # First line
     _SECRET = None  # Second line
     _TOKEN_URL = "https://accounts.spotify.com/api/token"
     _SEARCH_URL = "https://api.spotify.com/v1/search"
     _FEATURES_URL = "https://api.spotify.com/v1/audio-features/"
     _ANALYSIS_URL = "https://api.spotify.com/v1/audio-analysis/"
+    _ALBUMS_URL = "https://api.spotify.com/v1/albums/"
 
     _MAX_IDS = 100
+    _MAX_ALBUM_TRACKS = 50
+    _RETRIES = 5
+    _BACKOFF = 0.5  # seconds, doubled at every retry
+    _MAX_BACKOFF = 30
+    _EXPIRY_MARGIN = 60  # seconds before the expiration when the token is refreshed
+
+    def __init__(self, cache: LookupCache = None, workers: int = 8, rate: float = 20, api_url: str = None,
+                 accounts_url: str = None, transport: Transport = None, analyses: AnalysisCache = None):
+        if api_url is not None:
+            self._SEARCH_URL = f"{api_url}/v1/search"
+            self._FEATURES_URL = f"{api_url}/v1/audio-features/"
+            self._ANALYSIS_URL = f"{api_url}/v1/audio-analysis/"
+            self._ALBUMS_URL = f"{api_url}/v1/albums/"
+        if accounts_url is not None:
+            self._TOKEN_URL = f"{accounts_url}/api/token"
 
-    def __init__(self):
         self.session = Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.transport = transport if transport is not None else SessionTransport(self.session)
+
+        self.cache = cache
+        self.analyses = analyses
+        self.workers = workers
+        self.limiter = TokenBucket(rate)
+
+        self._token = None
+        self._expires_at = 0.0
+        self._token_lock = threading.Lock()
 
     def __list_split(self, split: list, n: int) -> list:
         """
@@ -47,6 +122,113 @@ class API:
             out += f"{track['spotify_id']},"
         return out[:-1]  # removes the trailing comma
 
+    def _get(self, url: str) -> Response:
+        """
+        Send an authenticated GET request
+        Args:
+            url: the url to request
+
+        Returns:
+            The response, always with status 200
+        """
+        return self._request("GET", url)
+
+    def _request(self, method: str, url: str, authenticate: bool = True, **kwargs) -> Response:
+        """
+        Send a request through the rate limiter.
+        The token is refreshed before it expires and when the server answers 401,
+        connection errors and 5xx responses are retried with exponential backoff,
+        429 responses pause the limiter for the time asked by the Retry-After header
+        Args:
+            method: the http method
+            url: the url to request
+            authenticate: add the bearer token to the request
+            **kwargs: passed to Session.request
+
+        Returns:
+            The response, always with status 200
+
+        Raises:
+            RetryableError: the request kept failing for a transient reason
+            AuthError: the token was rejected again after a refresh
+            FatalError: the request cannot succeed
+        """
+        refreshed = False
+        attempt = 0
+        while True:
+            last = attempt == self._RETRIES
+            if authenticate:
+                token = self.__valid_token()
+                kwargs["headers"] = {"Authorization": f"Bearer {token}"}
+            waited = time.perf_counter()
+            self.limiter.acquire()
+            started = time.perf_counter()
+            metrics.observe("rate_limiter_wait_ms", (started - waited) * 1000)
+
+            try:
+                response = self.transport.request(method, url=url, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                metrics.count("http_connection_errors")
+                if last:
+                    raise RetryableError(f"Request failed: {e!r}") from e
+                logging.warning(f"Request failed ({e!r}), retrying. Url = {url}")
+                metrics.count("http_retries")
+                self.__backoff(attempt)
+                attempt += 1
+                continue
+
+            status = response.status_code
+            endpoint = url.split("?")[0].rstrip("/").rsplit("/", 2)
+            # Urls ending with a track id are counted under their endpoint, e.g. audio-analysis
+            endpoint = endpoint[-2] if len(endpoint[-1]) == 22 and len(endpoint) > 1 else endpoint[-1]
+            metrics.count(f"http_requests.{endpoint}")
+            metrics.count(f"http_status.{status}")
+            metrics.observe(f"http_latency_ms.{endpoint}", (time.perf_counter() - started) * 1000)
+            if status == 200:
+                return response
+
+            if status == 401 and authenticate:
+                if refreshed:
+                    raise AuthError(f"Token rejected right after a refresh. Url = {url}")
+                # Not counted as an attempt, the token is refreshed only once
+                logging.info("Token rejected, refreshing it")
+                metrics.count("http_retries")
+                self.__refresh_token(token)
+                refreshed = True
+                continue
+
+            if status == 429 and not last:
+                retry_after = float(response.headers.get("Retry-After", 1))
+                logging.warning(f"Rate limited, pausing requests for {retry_after}s")
+                metrics.count("http_retries")
+                self.limiter.pause(retry_after)
+                attempt += 1
+                continue
+
+            if status >= 500 and not last:
+                logging.warning(f"Server error {status}, retrying. Url = {url}")
+                metrics.count("http_retries")
+                self.__backoff(attempt)
+                attempt += 1
+                continue
+
+            logging.warning(f"Request failed. Status = {status} - Url = {url} - Response = {response.content}")
+            if status == 429 or status >= 500:
+                raise RetryableError(f"Request failed with status {status}")
+            raise FatalError(f"Request failed with status {status}")
+
+    def __backoff(self, attempt: int) -> None:
+        """
+        Sleep before a retry, with jitter so the workers do not retry all together
+        Args:
+            attempt: the number of the failed attempt, starting from 0
+
+        Returns:
+            None
+        """
+        delay = min(self._MAX_BACKOFF, self._BACKOFF * 2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1))
+
     def key_parse(self, keyfile: str) -> None:
         """
         Load the client id and the client secret from the .key file
@@ -82,21 +264,60 @@ class API:
             logging.error("Client ID and Client Secret cannot be None")
             raise ValueError("Client ID and Client Secret cannot be None")
 
-        auth_str = bytes(f"{self._ID}:{self._SECRET}", 'utf-8')
-        auth_b64 = base64.b64encode(auth_str).decode('utf-8')
-        headers = {
-            "Authorization": f"Basic {auth_b64}"
-        }
-        body = {"grant_type": "client_credentials"}
+        self.__refresh_token(self._token)
+
+        return self
 
-        response = post(url=self._TOKEN_URL, headers=headers, data=body)
-        data = response.json()
+    def __valid_token(self) -> str:
+        """
+        Get the current token, refreshing it if it is about to expire
+        Returns:
+            The access token
+        """
+        token = self._token
+        if token is None or time.monotonic() >= self._expires_at - self._EXPIRY_MARGIN:
+            self.__refresh_token(token)
+            token = self._token
 
-        token_header = {"Authorization": f"Bearer {data['access_token']}"}
+        return token
 
-        self.session.headers = token_header
+    def __refresh_token(self, stale: str = None) -> None:
+        """
+        Request a new client credentials token, unless another thread already replaced the stale one
+        Args:
+            stale: the token known to be expired or rejected
 
-        return self
+        Returns:
+            None
+        """
+        with self._token_lock:
+            if self._token != stale:
+                return
+
+            if self._ID is None or self._SECRET is None:
+                logging.error("Client ID and Client Secret cannot be None")
+                raise AuthError("Client ID and Client Secret cannot be None")
+
+            auth_str = bytes(f"{self._ID}:{self._SECRET}", 'utf-8')
+            auth_b64 = base64.b64encode(auth_str).decode('utf-8')
+            headers = {
+                "Authorization": f"Basic {auth_b64}"
+            }
+            body = {"grant_type": "client_credentials"}
+
+            requested = time.monotonic()
+            try:
+                response = self._request("POST", self._TOKEN_URL, authenticate=False, headers=headers, data=body)
+            except AuthError:
+                raise
+            except FatalError as e:
+                raise AuthError(f"Cannot get a token: {e}") from e
+            data = response.json()
+
+            self._token = data["access_token"]
+            self._expires_at = requested + data.get("expires_in", 3600)
+            metrics.count("token_refreshes")
+            logging.debug("Obtained a new token")
 
     def search(self, track: Song, isrc: bool = False) -> None:
         """
@@ -108,38 +329,194 @@ class API:
         Returns:
             None
         """
+        key = None
+        if self.cache is not None:
+            key = self.cache.search_key(track, isrc)
+            known, spotify_id = self.cache.get_id(key)
+            if known:
+                if spotify_id is None:
+                    raise IndexError(f"{track['title']} - {track['artist']} is a cached miss")
+                track["spotify_id"] = spotify_id
+                return
+
+        # Quoted, a "#" or a "&" in a tag would cut the query
         if isrc and track['isrc'] is not None:
-            query = f"isrc:{track['isrc']}&type=track"
+            query = f"isrc:{quote(str(track['isrc']))}&type=track"
         else:
-            query = f"{track['title']}%20artist:{track['artist']}%20year:{track['year']}&type=track"
+            title, artist = quote(str(track['title'])), quote(str(track['artist']))
+            query = f"{title}%20artist:{artist}%20year:{track['year']}&type=track"
         url = f"{self._SEARCH_URL}?q={query}"
 
-        response = self.session.get(url=url)
-        if response.status_code != 200:
-            logging.warning(f"Search request failed. Status = {response.status_code} - Url = {url} - Response = "
-                            f"{response.content}")
-            raise ValueError(f"Search request failed.")
+        response = self._get(url)
+        items = response.json()["tracks"]["items"]
+        if not items:
+            if key is not None:
+                self.cache.put_id(key, None)
+            raise IndexError(f"{track['title']} - {track['artist']} not found")
 
-        spotify_id = response.json()["tracks"]["items"][0]["id"]
+        spotify_id = items[0]["id"]
 
         if spotify_id is None or len(spotify_id) != 22:
             logging.critical(f"id is wrong for {track['title']} - {track['artist']}")
+        elif key is not None:
+            self.cache.put_id(key, spotify_id)
 
         track["spotify_id"] = spotify_id
 
+    def search_track(self, track: Song) -> bool:
+        """
+        Search a song using the isrc first, then using artist, title and year
+        Args:
+            track: the Song Object representing the track to search
+
+        Returns:
+            True if the song was found, False if it was not found or its search failed
+
+        Raises:
+            AuthError: the credentials were rejected
+        """
+        try:
+            try:
+                self.search(track, True)  # Search using isrc
+            except IndexError:  # Not found
+                try:
+                    self.search(track)  # Search using artist, title and year
+                except IndexError:  # Not found, again
+                    return False
+        except RetryableError as e:
+            logging.error(f"Search of {track['title']} - {track['artist']} failed ({e}), it will be retried later")
+            return False
+        except AuthError:
+            raise
+        except FatalError as e:
+            # A bad request for this song only, the others go on
+            logging.error(f"Search of {track['title']} - {track['artist']} failed ({e}), skipping it")
+            return False
+
+        return True
+
+    def search_bulk(self, tracks: List[Song]) -> Tuple[List[Song], List[Song]]:
+        """
+        Search a list of songs concurrently, sharing the session's connection pool and the rate limiter
+        Args:
+            tracks: a list of Song Objects
+
+        Returns:
+            The songs found and the songs not found, in the given order
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self.search_track, tracks))
+
+        found = [track for track, ok in zip(tracks, results) if ok]
+        missing = [track for track, ok in zip(tracks, results) if not ok]
+
+        return found, missing
+
+    def search_album(self, album: str, artist: Optional[str], year) -> Optional[str]:
+        """
+        Search an album using the Spotify Web API
+        Args:
+            album: the album title
+            artist: the album artist, None for compilations
+            year: the release year, None if unknown
+
+        Returns:
+            The spotify id of the album, None if it was not found
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.album_key(album, artist, year)
+            known, album_id = self.cache.get_id(key)
+            if known:
+                return album_id
+
+        query = f"album:{quote(album)}"
+        if artist:
+            query += f"%20artist:{quote(artist)}"
+        if year:
+            query += f"%20year:{year}"
+        url = f"{self._SEARCH_URL}?q={query}&type=album&limit=1"
+
+        items = self._get(url).json()["albums"]["items"]
+        album_id = items[0]["id"] if items else None
+        if key is not None:
+            self.cache.put_id(key, album_id)
+
+        return album_id
+
+    def album_tracks(self, album_id: str) -> List[dict]:
+        """
+        Get the tracklist of an album, following the pages of the album tracks endpoint
+        Args:
+            album_id: the spotify id of the album
+
+        Returns:
+            The track objects, with id, name, track_number and disc_number
+        """
+        if self.cache is not None:
+            known, tracks = self.cache.get_album(album_id)
+            if known:
+                return tracks
+
+        tracks = []
+        url = f"{self._ALBUMS_URL}{album_id}/tracks?limit={self._MAX_ALBUM_TRACKS}"
+        while url:
+            page = self._get(url).json()
+            tracks += [{key: item.get(key) for key in ("id", "name", "track_number", "disc_number")}
+                       for item in page["items"]]
+            url = page.get("next")
+
+        if self.cache is not None:
+            self.cache.put_album(album_id, tracks)
+
+        return tracks
+
     def feature_bulk(self, tracks: List[Song]) -> None:
         """
-        Get the song features for a list of Song Objects
+        Get the song features for a list of Song Objects.
+        Features found in the cache are used directly, the others are requested in chunks of 100 ids
         Args:
             tracks: a list of Song Objects
 
         Returns:
             None
         """
+        tracks = [track for track in tracks if not self.cached_features(track)]
+
         tracks_chunks = self.__list_split(tracks, self._MAX_IDS)
 
         for chunk in tracks_chunks:
-            self.features(chunk)
+            try:
+                self.features(chunk)
+            except RetryableError as e:
+                logging.error(f"Features request for {len(chunk)} songs failed ({e}), they will be retried later")
+            except AuthError:
+                raise
+            except FatalError as e:
+                logging.error(f"Features request for {len(chunk)} songs failed ({e}), skipping them")
+
+    def cached_features(self, track: Song) -> bool:
+        """
+        Set the features of a track from the cache
+        Args:
+            track: the Song Object
+
+        Returns:
+            True if the cache knows the track, even if its features are missing
+        """
+        if self.cache is None:
+            return False
+
+        known, feature = self.cache.get_features(track["spotify_id"])
+        if not known:
+            return False
+
+        if feature is None:
+            logging.error(f"Features for {track['title']} - {track['artist']} not found (cached)")
+        else:
+            track.set_features(feature)
+
+        return True
 
     def features(self, tracks: List[Song]) -> None:
         """
@@ -153,23 +530,76 @@ class API:
         path = self.__ids_assembler(tracks)
         url = f"{self._FEATURES_URL}?ids={path}"
 
-        response = self.session.get(url=url)
-        if response.status_code != 200:
-            logging.warning(f"Features request failed. Status = {response.status_code} - Url = {url} - Response = "
-                            f"{response.content}")
-            raise ValueError(f"Feature request failed.")
-
+        response = self._get(url)
         data = response.json()["audio_features"]
 
-        for i, track in enumerate(tracks):
-            feature = data[i]
+        not_found = []
+        for track, feature in zip(tracks, data):
+            if self.cache is not None:
+                # set_features consumes the dict, so cache it first
+                self.cache.put_features(track["spotify_id"], feature)
 
             if feature is None:
-                # Remove not song with not found features
-                tracks.remove(track)
-                data.pop(i)
                 # log it
                 logging.error(f"Features for {track['title']} - {track['artist']} not found")
+                not_found.append(track)
                 continue
 
             track.set_features(feature)
+
+        # Remove songs with not found features
+        for track in not_found:
+            tracks.remove(track)
+
+    def analysis(self, track: Song) -> bool:
+        """
+        Get the audio analysis of a song, from the AnalysisCache if it has it
+        Args:
+            track: the Song Object, with its spotify id
+
+        Returns:
+            True if the analysis was set, False if it was not found or the request failed
+        """
+        if self.analyses is not None:
+            analysis = self.analyses.get(track["spotify_id"])
+            if analysis is not None:
+                track.set_analysis(analysis)
+                return True
+
+        try:
+            data = self._get(f"{self._ANALYSIS_URL}{track['spotify_id']}").json()
+        except AuthError:
+            raise
+        except FatalError as e:
+            logging.error(f"Analysis for {track['title']} - {track['artist']} not found ({e})")
+            return False
+        except RetryableError as e:
+            logging.error(f"Analysis request for {track['title']} - {track['artist']} failed ({e}), "
+                          f"it will be retried later")
+            return False
+
+        analysis = Analysis.from_json(data)
+        if self.analyses is not None:
+            self.analyses.put(track["spotify_id"], analysis)
+        track.set_analysis(analysis)
+
+        return True
+
+    def analysis_bulk(self, tracks: List[Song]) -> Tuple[List[Song], List[Song]]:
+        """
+        Get the audio analyses of a list of songs. The endpoint takes a single id, so the requests run concurrently,
+        sharing the session's connection pool and the rate limiter
+        Args:
+            tracks: a list of Song Objects, the ones without spotify id are skipped
+
+        Returns:
+            The songs with their analysis and the songs without, in the given order
+        """
+        tracks = [track for track in tracks if track["spotify_id"] is not None]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self.analysis, tracks))
+
+        found = [track for track, ok in zip(tracks, results) if ok]
+        missing = [track for track, ok in zip(tracks, results) if not ok]
+
+        return found, missing
@@ -0,0 +1,280 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Optional, Tuple
+
+from .metrics import metrics
+from .song import Song
+
+_MISSING = (False, None)  # Returned when the cache knows nothing about a key
+
+
+class LookupCache:
+    """
+    Persistent cache of the Spotify lookups, backed by SQLite.
+    Hits are kept forever by default, misses expire after miss_ttl seconds so they get retried eventually
+    Args:
+        filename: the SQLite database, ":memory:" for a throwaway cache
+        miss_ttl: how many seconds a miss is trusted
+        hit_ttl: how many seconds a hit is trusted, None for ever
+    """
+
+    def __init__(self, filename: str, miss_ttl: float = 30 * 24 * 3600, hit_ttl: float = None):
+        self.filename = filename
+        self.miss_ttl = miss_ttl
+        self.hit_ttl = hit_ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS lookups (key TEXT PRIMARY KEY, spotify_id TEXT, "
+                             "created REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS features (spotify_id TEXT PRIMARY KEY, payload TEXT, "
+                             "created REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS albums (spotify_id TEXT PRIMARY KEY, payload TEXT, "
+                             "created REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS local (key TEXT PRIMARY KEY, payload TEXT, "
+                             "created REAL NOT NULL)")
+
+    @staticmethod
+    def normalize(text) -> str:
+        """
+        Normalize a tag value so that small differences (case, spacing, accents) share the same key
+        Args:
+            text: the value to normalize
+
+        Returns:
+            The normalized string
+        """
+        text = unicodedata.normalize("NFKD", str(text))
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return re.sub(r"\s+", " ", text).strip().casefold()
+
+    @classmethod
+    def search_key(cls, track: Song, isrc: bool = False) -> str:
+        """
+        Get the key of a search: the isrc, or the normalized title, artist and year
+        Args:
+            track: the Song Object searched
+            isrc: if the search uses the isrc
+
+        Returns:
+            The cache key
+        """
+        if isrc and track["isrc"] is not None:
+            return f"isrc:{cls.normalize(track['isrc'])}"
+
+        return f"meta:{cls.normalize(track['title'])}|{cls.normalize(track['artist'])}|{track['year']}"
+
+    def known_miss(self, track: Song) -> bool:
+        """
+        Check if every search of a song is a cached miss, so searching it again would find nothing
+        Args:
+            track: the Song Object
+
+        Returns:
+            True if the searches by isrc and by title, artist and year are fresh misses
+        """
+        keys = {self.search_key(track, True), self.search_key(track)}
+        return all(self.get_id(key) == (True, None) for key in keys)
+
+    @classmethod
+    def album_key(cls, album: str, artist: Optional[str], year) -> str:
+        """
+        Get the key of an album search: the normalized album, artist and year
+        Args:
+            album: the album title
+            artist: the album artist, None for compilations
+            year: the release year
+
+        Returns:
+            The cache key
+        """
+        return f"album:{cls.normalize(album)}|{cls.normalize(artist or '')}|{year}"
+
+    def _fresh(self, created: float, hit: bool) -> bool:
+        """
+        Check if an entry is still valid
+        Args:
+            created: when the entry was written
+            hit: if the entry is a hit or a miss
+
+        Returns:
+            True if the entry can be used
+        """
+        ttl = self.hit_ttl if hit else self.miss_ttl
+        return ttl is None or time.time() - created < ttl
+
+    def _get(self, table: str, column: str, key: str) -> Tuple[bool, Optional[str]]:
+        """
+        Read an entry and update the counters
+        Args:
+            table: the table to read
+            column: the column holding the value
+            key: the primary key
+
+        Returns:
+            A tuple (known, value), value is None for a cached miss
+        """
+        key_column = "key" if table in ("lookups", "local") else "spotify_id"
+        with self._lock:
+            row = self._db.execute(f"SELECT {column}, created FROM {table} WHERE {key_column} = ?",
+                                   (key,)).fetchone()
+
+            if row is None or not self._fresh(row[1], row[0] is not None):
+                self.misses += 1
+                metrics.count("cache_misses")
+                return _MISSING
+
+            self.hits += 1
+            metrics.count("cache_hits")
+            return True, row[0]
+
+    def get_id(self, key: str) -> Tuple[bool, Optional[str]]:
+        """
+        Get the cached spotify id of a search
+        Args:
+            key: the key returned by search_key
+
+        Returns:
+            A tuple (known, spotify_id), spotify_id is None if the song is known to be missing
+        """
+        return self._get("lookups", "spotify_id", key)
+
+    def put_id(self, key: str, spotify_id: Optional[str]) -> None:
+        """
+        Save the result of a search
+        Args:
+            key: the key returned by search_key
+            spotify_id: the id found, None for a miss
+
+        Returns:
+            None
+        """
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)", (key, spotify_id, time.time()))
+
+    def get_features(self, spotify_id: str) -> Tuple[bool, Optional[dict]]:
+        """
+        Get the cached audio features of a track
+        Args:
+            spotify_id: the spotify id of the track
+
+        Returns:
+            A tuple (known, payload), payload is None if the features are known to be missing
+        """
+        known, payload = self._get("features", "payload", spotify_id)
+        if payload is not None:
+            payload = json.loads(payload)
+
+        return known, payload
+
+    def put_features(self, spotify_id: str, payload: Optional[dict]) -> None:
+        """
+        Save the audio features of a track
+        Args:
+            spotify_id: the spotify id of the track
+            payload: the audio features json object, None for a miss
+
+        Returns:
+            None
+        """
+        if payload is not None:
+            payload = json.dumps(payload, separators=(",", ":"))
+
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO features VALUES (?, ?, ?)", (spotify_id, payload, time.time()))
+
+    def get_album(self, spotify_id: str) -> Tuple[bool, Optional[list]]:
+        """
+        Get the cached tracklist of an album
+        Args:
+            spotify_id: the spotify id of the album
+
+        Returns:
+            A tuple (known, tracks), the tracks are the json objects of the album tracks endpoint
+        """
+        known, payload = self._get("albums", "payload", spotify_id)
+        if payload is not None:
+            payload = json.loads(payload)
+
+        return known, payload
+
+    def put_album(self, spotify_id: str, tracks: list) -> None:
+        """
+        Save the tracklist of an album
+        Args:
+            spotify_id: the spotify id of the album
+            tracks: the json objects of the album tracks
+
+        Returns:
+            None
+        """
+        payload = json.dumps(tracks, separators=(",", ":"))
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO albums VALUES (?, ?, ?)", (spotify_id, payload, time.time()))
+
+    def get_local(self, key: str) -> Tuple[bool, Optional[dict]]:
+        """
+        Get the features computed from the audio of a file
+        Args:
+            key: the key returned by LocalExtractor.key
+
+        Returns:
+            A tuple (known, features), features is None if the file could not be decoded
+        """
+        known, payload = self._get("local", "payload", key)
+        if payload is not None:
+            payload = json.loads(payload)
+
+        return known, payload
+
+    def put_local(self, key: str, features: Optional[dict]) -> None:
+        """
+        Save the features computed from the audio of a file
+        Args:
+            key: the key returned by LocalExtractor.key
+            features: the dict with the keys of Feature, None if the file could not be decoded
+
+        Returns:
+            None
+        """
+        if features is not None:
+            features = json.dumps(features, separators=(",", ":"))
+
+        with self._lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO local VALUES (?, ?, ?)", (key, features, time.time()))
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters
+        Returns:
+            A dict with the counters
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def log_stats(self) -> None:
+        """
+        Log the hit and miss counters
+        Returns:
+            None
+        """
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        logging.info(f"Lookup cache: {self.hits} hits, {self.misses} misses ({ratio:.1%} hit ratio)")
+
+    def close(self) -> None:
+        """
+        Close the database
+        Returns:
+            None
+        """
+        with self._lock:
+            self._db.close()
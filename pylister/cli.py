@@ -0,0 +1,570 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from typing import List, Tuple, Union
+
+# Only the standard library is imported here: every command imports the modules it needs, so status and export
+# start without loading scikit-learn, scipy or requests
+
+FILENAME = "playlist.m3u"
+SIMILAR_FILENAME = "similar.m3u"
+PICKLE = "data.pickle"  # Written by older versions, migrated to the dataset
+MANIFEST = "manifest.pickle"  # Written by older versions, migrated to the dataset
+MODE = ["energy", "danceability", "tempo"]
+PREFER = "bitrate"  # Which copy of a duplicate song goes into the playlists, see dedup.PREFERENCES
+SEQUENCE = ["tempo", "energy"]  # Features the playlists are ordered on for smooth transitions
+
+
+def _ask(value, prompt: str, option: str) -> str:
+    """
+    Get a required path, asking for it only when running in a terminal
+    Args:
+        value: the value given on the command line, if any
+        prompt: the question asked
+        option: the option to pass instead
+
+    Returns:
+        The value
+
+    Raises:
+        SystemExit: the value is missing and there is no terminal to ask it
+    """
+    if value is not None:
+        return value
+    if sys.stdin.isatty():
+        return input(prompt)
+
+    raise SystemExit(f"error: {option} is required")
+
+
+def _cluster_n(value: str) -> Union[int, str]:
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected a number of clusters or auto, got {value}")
+
+
+def open_dataset(args: argparse.Namespace, root: str = None, create: bool = False):
+    """
+    Open the dataset, migrating the pickles written by older versions the first time
+    Args:
+        args: the parsed command line
+        root: the music directory, the saved one is kept if None
+        create: create the dataset if there is none
+
+    Returns:
+        A DatasetStore
+
+    Raises:
+        SystemExit: there is no dataset and create is False
+    """
+    from .dataset import DatasetStore
+
+    legacy = os.path.isfile(MANIFEST) or os.path.isfile(PICKLE)
+    if not create and not legacy and not os.path.isdir(args.dataset):
+        raise SystemExit(f"error: no dataset in {args.dataset}, run scan first")
+    if not os.path.isdir(args.dataset) and legacy:
+        dataset = DatasetStore.migrate(args.dataset, manifest=MANIFEST, data=PICKLE)
+        if root is not None:
+            dataset.root = root
+        return dataset
+
+    return DatasetStore(args.dataset, root=root)
+
+
+def open_api(args: argparse.Namespace):
+    """
+    Create the Spotify client, the token is requested only if a request is needed
+    Args:
+        args: the parsed command line
+
+    Returns:
+        An API object
+    """
+    from .api import API
+    from .cache import LookupCache
+
+    spotipy = API(cache=LookupCache(args.cache), workers=args.api_workers, rate=args.rate, api_url=args.api_url,
+                  accounts_url=args.accounts_url)
+    spotipy.key_parse(args.keyfile)
+    return spotipy
+
+
+def apply_changes(args: argparse.Namespace, dataset, changed: List[str], removed: List[str], spotipy=None,
+                  retry: bool = True) -> Tuple[list, bool]:
+    """
+    Parse, search and get the features of the changed files only, then save the dataset
+    Args:
+        args: the parsed command line
+        dataset: the DatasetStore to update
+        changed: the new or changed files
+        removed: the files no more present
+        spotipy: the API object to use, created if a request is needed
+        retry: also retry the songs left unresolved by a previous run
+
+    Returns:
+        The SongCollection of the songs with features, mapped from the dataset, and whether the dataset changed
+    """
+    for file in removed:
+        dataset.remove(file)
+
+    # Songs left unresolved by a previous run are retried, cached misses do not cost a request
+    changed_paths = set(changed)
+    retry = [music for music in dataset.unresolved() if music["path"] not in changed_paths] if retry else []
+    if retry:
+        if spotipy is None:
+            spotipy = open_api(args)
+        # Songs with local features are searched again only once their cached misses expire, not at every run
+        retry = [music for music in retry if music["features"] is None or not spotipy.cache.known_miss(music)]
+
+    updated = False
+    if changed or retry:
+        from .extract import LocalExtractor
+        from .pipeline import Pipeline
+
+        if spotipy is None:
+            spotipy = open_api(args)
+        # Parse only the changed files, search their Spotify ID and get their features
+        local = None if args.no_local else LocalExtractor(cache=spotipy.cache)
+        pipeline = Pipeline(spotipy, workers=args.workers, executor=args.executor, local=local)
+        found, missing = pipeline.run(changed, songs=retry)
+        if local is not None:
+            local.close()
+        logging.info("Completed dataset update")
+        spotipy.cache.log_stats()
+
+        for music in found + missing:
+            dataset.update(music)
+        updated = bool(found or missing)
+
+    if updated or removed:
+        dataset.save()
+    songs = dataset.collection()
+
+    return songs, updated or bool(removed)
+
+
+def update(args: argparse.Namespace):
+    """
+    Incrementally update the dataset: only new or changed files are parsed and searched on Spotify,
+    deleted files are dropped
+    Args:
+        args: the parsed command line, with the music directory
+
+    Returns:
+        The SongCollection of the songs with features
+    """
+    from .utils import list_files
+
+    dataset = open_dataset(args, create=True)
+    path = _ask(args.music or dataset.root, "Where should I search for music files? ", "--music")
+    dataset.root = os.path.abspath(path)
+
+    changed, removed = dataset.diff(list_files(path))
+    logging.info(f"Updating dataset: {len(changed)} new or changed files, {len(removed)} removed files")
+
+    songs, _ = apply_changes(args, dataset, changed, removed)
+    dataset.close()
+
+    return songs
+
+
+def load_clusters(args: argparse.Namespace, songs, fit: bool = True) -> List[list]:
+    """
+    Cluster the songs with the model saved next to the dataset: new songs are assigned to the existing clusters,
+    and the model is refitted from its centroids once enough songs have been added.
+    Only one copy of every recording is clustered
+    Args:
+        args: the parsed command line
+        songs: the SongCollection of the library, its features are clustered in place
+        fit: fit or refit the model when needed, False to only assign songs to the saved model
+
+    Returns:
+        a clustered list
+
+    Raises:
+        SystemExit: fit is False and there is no model matching the options
+    """
+    from .clustering import ClusterModel
+    from .dedup import dedupe
+
+    songs = dedupe(songs, prefer=args.prefer)
+
+    # Options left out keep the ones of the saved model
+    model = ClusterModel.load(args.model) if os.path.isfile(args.model) and not args.refit else None
+    if model is not None and (args.mode not in (None, model.mode) or
+                              args.clusters not in (None, "auto", model.cluster_n)):
+        model = None
+    if model is None:
+        if not fit:
+            raise SystemExit(f"error: no clustering model in {args.model} for these options, run cluster first")
+        logging.info("Fitting clustering model")
+        model = ClusterModel.fit(songs, cluster_n=args.clusters or 4, mode=args.mode or MODE,
+                                 standardize=args.standardize)
+
+    clusters = model.clusters(songs)
+    if model.needs_refit():
+        if fit:
+            model.refit(songs)
+            clusters = model.clusters(songs)
+        else:
+            logging.warning(f"{model.assigned} songs were added since the last fit, run cluster to refit")
+    model.save(args.model)
+
+    return clusters
+
+
+def write_playlists(args: argparse.Namespace, clusters: List[list], name: str = None) -> List[str]:
+    """
+    Order the clusters and write them as numbered playlists in the output directory
+    Args:
+        args: the parsed command line
+        clusters: a clustered list
+        name: the base filename, the --name option by default
+
+    Returns:
+        The playlists written
+    """
+    from .utils import create_playlist
+
+    if args.order:
+        from .sequencing import sequence_clusters
+
+        clusters = sequence_clusters(clusters, args.order)
+
+    os.makedirs(args.out, exist_ok=True)
+    return create_playlist(clusters, os.path.join(args.out, name or args.name or FILENAME), extended=not args.plain,
+                           relative=args.relative)
+
+
+def scan(args: argparse.Namespace) -> None:
+    """
+    Parse the new and changed files and drop the deleted ones, without any request
+    """
+    from .utils import list_files, load_files_parallel, load_files_safe
+
+    dataset = open_dataset(args, create=True)
+    path = _ask(args.music or dataset.root, "Where should I search for music files? ", "--music")
+    dataset.root = os.path.abspath(path)
+
+    changed, removed = dataset.diff(list_files(path))
+    for file in removed:
+        dataset.remove(file)
+
+    if args.executor is None:
+        musics = load_files_safe(changed)
+    else:
+        musics = load_files_parallel(changed, workers=args.workers, executor=args.executor)
+    parsed = 0
+    for music in musics:
+        dataset.update(music)
+        parsed += 1
+    dataset.close()
+
+    logging.info(f"Scanned {path}: parsed {parsed} new or changed files, removed {len(removed)} files")
+
+
+def resolve(args: argparse.Namespace) -> None:
+    """
+    Search the songs without features on Spotify and get their features
+    """
+    dataset = open_dataset(args)
+    songs, _ = apply_changes(args, dataset, [], [])
+    dataset.close()
+
+    logging.info(f"{len(songs)} songs have features")
+
+
+def cluster(args: argparse.Namespace) -> None:
+    """
+    Fit or update the clustering model, or run a batch of clustering specs
+    """
+    dataset = open_dataset(args)
+    songs = dataset.collection()
+    dataset.close()
+
+    if args.specs is not None:
+        args.out = _ask(args.out, "Out dir: ", "--out")
+        batch(args, songs)
+        return
+
+    clusters = load_clusters(args, songs)
+    logging.info(f"{len(clusters)} clusters: {', '.join(str(len(songs)) for songs in clusters)} songs")
+    if args.out is not None:
+        write_playlists(args, clusters)
+
+
+def batch(args: argparse.Namespace, songs) -> None:
+    """
+    Write many playlist families in one run, one per clustering spec, from a single feature matrix
+    """
+    from .clustering import DEFAULT_SPECS, cluster_batch, load_specs
+    from .dedup import dedupe
+    from .metrics import metrics
+
+    specs = DEFAULT_SPECS if args.specs == "default" else load_specs(args.specs)
+    logging.info(f"Clustering {len(specs)} specs")
+    results = cluster_batch(dedupe(songs, prefer=args.prefer), specs)
+
+    extension = os.path.splitext(args.name or FILENAME)[1]
+    with metrics.stage("playlists"):
+        written = [file for name, clusters in results.items()
+                   for file in write_playlists(args, clusters, f"{name}{extension}")]
+    logging.info(f"Wrote {len(written)} playlists for {len(results)} specs")
+
+
+def export(args: argparse.Namespace) -> None:
+    """
+    Write the playlists of the saved clustering model, the songs added since it was fitted are assigned to it
+    """
+    args.out = _ask(args.out, "Out dir: ", "--out")
+    dataset = open_dataset(args)
+    songs = dataset.collection()
+    dataset.close()
+
+    written = write_playlists(args, load_clusters(args, songs, fit=False))
+    logging.info(f"Wrote {len(written)} playlists in {args.out}")
+
+
+def status(args: argparse.Namespace) -> int:
+    """
+    Print the state of the dataset and of the clustering model
+    """
+    if not os.path.isdir(args.dataset):
+        print(f"No dataset in {args.dataset}, run scan first")
+        return 1
+
+    dataset = open_dataset(args)
+    stats = dataset.stats()
+    root = dataset.root
+    modified = dataset.modified
+    if args.changes and root is not None:
+        from .utils import list_files
+
+        changed, removed = dataset.diff(list_files(root))
+    dataset.close()
+
+    print(f"Dataset:  {os.path.abspath(args.dataset)}")
+    print(f"Music:    {root}")
+    print(f"Songs:    {stats['songs']} ({stats['features']} with features, {stats['local']} computed locally, "
+          f"{stats['unresolved']} without features)")
+    print(f"Saved:    {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(modified)) if modified else 'never'}")
+    if args.changes and root is not None:
+        print(f"Changes:  {len(changed)} new or changed files, {len(removed)} removed files")
+
+    if os.path.isfile(args.model):
+        from .clustering import ClusterModel
+
+        model = ClusterModel.load(args.model)
+        print(f"Model:    {model.cluster_n} clusters on {', '.join(model.mode or ['every feature'])}, "
+              f"{len(model.labels)} songs, {model.assigned} assigned since the last fit"
+              f"{' (refit due)' if model.needs_refit() else ''}")
+    else:
+        print("Model:    none, run cluster first")
+
+    return 0
+
+
+def similar(args: argparse.Namespace) -> None:
+    """
+    Create a playlist with the songs most similar to a seed
+    """
+    from .dedup import dedupe
+    from .similarity import SimilarityIndex
+
+    args.out = _ask(args.out, "Out dir: ", "--out")
+    dataset = open_dataset(args)
+    if os.path.isfile(args.index) and os.path.getmtime(args.index) >= dataset.modified:
+        logging.info("Loading similarity index")
+        index = SimilarityIndex.load(args.index)
+    else:
+        logging.info("Building similarity index")
+        # A single copy of every recording, the others would be the nearest songs of each other
+        index = SimilarityIndex(dedupe(dataset.collection(), prefer=args.prefer))
+        index.save(args.index)
+
+    # The index holds absolute paths
+    seed = os.path.abspath(args.seed) if os.path.isfile(args.seed) else args.seed
+    if seed not in index and seed in dataset:
+        # A copy dropped as a duplicate, queried with its own features
+        collection = dataset.collection()
+        seed = collection[collection.column("path").index(seed)]
+    dataset.close()
+
+    songs = index.query(seed, args.n, include_seed=True)
+    # The seed stays first, the playlist is not reordered
+    args.order = None
+    write_playlists(args, [songs], args.name or SIMILAR_FILENAME)
+
+
+def run(args: argparse.Namespace) -> None:
+    """
+    Update the dataset, cluster it and write the playlists
+    """
+    from .metrics import metrics
+
+    args.out = _ask(args.out, "Out dir: ", "--out")
+    with metrics.stage("dataset"):
+        songs = update(args)
+
+    logging.info("Clustering")
+    clusters = load_clusters(args, songs)
+
+    logging.info("Creating playlist")
+    with metrics.stage("playlists"):
+        write_playlists(args, clusters)
+
+    metrics.write(args.report)
+    logging.info("Complete")
+
+
+def watch(args: argparse.Namespace) -> None:
+    """
+    Keep the dataset and the playlists up to date until interrupted: the changes below the music directory
+    are grouped in bursts, and each burst only goes through parsing, ID resolution and feature fetching
+    for the files it touched. Only the playlists whose songs changed are rewritten
+    """
+    from .watch import open_watcher
+
+    args.out = _ask(args.out, "Out dir: ", "--out")
+    # Catch up with what changed while not watching
+    songs = update(args)
+    dataset = open_dataset(args)
+
+    write_playlists(args, load_clusters(args, songs))
+
+    spotipy = open_api(args)
+
+    logging.info(f"Watching {dataset.root}")
+    with open_watcher(dataset.root, args.poll) as watcher:
+        try:
+            for paths in watcher.batches(args.debounce):
+                changed, removed = dataset.diff_paths(paths)
+                if not changed and not removed:
+                    continue
+                logging.info(f"{len(changed)} new or changed files, {len(removed)} removed files")
+
+                songs, updated = apply_changes(args, dataset, changed, removed, spotipy=spotipy, retry=False)
+                if updated:
+                    written = write_playlists(args, load_clusters(args, songs))
+                    logging.info(f"Rewrote {len(written)} playlists")
+        except KeyboardInterrupt:
+            logging.info("Stopped watching")
+        finally:
+            dataset.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    """
+    Create the parser of the command line
+    Returns:
+        The ArgumentParser
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--dataset", default="dataset", help="the dataset directory (default: %(default)s)")
+    common.add_argument("--model", default="model.pickle", help="the clustering model (default: %(default)s)")
+    common.add_argument("-v", "--verbose", action="store_true", help="log debug messages")
+    common.add_argument("-q", "--quiet", action="store_true", help="log only warnings and errors")
+
+    music = argparse.ArgumentParser(add_help=False)
+    music.add_argument("--music", help="the music directory (default: the one saved in the dataset)")
+    music.add_argument("--workers", type=int, help="the number of workers parsing the files")
+    music.add_argument("--executor", choices=["thread", "process"], help="parse the files in parallel")
+
+    requests = argparse.ArgumentParser(add_help=False)
+    requests.add_argument("--cache", default="cache.sqlite", help="the lookup cache (default: %(default)s)")
+    requests.add_argument("--keyfile", default=".key", help="the Spotify client id and secret (default: %(default)s)")
+    requests.add_argument("--api-workers", type=int, default=8, help="concurrent requests (default: %(default)s)")
+    requests.add_argument("--rate", type=float, default=20, help="requests per second (default: %(default)s)")
+    requests.add_argument("--api-url", help="the Web API server, e.g. a proxy (default: Spotify)")
+    requests.add_argument("--accounts-url", help="the token server (default: Spotify)")
+    requests.add_argument("--no-local", action="store_true",
+                          help="do not compute the features of the songs Spotify cannot give from their audio")
+
+    clustering = argparse.ArgumentParser(add_help=False)
+    clustering.add_argument("--mode", nargs="+", help=f"the features clustered (default: the model ones, or {MODE})")
+    clustering.add_argument("--clusters", type=_cluster_n,
+                            help="the number of playlists, or auto (default: the model one, or 4)")
+    clustering.add_argument("--standardize", action="store_true", help="give every feature the same weight")
+    clustering.add_argument("--prefer", default=PREFER, choices=["bitrate", "lossless", "first"],
+                            help="the copy of a duplicate song kept (default: %(default)s)")
+    clustering.add_argument("--refit", action="store_true", help="fit the model from scratch")
+
+    playlists = argparse.ArgumentParser(add_help=False)
+    playlists.add_argument("--out", help="the playlist directory")
+    playlists.add_argument("--name", help=f"the playlist base name, its extension sets the format: .m3u, .m3u8, "
+                                          f".pls or .xspf (default: {FILENAME}, {SIMILAR_FILENAME} for similar)")
+    playlists.add_argument("--relative", action="store_true", help="write paths relative to the playlists")
+    playlists.add_argument("--plain", action="store_true", help="write plain m3u instead of extended m3u")
+    playlists.add_argument("--order", nargs="*", default=SEQUENCE,
+                           help="the features the songs are ordered on, none for the disk order "
+                                "(default: %(default)s)")
+
+    parser = argparse.ArgumentParser(prog="pylister", description="Create playlists from a music library")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    command = commands.add_parser("scan", parents=[common, music], help="parse the new and changed music files")
+    command.set_defaults(function=scan)
+
+    command = commands.add_parser("resolve", parents=[common, music, requests],
+                                  help="get the features of the songs without features")
+    command.set_defaults(function=resolve)
+
+    command = commands.add_parser("cluster", parents=[common, clustering, playlists],
+                                  help="fit or update the clustering model")
+    command.add_argument("--specs", help="run a batch of clustering specs from a json file, or default, writing "
+                                         "<name>.<i>.m3u for every spec")
+    command.set_defaults(function=cluster)
+
+    command = commands.add_parser("export", parents=[common, clustering, playlists],
+                                  help="write the playlists of the clustering model")
+    command.set_defaults(function=export)
+
+    command = commands.add_parser("status", parents=[common], help="show the state of the dataset and the model")
+    command.add_argument("--changes", action="store_true", help="also count the files changed since the last scan")
+    command.set_defaults(function=status)
+
+    command = commands.add_parser("run", parents=[common, music, requests, clustering, playlists],
+                                  help="update the dataset, cluster it and write the playlists")
+    command.add_argument("--report", default="report.json", help="the metrics report (default: %(default)s)")
+    command.set_defaults(function=run)
+
+    command = commands.add_parser("watch", parents=[common, music, requests, clustering, playlists],
+                                  help="keep the dataset and the playlists up to date")
+    command.add_argument("--debounce", type=float, default=2.0, help="seconds without changes ending a burst")
+    command.add_argument("--poll", type=float, help="poll the music directory every this many seconds")
+    command.set_defaults(function=watch)
+
+    command = commands.add_parser("similar", parents=[common, playlists],
+                                  help="write a playlist of the songs most similar to a song")
+    command.add_argument("--prefer", default=PREFER, choices=["bitrate", "lossless", "first"],
+                         help="the copy of a duplicate song kept in the index (default: %(default)s)")
+    command.add_argument("seed", help="the path or the spotify id of a song of the library")
+    command.add_argument("-n", type=int, default=20, help="how many songs follow the seed (default: %(default)s)")
+    command.add_argument("--index", default="index.pickle", help="the similarity index (default: %(default)s)")
+    command.set_defaults(function=similar)
+
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Run a command, the run command when none is given
+    Args:
+        argv: the arguments, sys.argv[1:] by default
+
+    Returns:
+        The exit status
+    """
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv or ["run"])
+
+    level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=level)
+
+    return args.function(args) or 0
@@ -1,59 +1,611 @@
+import json
+import logging
+import os
+import pickle
 import numpy as np
-from typing import List
-from sklearn.cluster import KMeans
+from typing import Dict, Iterable, List, Tuple, Union
 
+from .collection import SongCollection
+from .metrics import metrics
 from .song import Song
 
+# scikit-learn and joblib are imported by the functions fitting models, so loading a saved ClusterModel and
+# assigning songs to it stays cheap
+ENGINES = ["kmeans", "minibatch"]
+MINIBATCH_THRESHOLD = 100000  # "auto" switches to MiniBatchKMeans from this many songs
 
-def cluster(raw_dataset: List[Song], cluster_n: int = 4, mode: list = None) -> list:
+
+def cluster(raw_dataset: Union[List[Song], SongCollection], cluster_n: Union[int, str] = 4, mode: list = None,
+            engine: str = "auto", batch_size: int = 4096, k_range: Iterable[int] = range(2, 13),
+            n_jobs: int = -1) -> list:
     """
     Given a list of songs, cluster them using KMeans algorithm
     Args:
-        raw_dataset: a list of Song objects
-        cluster_n: how many clusters create
+        raw_dataset: a list of Song objects or a SongCollection
+        cluster_n: how many clusters create, "auto" to choose it with select_k
         mode: the feature(s) to use for clustering
+        engine: "kmeans" for full-batch KMeans, "minibatch" for MiniBatchKMeans fitted chunk by chunk,
+            "auto" to choose by dataset size
+        batch_size: the chunk size used by the "minibatch" engine
+        k_range: the numbers of clusters tried when cluster_n is "auto"
+        n_jobs: how many cores are used when cluster_n is "auto", -1 for all
 
     Returns:
-        a clustered list
+        a clustered list, of the given Song objects when raw_dataset is a list
     """
-    raw_dataset, dataset = prepare_data(raw_dataset, mode)
-    kmeans = KMeans(n_clusters=cluster_n, random_state=0, n_init=20, tol=1e-06)
-    kmeans.fit(dataset)
+    if not isinstance(raw_dataset, SongCollection):
+        # The collection only holds copies of the songs, the given objects keep their analysis
+        raw_dataset = [music for music in raw_dataset if music["features"] is not None]
+    with metrics.stage("prepare_data"):
+        _, dataset = prepare_data(raw_dataset, mode)
+    metrics.gauge("dataset_songs", dataset.shape[0])
+    metrics.gauge("dataset_features", dataset.shape[1])
+
+    engine = _engine(engine, len(dataset))
+    logging.debug(f"Clustering {len(dataset)} songs with {engine}")
+
+    with metrics.stage("cluster"):
+        if cluster_n == "auto":
+            # The best fit is reused as is, no refit
+            cluster_n, labels = select_k(dataset, k_range, engine=engine, batch_size=batch_size, n_jobs=n_jobs)
+        else:
+            labels = _fit(dataset, cluster_n, engine, batch_size)
+    metrics.gauge("clusters", cluster_n)
 
     # Create return list
     out = []
     for _ in range(cluster_n):
         out.append([])
 
-    labels = kmeans.labels_
-    for i, music in enumerate(raw_dataset):
-        j = labels[i]
+    for music, j in zip(raw_dataset, labels.tolist()):
         out[j].append(music)
 
     return out
 
 
-def prepare_data(songs: List[Song], mode: list) -> np.array:
+class ClusterModel:
     """
-    Transform features of songs into a numpy array
+    Fitted clustering persisted with the dataset: the centroids, the features used, their scaling and the cluster
+    of every song. New songs are assigned to the nearest centroid without refitting, and refits start from the
+    previous centroids, so they converge faster and the cluster i of a refit is the cluster i of the previous fit
     Args:
-        songs: a list of Song objects
-        mode: the feature(s) to use for creating the dataset
+        centroids: the (clusters, features) array, in the scaled space
+        mode: the feature(s) used for clustering
+        mean: subtracted from the features before clustering, zeros by default
+        scale: the features are divided by it before clustering, ones by default
+    """
+
+    def __init__(self, centroids: np.ndarray, mode: list = None, mean: np.ndarray = None, scale: np.ndarray = None):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.mode = mode
+        features = self.centroids.shape[1]
+        self.mean = np.zeros(features, dtype=np.float32) if mean is None else np.asarray(mean, dtype=np.float32)
+        self.scale = np.ones(features, dtype=np.float32) if scale is None else np.asarray(scale, dtype=np.float32)
+
+        self.labels: Dict[str, int] = {}  # path: cluster
+        self.assigned = 0  # songs assigned since the last fit
+
+    @property
+    def cluster_n(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def fit(cls, songs: Union[List[Song], SongCollection], cluster_n: Union[int, str] = 4, mode: list = None,
+            engine: str = "auto", batch_size: int = 4096, k_range: Iterable[int] = range(2, 13), n_jobs: int = -1,
+            standardize: bool = False) -> "ClusterModel":
+        """
+        Fit a model from scratch
+        Args:
+            songs: a list of Song objects or a SongCollection, songs without features are skipped
+            cluster_n: how many clusters create, "auto" to choose it with select_k
+            mode: the feature(s) to use for clustering
+            engine: "kmeans", "minibatch" or "auto", see cluster
+            batch_size: the chunk size used by the "minibatch" engine
+            k_range: the numbers of clusters tried when cluster_n is "auto"
+            n_jobs: how many cores are used when cluster_n is "auto", -1 for all
+            standardize: scale every feature to zero mean and unit variance, so tempo does not dominate
+
+        Returns:
+            A ClusterModel
+        """
+        with metrics.stage("prepare_data"):
+            collection, dataset = prepare_data(songs, mode)
+        if len(dataset) == 0:
+            raise ValueError("Cannot cluster an empty library")
+        metrics.gauge("dataset_songs", dataset.shape[0])
+        metrics.gauge("dataset_features", dataset.shape[1])
+
+        mean, scale = None, None
+        if standardize:
+            mean = dataset.mean(axis=0)
+            scale = dataset.std(axis=0)
+            scale[scale == 0] = 1
+            dataset = (dataset - mean) / scale
+
+        engine = _engine(engine, len(dataset))
+        with metrics.stage("cluster"):
+            if cluster_n == "auto":
+                cluster_n, labels = select_k(dataset, k_range, engine=engine, batch_size=batch_size, n_jobs=n_jobs)
+            else:
+                labels = _fit(dataset, cluster_n, engine, batch_size)
+        metrics.gauge("clusters", cluster_n)
+
+        model = cls(_centroids(dataset, labels, cluster_n), mode, mean, scale)
+        model.labels = dict(zip(collection.column("path"), labels.tolist()))
+        return model
+
+    def refit(self, songs: Union[List[Song], SongCollection], engine: str = "auto", batch_size: int = 4096) -> None:
+        """
+        Fit the model again on the whole library, starting from the current centroids.
+        The scaling is kept, so the centroids stay comparable
+        Args:
+            songs: a list of Song objects or a SongCollection, songs without features are skipped
+            engine: "kmeans", "minibatch" or "auto", see cluster
+            batch_size: the chunk size used by the "minibatch" engine
+
+        Returns:
+            None
+        """
+        with metrics.stage("prepare_data"):
+            collection, dataset = prepare_data(songs, self.mode)
+        dataset = self.transform(dataset)
+
+        engine = _engine(engine, len(dataset))
+        logging.info(f"Refitting {self.cluster_n} clusters on {len(dataset)} songs with {engine}")
+        with metrics.stage("cluster"):
+            labels = _fit(dataset, self.cluster_n, engine, batch_size, init=self.centroids)
+
+        self.centroids = _centroids(dataset, labels, self.cluster_n, self.centroids)
+        self.labels = dict(zip(collection.column("path"), labels.tolist()))
+        self.assigned = 0
+
+    def transform(self, dataset: np.ndarray) -> np.ndarray:
+        """
+        Apply the scaling of the model
+        Args:
+            dataset: the (songs, features) array
+
+        Returns:
+            The scaled array
+        """
+        return (dataset - self.mean) / self.scale
+
+    def predict(self, dataset: np.ndarray) -> np.ndarray:
+        """
+        Find the nearest centroid of every row
+        Args:
+            dataset: the (songs, features) array, not scaled
+
+        Returns:
+            The cluster label of every row
+        """
+        dataset = self.transform(dataset)
+        # |x - c|^2 without the |x|^2 term, which is the same for every centroid
+        distances = (self.centroids ** 2).sum(axis=1) - 2 * dataset @ self.centroids.T
+        return distances.argmin(axis=1)
+
+    def assign(self, songs: Union[List[Song], SongCollection]) -> np.ndarray:
+        """
+        Assign songs to the existing clusters, in time proportional to the number of songs given
+        Args:
+            songs: a list of Song objects or a SongCollection, songs without features are skipped
+
+        Returns:
+            The cluster label of every song with features
+        """
+        collection, dataset = prepare_data(songs, self.mode)
+        labels = self.predict(dataset) if len(dataset) else np.empty(0, dtype=np.int64)
+
+        self.labels.update(zip(collection.column("path"), labels.tolist()))
+        self.assigned += len(labels)
+        metrics.count("songs_assigned", len(labels))
+
+        return labels
+
+    def needs_refit(self, drift: float = 0.1) -> bool:
+        """
+        Check if enough songs have been assigned since the last fit to justify a refit
+        Args:
+            drift: the fraction of assigned songs triggering a refit
+
+        Returns:
+            True if the model should be refitted
+        """
+        return self.assigned > drift * max(len(self.labels) - self.assigned, 1)
+
+    def clusters(self, songs: Union[List[Song], SongCollection]) -> List[List[Song]]:
+        """
+        Group songs by cluster, the ones never seen are assigned first and the ones no more given are forgotten
+        Args:
+            songs: the Song objects of the library or a SongCollection, whose features are used in place and whose
+                Song objects are only built for the output
+
+        Returns:
+            a clustered list
+        """
+        if isinstance(songs, SongCollection):
+            paths = songs.column("path")
+        else:
+            songs = [music for music in songs if music["features"] is not None]
+            paths = [music["path"] for music in songs]
+
+        new = [i for i, path in enumerate(paths) if path not in self.labels]
+        if new:
+            self.assign(songs.subset(new) if isinstance(songs, SongCollection) else [songs[i] for i in new])
+
+        known = set(paths)
+        self.labels = {path: label for path, label in self.labels.items() if path in known}
+
+        indexes = [[] for _ in range(self.cluster_n)]
+        for i, path in enumerate(paths):
+            indexes[self.labels[path]].append(i)
+
+        if isinstance(songs, SongCollection):
+            return [songs.songs(cluster) for cluster in indexes]
+        return [[songs[i] for i in cluster] for cluster in indexes]
+
+    @classmethod
+    def load(cls, filename: str) -> "ClusterModel":
+        """
+        Load a model saved with save
+        Args:
+            filename: the model file
+
+        Returns:
+            A ClusterModel
+        """
+        with open(filename, "rb") as data:
+            return pickle.load(data)
+
+    def save(self, filename: str) -> None:
+        """
+        Save the model next to the dataset
+        Args:
+            filename: the model file
+
+        Returns:
+            None
+        """
+        tmp = f"{filename}.tmp"
+        with open(tmp, "wb") as data:
+            pickle.dump(self, data)
+        os.replace(tmp, filename)
+
+
+class ClusterSpec:
+    """
+    One clustering of a batch: the playlists of a spec are written as <name>.<i>.m3u
+    Args:
+        name: the name of the playlist family, e.g. "mood-4"
+        mode: the features used, a group of SongCollection.GROUPS, a key or a list of keys, None for all
+        cluster_n: how many clusters create, "auto" to choose it with select_k
+        engine: "kmeans", "minibatch" or "auto", see cluster
+        standardize: scale every feature to zero mean and unit variance, so tempo does not dominate
+    """
+
+    def __init__(self, name: str, mode: Union[str, List[str]] = None, cluster_n: Union[int, str] = 4,
+                 engine: str = "auto", standardize: bool = False):
+        self.name = name
+        self.mode = mode
+        self.cluster_n = cluster_n
+        self.engine = engine
+        self.standardize = standardize
+
+    @property
+    def columns(self) -> List[int]:
+        """
+        Get the columns of the feature matrix used by the spec
+        Returns:
+            The column indexes, in SongCollection.COLUMNS order
+
+        Raises:
+            KeyError: a key is not a feature
+        """
+        mode = self.mode
+        if mode is None:
+            return list(range(len(SongCollection.COLUMNS)))
+        if isinstance(mode, str):
+            if mode in SongCollection.GROUPS:
+                return list(range(len(SongCollection.COLUMNS)))[SongCollection.GROUPS[mode]]
+            mode = [mode]
+
+        for key in mode:
+            if key not in SongCollection.COLUMNS:
+                raise KeyError(f"{key} not found in spec {self.name}")
+        return [SongCollection.COLUMNS.index(key) for key in mode]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ClusterSpec":
+        """
+        Create a spec from its json object, e.g. {"name": "mood", "mode": "mood", "clusters": 6}
+        Args:
+            data: the json object, "clusters" is the number of clusters
+
+        Returns:
+            A ClusterSpec
+        """
+        return cls(data["name"], data.get("mode"), data.get("clusters", 4), data.get("engine", "auto"),
+                   data.get("standardize", False))
+
+
+# Every feature group at two granularities
+DEFAULT_SPECS = [ClusterSpec(f"{group}-{k}", group, k, standardize=True)
+                 for group in SongCollection.GROUPS for k in (4, 8)]
+
+
+def load_specs(filename: str) -> List[ClusterSpec]:
+    """
+    Read clustering specs from a json file holding a list of spec objects, see ClusterSpec.from_dict
+    Args:
+        filename: the json file
+
+    Returns:
+        A list of ClusterSpec
+
+    Raises:
+        ValueError: two specs have the same name
+    """
+    with open(filename, "r", encoding="utf-8") as file:
+        specs = [ClusterSpec.from_dict(data) for data in json.load(file)]
+
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Spec names must be unique in {filename}")
+
+    return specs
+
+
+def cluster_batch(songs: Union[List[Song], SongCollection], specs: List[ClusterSpec], batch_size: int = 4096,
+                  k_range: Iterable[int] = range(2, 13), n_jobs: int = -1) -> Dict[str, List[List[Song]]]:
+    """
+    Run many clusterings of the same songs. The feature matrix is built once, and the specs are fitted in parallel
+    by joblib, which dumps the matrix once to shared memory and maps it in every worker instead of sending each
+    one a copy; a worker only copies the columns of its spec
+    Args:
+        songs: a list of Song objects or a SongCollection, songs without features are skipped
+        specs: the clusterings to run
+        batch_size: the chunk size used by the "minibatch" engine
+        k_range: the numbers of clusters tried by the specs with cluster_n "auto"
+        n_jobs: how many cores are used, -1 for all
+
+    Returns:
+        A dict spec name: clustered list
+    """
+    with metrics.stage("prepare_data"):
+        collection, matrix = prepare_data(songs, None)
+    if len(matrix) == 0:
+        raise ValueError("Cannot cluster an empty library")
+    metrics.gauge("dataset_songs", matrix.shape[0])
+
+    from joblib import Parallel, delayed
+
+    k_range = list(k_range)
+    with metrics.stage("cluster_batch"):
+        results = Parallel(n_jobs=n_jobs, max_nbytes=0)(
+            delayed(_fit_spec)(matrix, spec.columns, spec.cluster_n, spec.engine, spec.standardize, batch_size,
+                               k_range)
+            for spec in specs)
+
+    # Every result shares the same Song objects, a collection is rebuilt only once
+    if isinstance(songs, SongCollection):
+        songs = collection.songs()
+    else:
+        songs = [music for music in songs if music["features"] is not None]
+
+    out = {}
+    for spec, (cluster_n, labels) in zip(specs, results):
+        clusters = [[] for _ in range(cluster_n)]
+        for music, label in zip(songs, labels.tolist()):
+            clusters[label].append(music)
+        out[spec.name] = clusters
+        logging.info(f"{spec.name}: {cluster_n} clusters")
+
+    return out
+
+
+def _fit_spec(matrix: np.ndarray, columns: List[int], cluster_n: Union[int, str], engine: str, standardize: bool,
+              batch_size: int, k_range: List[int]) -> Tuple[int, np.ndarray]:
+    """
+    Fit one spec of cluster_batch, in a worker
+    Args:
+        matrix: the (songs, features) array of every feature, mapped from shared memory
+        columns: the columns of the spec
+        cluster_n: how many clusters create, "auto" to choose it with select_k
+        engine: "kmeans", "minibatch" or "auto"
+        standardize: scale every feature to zero mean and unit variance
+        batch_size: the chunk size used by the "minibatch" engine
+        k_range: the numbers of clusters tried when cluster_n is "auto"
+
+    Returns:
+        The number of clusters and the cluster label of every song
+    """
+    dataset = np.ascontiguousarray(matrix[:, columns])
+    if standardize:
+        scale = dataset.std(axis=0)
+        scale[scale == 0] = 1
+        dataset = (dataset - dataset.mean(axis=0)) / scale
+
+    engine = _engine(engine, len(dataset))
+    if cluster_n == "auto":
+        # Already in a worker, the candidates are fitted one after the other
+        return select_k(dataset, k_range, engine=engine, batch_size=batch_size, n_jobs=1)
+
+    return cluster_n, _fit(dataset, cluster_n, engine, batch_size)
+
+
+def select_k(dataset: np.ndarray, k_range: Iterable[int] = range(2, 13), engine: str = "kmeans",
+             batch_size: int = 4096, sample_size: int = 10000, n_jobs: int = -1) -> Tuple[int, np.ndarray]:
+    """
+    Choose the number of clusters with the highest silhouette score.
+    Candidates are fitted in parallel on the same matrix, joblib memory-maps it instead of copying it to every worker,
+    and the silhouette is computed on a sample to keep it cheap
+    Args:
+        dataset: the (songs, features) array
+        k_range: the numbers of clusters to try
+        engine: "kmeans" or "minibatch"
+        batch_size: the chunk size used by the "minibatch" engine
+        sample_size: how many songs are used to compute the silhouette
+        n_jobs: how many cores are used, -1 for all
 
     Returns:
-        A numpy array
+        The best number of clusters and the labels of its fit
     """
-    raw_dataset = []
-    fixed_songs = []
-    for song in songs:
-        if song["features"] is None:
-            continue
+    k_range = [k for k in k_range if 2 <= k < len(dataset)]
+    if not k_range:
+        raise ValueError(f"Cannot choose the number of clusters of {len(dataset)} songs")
+
+    from joblib import Parallel, delayed
+
+    results = Parallel(n_jobs=n_jobs)(delayed(_score)(dataset, k, engine, batch_size, sample_size) for k in k_range)
+
+    for k, (score, _) in zip(k_range, results):
+        logging.debug(f"k = {k}: silhouette = {score:.4f}")
+
+    best = int(np.argmax([score for score, _ in results]))
+    logging.info(f"Chosen {k_range[best]} clusters (silhouette = {results[best][0]:.4f})")
+
+    return k_range[best], results[best][1]
+
+
+def _score(dataset: np.ndarray, cluster_n: int, engine: str, batch_size: int,
+           sample_size: int) -> Tuple[float, np.ndarray]:
+    """
+    Fit a candidate number of clusters and score it
+    Args:
+        dataset: the (songs, features) array
+        cluster_n: how many clusters create
+        engine: "kmeans" or "minibatch"
+        batch_size: the chunk size used by the "minibatch" engine
+        sample_size: how many songs are used to compute the silhouette
+
+    Returns:
+        The silhouette score and the labels
+    """
+    from sklearn.metrics import silhouette_score
+
+    labels = _fit(dataset, cluster_n, engine, batch_size)
+    if len(np.unique(labels)) < 2:
+        return -1.0, labels
+
+    score = silhouette_score(dataset, labels, sample_size=min(sample_size, len(dataset)), random_state=0)
+    return float(score), labels
+
+
+def _engine(engine: str, size: int) -> str:
+    """
+    Resolve the "auto" engine and check the others
+    Args:
+        engine: "kmeans", "minibatch" or "auto"
+        size: the number of songs
+
+    Returns:
+        "kmeans" or "minibatch"
+    """
+    if engine == "auto":
+        engine = "minibatch" if size >= MINIBATCH_THRESHOLD else "kmeans"
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES + ['auto']}")
+
+    return engine
+
+
+def _fit(dataset: np.ndarray, cluster_n: int, engine: str, batch_size: int, init: np.ndarray = None) -> np.ndarray:
+    """
+    Fit the given engine
+    Args:
+        dataset: the (songs, features) array
+        cluster_n: how many clusters create
+        engine: "kmeans" or "minibatch"
+        batch_size: the chunk size used by the "minibatch" engine
+        init: the (clusters, features) array of starting centroids, None for a fit from scratch
+
+    Returns:
+        The cluster label of every song
+    """
+    if engine == "kmeans":
+        from sklearn.cluster import KMeans
+
+        if init is None:
+            kmeans = KMeans(n_clusters=cluster_n, random_state=0, n_init=20, tol=1e-06)
         else:
-            if mode is None:
-                raw_dataset.append(list(song["features"].items()))
-            else:
-                raw_dataset.append(list(song["features"].group(mode)))
+            # A single run from the previous centroids instead of 20 random restarts
+            kmeans = KMeans(n_clusters=cluster_n, init=init, n_init=1, tol=1e-06)
+        kmeans.fit(dataset)
+        return kmeans.labels_
+
+    return _fit_minibatch(dataset, cluster_n, batch_size, init=init)
+
+
+def _fit_minibatch(dataset: np.ndarray, cluster_n: int, batch_size: int, epochs: int = 3,
+                   init: np.ndarray = None) -> np.ndarray:
+    """
+    Fit a MiniBatchKMeans streaming the dataset in chunks, so only one chunk at a time is worked on
+    Args:
+        dataset: the (songs, features) array
+        cluster_n: how many clusters create
+        batch_size: the number of songs in each chunk
+        epochs: how many passes over the dataset
+        init: the (clusters, features) array of starting centroids, None for a fit from scratch
+
+    Returns:
+        The cluster label of every song
+    """
+    from sklearn.cluster import MiniBatchKMeans
+
+    rng = np.random.RandomState(0)
+    if init is None:
+        kmeans = MiniBatchKMeans(n_clusters=cluster_n, random_state=0, batch_size=batch_size)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=cluster_n, init=init, n_init=1, random_state=0, batch_size=batch_size)
+
+    # Songs are stored in disk order, so the centroids are initialized on a random sample
+    init_size = min(len(dataset), max(3 * cluster_n, 3 * batch_size))
+    kmeans.partial_fit(dataset[np.sort(rng.choice(len(dataset), init_size, replace=False))])
 
-            fixed_songs.append(song)
+    starts = np.arange(0, len(dataset), batch_size)
+    for _ in range(epochs):
+        for start in rng.permutation(starts):
+            # Contiguous chunks are views of the dataset, no copy is made
+            kmeans.partial_fit(dataset[start:start + batch_size])
+
+    labels = np.empty(len(dataset), dtype=np.int32)
+    for start in starts:
+        labels[start:start + batch_size] = kmeans.predict(dataset[start:start + batch_size])
+
+    return labels
+
+
+def _centroids(dataset: np.ndarray, labels: np.ndarray, cluster_n: int, fallback: np.ndarray = None) -> np.ndarray:
+    """
+    Compute the mean of every cluster
+    Args:
+        dataset: the (songs, features) array
+        labels: the cluster label of every song
+        cluster_n: how many clusters
+        fallback: the centroids kept for empty clusters, the mean of the dataset by default
+
+    Returns:
+        The (clusters, features) array
+    """
+    sums = np.stack([np.bincount(labels, weights=column, minlength=cluster_n) for column in dataset.T], axis=1)
+    counts = np.bincount(labels, minlength=cluster_n)
+
+    centroids = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None],
+                         dataset.mean(axis=0) if fallback is None else fallback)
+    return centroids.astype(np.float32)
+
+
+def prepare_data(songs: Union[List[Song], SongCollection], mode: list) -> Tuple[SongCollection, np.ndarray]:
+    """
+    Transform features of songs into a numpy array
+    Args:
+        songs: a list of Song objects or a SongCollection, songs without features are skipped
+        mode: the feature(s) to use for creating the dataset
+
+    Returns:
+        The SongCollection and a float32 numpy array, a view of the collection whenever possible
+    """
+    if not isinstance(songs, SongCollection):
+        songs = SongCollection.from_songs(songs)
 
-    return fixed_songs, np.array([np.array(dataset) for dataset in raw_dataset])
+    return songs, songs.features(mode)
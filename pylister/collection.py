@@ -0,0 +1,197 @@
+import logging
+from typing import Dict, Iterable, Iterator, List, Union
+
+import numpy as np
+
+from .features import Feature
+from .song import Song
+
+
+class SongCollection:
+    """
+    Column-wise storage of many songs: the features live in a single preallocated float32 matrix,
+    the metadata in parallel lists. Columns are ordered so that every feature group is contiguous,
+    which lets the groups be returned as views of the matrix
+    Args:
+        capacity: how many songs can be stored before the matrix has to grow
+    """
+    COLUMNS = Feature._mood + Feature._properties + Feature._context
+    GROUPS = {
+        "mood": slice(0, len(Feature._mood)),
+        "properties": slice(len(Feature._mood), len(Feature._mood) + len(Feature._properties)),
+        "context": slice(len(Feature._mood) + len(Feature._properties), len(COLUMNS))
+    }
+    METADATA = ["title", "artist", "album", "year", "isrc", "path", "spotify_id", "albumartist", "track"]
+
+    def __init__(self, capacity: int = 1024):
+        self._features = np.empty((max(capacity, 1), len(self.COLUMNS)), dtype=np.float32)
+        self._size = 0
+        self._metadata = {key: [] for key in self.METADATA}
+
+    @classmethod
+    def from_songs(cls, songs: Iterable[Song]) -> "SongCollection":
+        """
+        Create a collection from Song objects, songs without features are skipped
+        Args:
+            songs: the Song objects
+
+        Returns:
+            A SongCollection
+        """
+        songs = [song for song in songs if song["features"] is not None]
+        collection = cls(capacity=len(songs))
+        for song in songs:
+            collection.append(song)
+
+        return collection
+
+    @classmethod
+    def from_arrays(cls, features: np.ndarray, metadata: Dict[str, list]) -> "SongCollection":
+        """
+        Wrap existing columns without copying them, e.g. a memory-mapped feature matrix
+        Args:
+            features: the (songs, features) float32 array, the columns ordered as COLUMNS
+            metadata: a list of values for every key of METADATA, one per song
+
+        Returns:
+            A SongCollection
+        """
+        if features.shape[1] != len(cls.COLUMNS):
+            raise ValueError(f"Expected {len(cls.COLUMNS)} feature columns, got {features.shape[1]}")
+
+        collection = cls(capacity=1)
+        collection._features = features
+        collection._size = len(features)
+        collection._metadata = {key: list(metadata[key]) for key in cls.METADATA}
+
+        return collection
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, index: int) -> Song:
+        """
+        Rebuild the Song object stored at the given index
+        Args:
+            index: the position of the song
+
+        Returns:
+            A Song object
+        """
+        if not -self._size <= index < self._size:
+            raise IndexError(f"{index} out of range")
+        index %= self._size
+
+        metadata = {key: values[index] for key, values in self._metadata.items()}
+        features = Feature(**dict(zip(self.COLUMNS, self._features[index].tolist())))
+
+        return Song(features=features, **metadata)
+
+    def __iter__(self) -> Iterator[Song]:
+        for i in range(self._size):
+            yield self[i]
+
+    def append(self, song: Song) -> None:
+        """
+        Add a song to the collection, growing the matrix if it is full
+        Args:
+            song: a Song object with features
+
+        Returns:
+            None
+        """
+        if song["features"] is None:
+            raise ValueError(f"{song['path']} has no features")
+
+        if self._size == len(self._features):
+            # Double the capacity, so appending n songs costs O(n) copies overall
+            grown = np.empty((2 * len(self._features), len(self.COLUMNS)), dtype=np.float32)
+            grown[:self._size] = self._features[:self._size]
+            self._features = grown
+
+        feature = song["features"]
+        self._features[self._size] = [feature[key] for key in self.COLUMNS]
+        for key, values in self._metadata.items():
+            values.append(song[key])
+        self._size += 1
+
+    def column(self, key: str) -> list:
+        """
+        Get a metadata column
+        Args:
+            key: the metadata key, e.g. "path"
+
+        Returns:
+            The list of values, one per song
+        """
+        return self._metadata[key]
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """
+        Get all the features, the columns are ordered as COLUMNS
+        Returns:
+            A view of the feature matrix
+        """
+        return self._features[:self._size]
+
+    def features(self, mode: Union[str, List[str]] = None) -> np.ndarray:
+        """
+        Get the features of all the songs for the given group or list of keys.
+        Groups and lists of keys evenly spaced in COLUMNS are returned as views, other lists need a copy
+        Args:
+            mode: None for every feature, "mood", "properties", "context" or a list of keys
+
+        Returns:
+            A (songs, features) float32 array
+        """
+        if mode is None:
+            return self.matrix
+        if isinstance(mode, str):
+            if mode in self.GROUPS:
+                return self.matrix[:, self.GROUPS[mode]]
+            mode = [mode]
+
+        for key in mode:
+            if key not in self.COLUMNS:
+                logging.warning(f"{key} not found")
+                raise KeyError(f"{key} not found")
+
+        indexes = [self.COLUMNS.index(key) for key in mode]
+        step = indexes[1] - indexes[0] if len(indexes) > 1 else 1
+        if step > 0 and indexes == list(range(indexes[0], indexes[-1] + 1, step)):
+            return self.matrix[:, indexes[0]:indexes[-1] + 1:step]
+
+        logging.debug(f"{mode} cannot be sliced, copying the columns")
+        return self.matrix[:, indexes]
+
+    def subset(self, indexes: Iterable[int]) -> "SongCollection":
+        """
+        Get a collection of some of the songs, their features are copied
+        Args:
+            indexes: the positions of the songs
+
+        Returns:
+            A SongCollection
+        """
+        indexes = list(indexes)
+        metadata = {key: [values[i] for i in indexes] for key, values in self._metadata.items()}
+
+        return SongCollection.from_arrays(np.asarray(self.matrix)[indexes], metadata)
+
+    def songs(self, indexes: Iterable[int] = None) -> List[Song]:
+        """
+        Rebuild the Song objects
+        Args:
+            indexes: the positions of the songs, None for all
+
+        Returns:
+            A list of Song objects
+        """
+        indexes = range(self._size) if indexes is None else list(indexes)
+        # The rows are converted in one call, reading a memory-mapped matrix value by value is slow
+        rows = np.asarray(self._features)[indexes].tolist()
+        metadata = list(self._metadata.items())
+
+        return [Song(features=Feature(**dict(zip(self.COLUMNS, row))), **{key: values[i] for key, values in metadata})
+                for i, row in zip(indexes, rows)]
@@ -0,0 +1,419 @@
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from .collection import SongCollection
+from .features import Feature
+from .manifest import Manifest, diff_files, diff_paths
+from .song import Song
+
+# Metadata columns of the songs table, after path
+_METADATA = [key for key in SongCollection.METADATA if key != "path"]
+
+
+class DatasetStore:
+    """
+    Versioned on-disk dataset replacing data.pickle and manifest.pickle.
+    The features live in a memory-mapped float32 .npy matrix, one dense row per song with features, so opening the
+    store reads nothing and the clustering works on the mapped rows directly. The metadata, the mtime and size of
+    every file and the row of its features are kept in an indexed SQLite table.
+    Updates write single rows in place; they are durable once save is called
+    Args:
+        directory: where the store files are kept, created if needed
+        root: the music directory the dataset refers to, the saved one is kept if None
+    """
+    VERSION = 2
+    COLUMNS = SongCollection.COLUMNS
+
+    def __init__(self, directory: str, root: str = None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(os.path.join(directory, "meta.sqlite"))
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._db.execute(f"CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY KEY, {', '.join(_METADATA)}, "
+                             f"mtime REAL, size INTEGER, row INTEGER UNIQUE)")
+
+        version = self._meta("version")
+        if version is None:
+            with self._db:
+                self._set_meta("version", self.VERSION)
+                self._set_meta("columns", json.dumps(self.COLUMNS))
+        elif int(version) > self.VERSION:
+            raise ValueError(f"{directory} has dataset version {version}, this pylister reads up to {self.VERSION}")
+        elif int(version) < self.VERSION:
+            self._upgrade(int(version))
+
+        if root is not None:
+            self.root = root
+
+        self._rows = self._db.execute("SELECT COUNT(row) FROM songs").fetchone()[0]
+        self._features = self._open_features()
+        self._dirty = False  # songs changed since the last save
+
+    def _upgrade(self, version: int) -> None:
+        """
+        Migrate the SQLite schema written by an older version
+        Args:
+            version: the version of the store
+
+        Returns:
+            None
+        """
+        logging.info(f"Upgrading {self.directory} from version {version} to {self.VERSION}")
+        with self._db:
+            if version < 2:
+                # Album and track number, used by the album resolver
+                self._db.execute("ALTER TABLE songs ADD COLUMN albumartist")
+                self._db.execute("ALTER TABLE songs ADD COLUMN track")
+            self._set_meta("version", self.VERSION)
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_meta(self, key: str, value) -> None:
+        self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, None if value is None else str(value)))
+
+    @property
+    def root(self) -> Optional[str]:
+        return self._meta("root")
+
+    @root.setter
+    def root(self, root: str) -> None:
+        self._set_meta("root", root)
+
+    @property
+    def modified(self) -> float:
+        """
+        When the songs of the dataset last changed, as a timestamp
+        """
+        return float(self._meta("modified") or 0)
+
+    @property
+    def _filename(self) -> str:
+        return os.path.join(self.directory, "features.npy")
+
+    def _open_features(self) -> np.ndarray:
+        """
+        Map the feature matrix, creating it or converting its columns if Feature changed since it was written
+        Returns:
+            The memory-mapped (capacity, features) array
+        """
+        if not os.path.isfile(self._filename):
+            return self._resize(max(1024, self._rows))
+
+        features = open_memmap(self._filename, mode="r+")
+        columns = json.loads(self._meta("columns"))
+        if columns != self.COLUMNS:
+            logging.info(f"Converting the feature columns of {self.directory} from {columns} to {self.COLUMNS}")
+            converted = np.full((len(features), len(self.COLUMNS)), np.nan, dtype=np.float32)
+            for i, key in enumerate(self.COLUMNS):
+                if key in columns:
+                    converted[:, i] = features[:, columns.index(key)]
+            del features
+
+            self._write_features(converted)
+            with self._db:
+                self._set_meta("columns", json.dumps(self.COLUMNS))
+            features = open_memmap(self._filename, mode="r+")
+
+        return features
+
+    def _write_features(self, features: np.ndarray) -> None:
+        """
+        Replace the feature file atomically
+        """
+        tmp = f"{self._filename}.tmp"
+        out = open_memmap(tmp, mode="w+", dtype=np.float32, shape=features.shape)
+        out[:] = features
+        out.flush()
+        del out
+        os.replace(tmp, self._filename)
+
+    def _resize(self, capacity: int) -> np.ndarray:
+        """
+        Grow the feature file, keeping the rows in use
+        Args:
+            capacity: the new number of rows
+
+        Returns:
+            The new memory-mapped array
+        """
+        features = np.full((capacity, len(self.COLUMNS)), np.nan, dtype=np.float32)
+        if getattr(self, "_features", None) is not None:
+            features[:self._rows] = self._features[:self._rows]
+            self._features.flush()
+            self._features = None
+
+        self._write_features(features)
+        return open_memmap(self._filename, mode="r+")
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+
+    def __contains__(self, path: str) -> bool:
+        return self._db.execute("SELECT 1 FROM songs WHERE path = ?", (os.path.abspath(path),)).fetchone() is not None
+
+    def _stats(self) -> Dict[str, Tuple[float, int]]:
+        """
+        Get the mtime and size of every file
+        Returns:
+            A dict path: (mtime, size)
+        """
+        return {path: (mtime, size) for path, mtime, size in self._db.execute("SELECT path, mtime, size FROM songs")}
+
+    def diff(self, files: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Compare the given files with the dataset
+        Args:
+            files: the files currently in the music directory
+
+        Returns:
+            The new or changed files and the files no more present
+        """
+        return diff_files(self._stats(), files)
+
+    def diff_paths(self, paths: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Compare only some files or directories with the dataset, e.g. the ones reported by a Watcher
+        Args:
+            paths: the paths that may have changed
+
+        Returns:
+            The new or changed files and the files no more present
+        """
+        return diff_paths(self._stats(), paths)
+
+    def update(self, song: Song, mtime: float = None, size: int = None) -> None:
+        """
+        Add or replace a song, its features row is written in place
+        Args:
+            song: the Song object, its path is used as the key
+            mtime: the modification time of the file, read from disk if None
+            size: the size of the file, read from disk if None
+
+        Returns:
+            None
+        """
+        path = os.path.abspath(song["path"])
+        if mtime is None or size is None:
+            stat = os.stat(path)
+            mtime, size = stat.st_mtime, stat.st_size
+
+        before = self._db.execute(f"SELECT {self._select}, mtime, size FROM songs WHERE path = ?", (path,)).fetchone()
+        row = None if before is None else before[-3]
+        changed = False
+        if song["features"] is None:
+            if row is not None:
+                self._free(row)
+                changed = True
+            row = None
+        else:
+            if row is None:
+                row = self._allocate()
+                changed = True
+            feature = song["features"]
+            values = np.array([feature[key] for key in self.COLUMNS], dtype=np.float32)
+            if changed or not np.array_equal(self._features[row], values):
+                self._features[row] = values
+                changed = True
+
+        record = (path, *[song[key] for key in _METADATA], row, mtime, size)
+        if changed or before != record:
+            self._db.execute(f"INSERT OR REPLACE INTO songs (path, {', '.join(_METADATA)}, row, mtime, size) "
+                             f"VALUES ({', '.join('?' * len(record))})", record)
+            # Songs written again unchanged, e.g. retried and still not found, leave the modified time alone
+            self._dirty = True
+
+    def remove(self, path: str) -> Optional[Song]:
+        """
+        Drop a song
+        Args:
+            path: the path of the file
+
+        Returns:
+            The removed Song object, if any
+        """
+        path = os.path.abspath(path)
+        song = self._song(self._db.execute(f"SELECT {self._select} FROM songs WHERE path = ?", (path,)).fetchone())
+        if song is None:
+            return None
+
+        row = self._row(path)
+        self._db.execute("DELETE FROM songs WHERE path = ?", (path,))
+        if row is not None:
+            self._free(row)
+        self._dirty = True
+
+        return song
+
+    def _row(self, path: str) -> Optional[int]:
+        row = self._db.execute("SELECT row FROM songs WHERE path = ?", (path,)).fetchone()
+        return None if row is None else row[0]
+
+    def _allocate(self) -> int:
+        """
+        Get the next free features row, growing the file if it is full
+        """
+        if self._rows == len(self._features):
+            # Double the capacity, so adding n songs costs O(n) copies overall
+            self._features = self._resize(2 * len(self._features))
+
+        self._rows += 1
+        return self._rows - 1
+
+    def _free(self, row: int) -> None:
+        """
+        Release a features row, the last row is moved in its place so the rows in use stay dense
+        """
+        last = self._rows - 1
+        if row != last:
+            self._db.execute("UPDATE songs SET row = NULL WHERE row = ?", (row,))
+            self._db.execute("UPDATE songs SET row = ? WHERE row = ?", (row, last))
+            self._features[row] = self._features[last]
+        else:
+            self._db.execute("UPDATE songs SET row = NULL WHERE row = ?", (row,))
+        self._features[last] = np.nan
+        self._rows -= 1
+
+    @property
+    def _select(self) -> str:
+        return f"path, {', '.join(_METADATA)}, row"
+
+    def _song(self, record: Optional[tuple]) -> Optional[Song]:
+        """
+        Rebuild a Song object from a songs record
+        """
+        if record is None:
+            return None
+
+        path, *metadata, row = record
+        features = None
+        if row is not None:
+            features = Feature(**{key: float(value) for key, value in zip(self.COLUMNS, self._features[row])})
+
+        return Song(path=path, features=features, **dict(zip(_METADATA, metadata)))
+
+    def songs(self) -> List[Song]:
+        """
+        Get the songs that have been resolved and have their features
+        Returns:
+            A list of Song objects
+        """
+        records = self._db.execute(f"SELECT {self._select} FROM songs WHERE row IS NOT NULL ORDER BY row")
+        return [self._song(record) for record in records]
+
+    def unresolved(self) -> List[Song]:
+        """
+        Get the songs still without features, e.g. because a request failed, and the songs not found on Spotify,
+        whose features if any were computed locally
+        Returns:
+            A list of Song objects
+        """
+        return [self._song(record) for record in
+                self._db.execute(f"SELECT {self._select} FROM songs WHERE row IS NULL OR spotify_id IS NULL")]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Count the songs by state, without reading the features
+        Returns:
+            A dict with the number of songs, of songs with features, of songs without features and of songs whose
+            features were computed locally because they are not on Spotify
+        """
+        songs, features, local = self._db.execute(
+            "SELECT COUNT(*), COUNT(row), COUNT(CASE WHEN spotify_id IS NULL THEN row END) FROM songs").fetchone()
+        return {"songs": songs, "features": features, "unresolved": songs - features, "local": local}
+
+    def collection(self) -> SongCollection:
+        """
+        Get the songs with features as a SongCollection whose matrix is the memory-mapped file, nothing is copied
+        Returns:
+            A SongCollection
+        """
+        keys = SongCollection.METADATA
+        records = self._db.execute(f"SELECT {', '.join(keys)} FROM songs WHERE row IS NOT NULL ORDER BY row").fetchall()
+        # Transposed in one call, the records are not walked value by value
+        columns = zip(*records) if records else [()] * len(keys)
+        metadata = {key: list(values) for key, values in zip(keys, columns)}
+
+        return SongCollection.from_arrays(self._features[:self._rows], metadata)
+
+    def items(self) -> Iterator[Tuple[str, float, int, Song]]:
+        """
+        Iterate over the songs
+        Returns:
+            An iterator of (path, mtime, size, Song object)
+        """
+        for record in self._db.execute(f"SELECT {self._select}, mtime, size FROM songs").fetchall():
+            yield record[0], record[-2], record[-1], self._song(record[:-2])
+
+    def save(self) -> None:
+        """
+        Make the changes durable: the features are flushed before the metadata pointing to them is committed.
+        The modified time only moves when songs changed, so opening the store to read it leaves it untouched
+        Returns:
+            None
+        """
+        self._features.flush()
+        with self._db:
+            if self._dirty:
+                self._set_meta("modified", time.time())
+                self._dirty = False
+
+    def close(self) -> None:
+        """
+        Save and close the store
+        Returns:
+            None
+        """
+        self.save()
+        self._db.close()
+        self._features = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @classmethod
+    def migrate(cls, directory: str, manifest: str = None, data: str = None) -> "DatasetStore":
+        """
+        Create a store from the pickles written by older versions: the manifest keeps the mtime and size of every
+        file, the data pickle only has the songs with features, whose files are stat again
+        Args:
+            directory: where the store is created
+            manifest: the manifest.pickle file, if any
+            data: the data.pickle file, used only without a manifest
+
+        Returns:
+            The DatasetStore
+        """
+        store = cls(directory)
+        if manifest is not None and os.path.isfile(manifest):
+            logging.info(f"Migrating {manifest} to {directory}")
+            legacy = Manifest.load(manifest)
+            store.root = legacy.root
+            for path, mtime, size, song in legacy.items():
+                store.update(song, mtime, size)
+        elif data is not None and os.path.isfile(data):
+            logging.info(f"Migrating {data} to {directory}")
+            with open(data, "rb") as file:
+                songs = pickle.load(file, encoding="utf-8")
+            for song in songs:
+                try:
+                    store.update(song)
+                except OSError:
+                    logging.warning(f"{song['path']} no more exists, not migrated")
+
+        store.save()
+        return store
@@ -0,0 +1,235 @@
+import hashlib
+import logging
+import os
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Union
+
+import mutagen
+
+from .cache import LookupCache
+from .collection import SongCollection
+from .song import Song
+
+KEYS = ["isrc", "tags", "content"]
+LOSSLESS = [".flac", ".wav", ".aiff", ".alac"]
+
+
+class DuplicateIndex:
+    """
+    Streaming duplicate finder: a song joins the group of every earlier song sharing its ISRC, its normalized title,
+    artist and album, or the hash of the first and last bytes of its file. The album keeps apart the songs sharing
+    a title on different records, such as an "Intro" on every album or the live version of a studio track.
+    Only the first song of a group needs to be resolved, the others copy its spotify id and features.
+    The content hash is only computed for files whose size matches another file, so unique files are never read
+    Args:
+        keys: the kinds of keys used, among "isrc", "tags" and "content"
+        hash_bytes: how many bytes are hashed at the start and at the end of a file
+    """
+
+    def __init__(self, keys: List[str] = None, hash_bytes: int = 64 * 1024):
+        self.keys = KEYS if keys is None else keys
+        for key in self.keys:
+            if key not in KEYS:
+                raise ValueError(f"keys must be among {KEYS}")
+        self.hash_bytes = hash_bytes
+
+        self._songs: List[Song] = []
+        self._parent: List[int] = []
+        self._by_key: Dict[str, int] = {}
+        self._by_size: Dict[int, List[int]] = defaultdict(list)
+        self._hashed = set()
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def _find(self, i: int) -> int:
+        """
+        Get the first song of the group of a song, compressing the path on the way
+        """
+        root = i
+        while self._parent[root] != root:
+            root = self._parent[root]
+        while self._parent[i] != root:
+            self._parent[i], i = root, self._parent[i]
+
+        return root
+
+    def _tag_keys(self, song: Song) -> List[str]:
+        keys = []
+        if "isrc" in self.keys and song["isrc"]:
+            keys.append(f"isrc:{LookupCache.normalize(song['isrc'])}")
+        if "tags" in self.keys and song["title"] and song["artist"] and song["album"]:
+            keys.append(f"tags:{LookupCache.normalize(song['title'])}|{LookupCache.normalize(song['artist'])}|"
+                        f"{LookupCache.normalize(song['album'])}")
+
+        return keys
+
+    def _content_keys(self, i: int) -> List[str]:
+        """
+        Hash the file of a song if another file has the same size, hashing that one too if needed
+        Args:
+            i: the index of the song
+
+        Returns:
+            The content keys to register, with the index of their song
+        """
+        try:
+            size = os.path.getsize(self._songs[i]["path"])
+        except OSError:
+            return []
+
+        same_size = self._by_size[size]
+        same_size.append(i)
+        if len(same_size) == 1:
+            return []
+
+        keys = []
+        for j in same_size:
+            if j in self._hashed:
+                continue
+            self._hashed.add(j)
+            digest = content_hash(self._songs[j]["path"], self.hash_bytes)
+            if digest is not None:
+                keys.append((f"content:{size}:{digest}", j))
+
+        return keys
+
+    def add(self, song: Song) -> Optional[Song]:
+        """
+        Add a song
+        Args:
+            song: the Song object
+
+        Returns:
+            The first song of its group if the song is a duplicate, None if the song is new
+        """
+        i = len(self._songs)
+        self._songs.append(song)
+        self._parent.append(i)
+
+        keys = [(key, i) for key in self._tag_keys(song)]
+        if "content" in self.keys:
+            keys += self._content_keys(i)
+
+        for key, j in keys:
+            other = self._by_key.setdefault(key, j)
+            if other != j:
+                a, b = self._find(other), self._find(j)
+                # The earliest song stays the root, it is the one sent to be resolved
+                self._parent[max(a, b)] = min(a, b)
+
+        root = self._find(i)
+        return None if root == i else self._songs[root]
+
+    def groups(self) -> List[List[Song]]:
+        """
+        Get the groups of duplicates
+        Returns:
+            The lists of songs with more than one song, the first one is the one resolved
+        """
+        groups = defaultdict(list)
+        for i, song in enumerate(self._songs):
+            groups[self._find(i)].append(song)
+
+        return [songs for songs in groups.values() if len(songs) > 1]
+
+
+def content_hash(path: str, size: int = 64 * 1024) -> Optional[str]:
+    """
+    Hash the start and the end of a file, enough to tell apart files of the same size
+    Args:
+        path: the file
+        size: how many bytes are hashed at each end
+
+    Returns:
+        The hex digest, None if the file cannot be read
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, "rb") as file:
+            digest.update(file.read(size))
+            file.seek(0, os.SEEK_END)
+            end = file.tell()
+            if end > size:
+                file.seek(max(size, end - size))
+                digest.update(file.read(size))
+    except OSError as e:
+        logging.warning(f"Cannot hash {path}: {e!r}")
+        return None
+
+    return digest.hexdigest()
+
+
+def bitrate(song: Song) -> float:
+    """
+    Get the bitrate of the file of a song, its size if mutagen cannot tell
+    Args:
+        song: the Song object
+
+    Returns:
+        The bitrate in bits per second
+    """
+    try:
+        info = mutagen.File(song["path"]).info
+        if getattr(info, "bitrate", 0):
+            return info.bitrate
+    except Exception as e:
+        logging.debug(f"Cannot read the bitrate of {song['path']}: {e!r}")
+
+    try:
+        # Copies of the same recording have the same length, so the size grows with the bitrate
+        return os.path.getsize(song["path"])
+    except OSError:
+        return 0
+
+
+def _lossless(song: Song) -> tuple:
+    return os.path.splitext(song["path"])[1].lower() in LOSSLESS, bitrate(song)
+
+
+# The copy kept is the one with the highest key
+PREFERENCES: Dict[str, Optional[Callable[[Song], object]]] = {
+    "bitrate": bitrate,
+    "lossless": _lossless,  # Lossless files first, then the highest bitrate
+    "first": None  # The first copy given
+}
+
+
+def dedupe(songs: Union[List[Song], SongCollection],
+           prefer: Union[str, Callable[[Song], object]] = "bitrate") -> Union[List[Song], SongCollection]:
+    """
+    Keep a single copy of every recording: songs with the same spotify id are the same recording
+    Args:
+        songs: the Song objects or a SongCollection, songs without spotify id are kept
+        prefer: "bitrate", "lossless" or "first", or a function giving the key of the copy to keep (the highest)
+
+    Returns:
+        The songs kept, in the given order, as a SongCollection if one was given
+    """
+    if isinstance(prefer, str):
+        if prefer not in PREFERENCES:
+            raise ValueError(f"prefer must be one of {list(PREFERENCES)} or a function")
+        prefer = PREFERENCES[prefer]
+
+    # Only the copies of a collection are rebuilt as Song objects, to compare them
+    ids = songs.column("spotify_id") if isinstance(songs, SongCollection) else [song["spotify_id"] for song in songs]
+    copies = defaultdict(list)
+    for i, spotify_id in enumerate(ids):
+        if spotify_id is not None:
+            copies[spotify_id].append(i)
+
+    dropped = set()
+    for group in copies.values():
+        if len(group) < 2:
+            continue
+        kept = group[0] if prefer is None else max(group, key=lambda i: prefer(songs[i]))
+        dropped.update(i for i in group if i != kept)
+
+    if not dropped:
+        return songs
+    logging.info(f"Dropped {len(dropped)} duplicate copies")
+
+    kept = [i for i in range(len(songs)) if i not in dropped]
+    if isinstance(songs, SongCollection):
+        return songs.subset(kept)
+    return [songs[i] for i in kept]
@@ -0,0 +1,420 @@
+import logging
+import os
+import shutil
+import subprocess
+import wave
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .cache import LookupCache
+from .dedup import content_hash
+from .features import Feature
+from .metrics import metrics
+from .song import Song
+
+SAMPLE_RATE = 22050
+FRAME = 2048  # samples per analysis frame, about 93 ms
+HOP = 512  # samples between two frames
+BATCH = 512  # frames transformed with a single FFT call
+VERSION = 1  # part of the cache keys, bump it when the features change
+
+_EPS = 1e-10
+# Krumhansl-Kessler key profiles, used to tell major from minor
+_MAJOR = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+_MINOR = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+
+
+class DecodeError(Exception):
+    """
+    An audio file cannot be decoded
+    """
+
+
+def decode(path: str, sample_rate: int = SAMPLE_RATE, seconds: float = 60.0,
+           offset: float = 0.0) -> Tuple[np.ndarray, int]:
+    """
+    Decode an excerpt of an audio file to mono float32 samples with ffmpeg, or with the wave module for WAV files
+    when ffmpeg is not installed
+    Args:
+        path: the audio file
+        sample_rate: the sample rate ffmpeg resamples to
+        seconds: the length of the excerpt
+        offset: where the excerpt starts, in seconds
+
+    Returns:
+        The samples in [-1, 1] and their sample rate
+
+    Raises:
+        DecodeError: the file cannot be decoded
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        if _is_wav(path):
+            return _read_wav(path, seconds, offset)
+        raise DecodeError("ffmpeg not found, only WAV files can be decoded")
+
+    command = [ffmpeg, "-v", "error", "-nostdin", "-ss", str(offset), "-i", path, "-t", str(seconds), "-vn",
+               "-ac", "1", "-ar", str(sample_rate), "-f", "f32le", "-"]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10 * seconds)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise DecodeError(f"ffmpeg failed: {e!r}") from e
+    if result.returncode != 0:
+        raise DecodeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+
+    return np.frombuffer(result.stdout, dtype=np.float32), sample_rate
+
+
+def _is_wav(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() == ".wav"
+
+
+def _read_wav(path: str, seconds: float, offset: float) -> Tuple[np.ndarray, int]:
+    """
+    Decode an excerpt of a PCM WAV file, at its own sample rate
+    """
+    try:
+        with wave.open(path, "rb") as file:
+            rate, channels, width = file.getframerate(), file.getnchannels(), file.getsampwidth()
+            file.setpos(min(int(offset * rate), file.getnframes()))
+            data = file.readframes(int(seconds * rate))
+    except (OSError, EOFError, wave.Error) as e:
+        raise DecodeError(f"Cannot read {path}: {e!r}") from e
+
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}.get(width)
+    if dtype is None:
+        raise DecodeError(f"{path} has unsupported {8 * width} bits samples")
+
+    samples = np.frombuffer(data, dtype=dtype).reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    if width == 1:
+        return (samples - 128) / 128, rate
+    return samples / 2 ** (8 * width - 1), rate
+
+
+def extract_features(samples: np.ndarray, sample_rate: int) -> dict:
+    """
+    Approximate the Spotify audio features of an excerpt. The frames are strided views of the samples and are
+    transformed BATCH at a time, every per-frame descriptor is computed for the whole batch at once.
+    The values are rough proxies on the Spotify scales (0-1, dB, BPM), good enough to cluster tracks
+    Spotify does not know, not to compare with Spotify's own values
+    Args:
+        samples: the mono samples in [-1, 1]
+        sample_rate: their sample rate
+
+    Returns:
+        A dict with the keys of Feature
+
+    Raises:
+        DecodeError: the excerpt is too short
+    """
+    if len(samples) < 8 * FRAME:
+        raise DecodeError(f"Only {len(samples) / sample_rate:.1f}s of audio")
+
+    samples = np.asarray(samples, dtype=np.float32)
+    frames = sliding_window_view(samples, FRAME)[::HOP]
+    n = len(frames)
+
+    window = np.hanning(FRAME).astype(np.float32)
+    freqs = np.fft.rfftfreq(FRAME, 1 / sample_rate).astype(np.float32)
+    voice = (freqs >= 300) & (freqs <= 3400)
+    # One-hot map from the FFT bins between A1 and about D#8 to their pitch class
+    pitched = (freqs >= 55) & (freqs <= 5000)
+    pitch_class = np.round(12 * np.log2(np.where(pitched, freqs, 440) / 440)).astype(int) % 12
+    chroma_map = ((pitch_class[:, None] == np.arange(12)) & pitched[:, None]).astype(np.float32)
+
+    rms = np.empty(n, dtype=np.float32)
+    zcr = np.empty(n, dtype=np.float32)
+    centroid = np.empty(n, dtype=np.float32)
+    rolloff = np.empty(n, dtype=np.float32)
+    flatness = np.empty(n, dtype=np.float32)
+    flux = np.empty(n, dtype=np.float32)
+    voice_ratio = np.empty(n, dtype=np.float32)
+    chroma = np.zeros(12, dtype=np.float64)
+
+    previous = None
+    for start in range(0, n, BATCH):
+        batch = frames[start:start + BATCH]
+        part = slice(start, start + len(batch))
+
+        rms[part] = np.sqrt(np.mean(np.square(batch), axis=1))
+        zcr[part] = np.count_nonzero(np.diff(np.signbit(batch), axis=1), axis=1) / FRAME
+
+        spectrum = np.abs(np.fft.rfft(batch * window, axis=1)).astype(np.float32)
+        power = np.square(spectrum)
+        total = power.sum(axis=1) + _EPS
+        centroid[part] = power @ freqs / total
+        rolloff[part] = freqs[np.argmax(np.cumsum(power, axis=1) >= 0.85 * total[:, None], axis=1)]
+        flatness[part] = np.exp(np.mean(np.log(power + _EPS), axis=1)) / (np.mean(power, axis=1) + _EPS)
+        voice_ratio[part] = power[:, voice].sum(axis=1) / total
+        chroma += (power @ chroma_map).sum(axis=0)
+
+        # Positive change of the compressed spectrum, the onset strength of every frame
+        compressed = np.log1p(spectrum)
+        flux[part] = np.maximum(np.diff(compressed, axis=0, prepend=compressed[:1] if previous is None else previous),
+                                0).sum(axis=1)
+        previous = compressed[-1:]
+
+    frame_rate = sample_rate / HOP
+    tempo, pulse = _tempo(flux, frame_rate)
+
+    loudness = float(10 * np.log10(np.mean(np.square(rms)) + _EPS))
+    brightness = float(np.clip(np.mean(centroid) / 4000, 0, 1))
+    strong = (flux[1:-1] > flux[:-2]) & (flux[1:-1] >= flux[2:]) & (flux[1:-1] > flux.mean() + flux.std())
+    onset_rate = np.count_nonzero(strong) * frame_rate / n
+    pauses = float(np.mean(rms < 0.3 * np.median(rms)))
+    quiet = rms <= np.percentile(rms, 10)
+
+    energy = _unit(0.5 * _unit((loudness + 30) / 30) + 0.25 * brightness + 0.25 * _unit(onset_rate / 8))
+    features = {
+        "danceability": _unit(0.7 * _unit(2 * pulse) + 0.3 * np.exp(-0.5 * ((tempo - 120) / 30) ** 2)),
+        "energy": energy,
+        "loudness": loudness,
+        "speechiness": _unit(np.mean(voice_ratio) * (0.5 * pauses + 0.5 * _unit(zcr.std() / (zcr.mean() + _EPS)))),
+        "acousticness": _unit(1 - (np.mean(rolloff) - 1500) / 6000),
+        "instrumentalness": _unit(1 - 4 * voice_ratio.std()),
+        "liveness": _unit(2 * np.mean(flatness[quiet])),
+        "valence": _unit(0.6 * _unit(0.5 + 2 * _mode_score(chroma)) + 0.4 * energy),
+        "tempo": tempo
+    }
+
+    return features
+
+
+def _tempo(flux: np.ndarray, frame_rate: float) -> Tuple[float, float]:
+    """
+    Estimate the tempo from the autocorrelation of the onset strength, computed with an FFT
+    Args:
+        flux: the onset strength of every frame
+        frame_rate: frames per second
+
+    Returns:
+        The tempo in BPM, between 60 and 200, and the normalized autocorrelation at the beat period
+    """
+    envelope = flux - flux.mean()
+    size = 1 << int(2 * len(envelope) - 1).bit_length()
+    autocorr = np.fft.irfft(np.abs(np.fft.rfft(envelope, size)) ** 2, size)[:len(envelope)]
+    autocorr /= autocorr[0] + _EPS
+
+    lags = np.arange(len(autocorr), dtype=np.float64)
+    bpm = 60 * frame_rate / np.maximum(lags, 1)
+    # Favour tempos around 120 BPM, which halves the octave errors
+    weighted = np.where((bpm >= 60) & (bpm <= 200), autocorr * np.exp(-0.5 * np.log2(bpm / 120) ** 2), -np.inf)
+    best = int(np.argmax(weighted))
+    if not np.isfinite(weighted[best]):
+        return 120.0, 0.0
+
+    lag = float(best)
+    if 0 < best < len(autocorr) - 1:
+        # Parabolic interpolation of the peak, frames are about 23 ms apart
+        a, b, c = autocorr[best - 1:best + 2]
+        if a - 2 * b + c < 0:
+            lag += 0.5 * (a - c) / (a - 2 * b + c)
+
+    return float(60 * frame_rate / lag), float(np.clip(autocorr[best], 0, 1))
+
+
+def _mode_score(chroma: np.ndarray) -> float:
+    """
+    Correlate a chroma profile with the 12 major and 12 minor keys
+    Returns:
+        The best major correlation minus the best minor correlation, positive for major keys
+    """
+    def correlations(profile: np.ndarray) -> np.ndarray:
+        keys = np.stack([np.roll(profile, k) for k in range(12)])
+        keys = (keys - keys.mean(axis=1, keepdims=True)) / keys.std(axis=1, keepdims=True)
+        return keys @ normalized / 12
+
+    normalized = (chroma - chroma.mean()) / (chroma.std() + _EPS)
+    return float(correlations(_MAJOR).max() - correlations(_MINOR).max())
+
+
+def _unit(value) -> float:
+    return float(np.clip(value, 0, 1))
+
+
+def extract_file(path: str, sample_rate: int = SAMPLE_RATE, seconds: float = 60.0) -> Optional[dict]:
+    """
+    Decode a file and approximate its features, in a worker process.
+    The excerpt starts 30 seconds in to skip intros, or at the start of short files
+    Args:
+        path: the audio file
+        sample_rate: the decoding sample rate
+        seconds: the length of the excerpt
+
+    Returns:
+        A dict with the keys of Feature, None if the file cannot be decoded
+    """
+    try:
+        samples, rate = decode(path, sample_rate, seconds, offset=30.0)
+        if len(samples) < 10 * rate:
+            samples, rate = decode(path, sample_rate, seconds)
+        return extract_features(samples, rate)
+    except DecodeError as e:
+        logging.warning(f"Cannot extract the features of {path}: {e}")
+        return None
+
+
+def _done(result) -> Future:
+    """
+    Wrap a cached result in a completed future
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class LocalExtractor:
+    """
+    Compute approximate features from the audio of songs Spotify does not know or has no features for, on a
+    process pool. Jobs are submitted without waiting, so ingestion goes on while they run.
+    Results are cached by file content, a file is decoded again only if it changes, and by path, mtime and size,
+    so the files left unchanged since their features were computed are not even read
+    Args:
+        cache: a LookupCache keeping the results, None to compute them every time
+        workers: the number of worker processes, defaults to the number of CPUs
+        sample_rate: the decoding sample rate
+        seconds: how many seconds of every file are analyzed
+    """
+
+    def __init__(self, cache: LookupCache = None, workers: int = None, sample_rate: int = SAMPLE_RATE,
+                 seconds: float = 60.0):
+        self.cache = cache
+        self.workers = workers
+        self.sample_rate = sample_rate
+        self.seconds = seconds
+
+        self._pool = None
+        self._ffmpeg = shutil.which("ffmpeg") is not None
+        if not self._ffmpeg:
+            logging.warning("ffmpeg not found: local features are computed for WAV files only, the other files are "
+                            "skipped until ffmpeg is installed")
+
+    def key(self, path: str) -> Optional[str]:
+        """
+        Get the cache key of a file: its size and the hash of its first and last bytes
+        Args:
+            path: the audio file
+
+        Returns:
+            The key, None if the file cannot be read
+        """
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        digest = content_hash(path)
+
+        return None if digest is None else f"v{VERSION}:{size}:{digest}"
+
+    @staticmethod
+    def stat_key(path: str) -> Optional[str]:
+        """
+        Get the cache key of a file without reading it: its path, mtime and size
+        Args:
+            path: the audio file
+
+        Returns:
+            The key, None if the file does not exist
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        return f"v{VERSION}:file:{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def submit(self, song: Song) -> Future:
+        """
+        Start computing the features of a song, cached results are returned immediately
+        Args:
+            song: the Song object
+
+        Returns:
+            A future of the dict with the keys of Feature, None if the file cannot be decoded
+        """
+        keys = []
+        stat_key = self.stat_key(song["path"]) if self.cache is not None else None
+        if stat_key is not None:
+            known, payload = self.cache.get_local(stat_key)
+            if known:
+                return _done(payload)
+            keys.append(stat_key)
+
+            # Only the files changed or not seen yet are hashed
+            key = self.key(song["path"])
+            if key is not None:
+                known, payload = self.cache.get_local(key)
+                if known:
+                    self.cache.put_local(stat_key, payload)
+                    return _done(payload)
+                keys.append(key)
+
+        if not self._ffmpeg and not _is_wav(song["path"]):
+            # Not cached, the file can be decoded once ffmpeg is installed
+            metrics.count("songs_not_decodable")
+            return _done(None)
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        future = self._pool.submit(extract_file, song["path"], self.sample_rate, self.seconds)
+        if keys:
+            future.add_done_callback(lambda done: self._store(keys, done))
+
+        return future
+
+    def _store(self, keys: List[str], future: Future) -> None:
+        if future.exception() is None:
+            for key in keys:
+                self.cache.put_local(key, future.result())
+
+    def apply(self, song: Song, future: Future) -> bool:
+        """
+        Wait for a job and set the features of its song
+        Args:
+            song: the Song object given to submit
+            future: the future returned by submit
+
+        Returns:
+            True if the song got features
+        """
+        try:
+            payload = future.result()
+        except Exception as e:
+            logging.error(f"Feature extraction of {song['path']} failed: {e!r}")
+            return False
+        if payload is None:
+            return False
+
+        song["features"] = Feature(**payload)
+        metrics.count("songs_local_features")
+        return True
+
+    def extract_bulk(self, songs: List[Song]) -> Tuple[List[Song], List[Song]]:
+        """
+        Compute the features of many songs on the process pool
+        Args:
+            songs: the Song objects
+
+        Returns:
+            The songs with features and the songs without, in the given order
+        """
+        futures = [self.submit(song) for song in songs]
+        results = [self.apply(song, future) for song, future in zip(songs, futures)]
+
+        found = [song for song, ok in zip(songs, results) if ok]
+        missing = [song for song, ok in zip(songs, results) if not ok]
+
+        return found, missing
+
+    def close(self) -> None:
+        """
+        Stop the worker processes
+        Returns:
+            None
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,198 @@
+import os
+import pickle
+import logging
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+from .song import Song
+from .utils import is_music_file, list_files
+
+
+class Manifest:
+    """
+    Remember path, mtime and size of every scanned file together with the resolved Song,
+    so a rescan only needs to parse and resolve the files that changed
+    Args:
+        filename: where the manifest is saved
+        root: the music directory the manifest refers to
+    """
+
+    def __init__(self, filename: str, root: str = None):
+        self.filename = filename
+        self.root = root
+        self._entries: Dict[str, Tuple[float, int, Song]] = {}
+
+    @classmethod
+    def load(cls, filename: str) -> "Manifest":
+        """
+        Load a manifest from disk, or create an empty one if the file does not exist
+        Args:
+            filename: where the manifest is saved
+
+        Returns:
+            A Manifest object
+        """
+        if not os.path.isfile(filename):
+            logging.debug(f"{filename} not found, starting from an empty manifest")
+            return cls(filename)
+
+        with open(filename, "rb") as data:
+            manifest = pickle.load(data, encoding="utf-8")
+        manifest.filename = filename
+
+        return manifest
+
+    def save(self) -> None:
+        """
+        Write the manifest to disk
+        Returns:
+            None
+        """
+        tmp = f"{self.filename}.tmp"
+        with open(tmp, "wb") as data:
+            pickle.dump(self, data)
+        os.replace(tmp, self.filename)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self._entries
+
+    def diff(self, files: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Compare the given files with the manifest
+        Args:
+            files: the files currently in the music directory
+
+        Returns:
+            The new or changed files and the files no more present
+        """
+        return diff_files(self._entries, files)
+
+    def diff_paths(self, paths: Iterable[str]) -> Tuple[List[str], List[str]]:
+        """
+        Compare only some files or directories with the manifest, e.g. the ones reported by a Watcher
+        Args:
+            paths: the paths that may have changed
+
+        Returns:
+            The new or changed files and the files no more present
+        """
+        return diff_paths(self._entries, paths)
+
+    def items(self) -> Iterator[Tuple[str, float, int, Song]]:
+        """
+        Iterate over the entries
+        Returns:
+            An iterator of (path, mtime, size, Song object)
+        """
+        for path, (mtime, size, song) in self._entries.items():
+            yield path, mtime, size, song
+
+    def update(self, song: Song) -> None:
+        """
+        Add or replace the entry of a parsed song
+        Args:
+            song: the Song object, its path is used as the key
+
+        Returns:
+            None
+        """
+        path = os.path.abspath(song["path"])
+        stat = os.stat(path)
+        self._entries[path] = (stat.st_mtime, stat.st_size, song)
+
+    def remove(self, path: str) -> Optional[Song]:
+        """
+        Drop the entry of a file
+        Args:
+            path: the path of the file
+
+        Returns:
+            The removed Song object, if any
+        """
+        entry = self._entries.pop(os.path.abspath(path), None)
+        return None if entry is None else entry[2]
+
+    def songs(self) -> List[Song]:
+        """
+        Get the songs that have been resolved and have their features
+        Returns:
+            A list of Song objects
+        """
+        return [entry[2] for entry in self._entries.values() if entry[2]["features"] is not None]
+
+    def unresolved(self) -> List[Song]:
+        """
+        Get the songs still without features, e.g. because they were not found or a request failed
+        Returns:
+            A list of Song objects
+        """
+        return [entry[2] for entry in self._entries.values() if entry[2]["features"] is None]
+
+
+def diff_files(known: Mapping[str, tuple], files: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """
+    Compare the given files with the known ones
+    Args:
+        known: a mapping path: (mtime, size, ...) of the files already scanned
+        files: the files currently in the music directory
+
+    Returns:
+        The new or changed files and the known files no more present
+    """
+    changed = []
+    seen = set()
+    for file in files:
+        path = os.path.abspath(file)
+        seen.add(path)
+
+        entry = known.get(path)
+        if entry is None:
+            changed.append(path)
+            continue
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Vanished while scanning, drop it as removed
+            seen.discard(path)
+            continue
+        if entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+            changed.append(path)
+
+    removed = [path for path in known if path not in seen]
+
+    return changed, removed
+
+
+def diff_paths(known: Mapping[str, tuple], paths: Iterable[str]) -> Tuple[List[str], List[str]]:
+    """
+    Compare only some files or directories with the known files.
+    Existing directories are scanned, paths no more present drop every known file below them
+    Args:
+        known: a mapping path: (mtime, size, ...) of the files already scanned
+        paths: the paths that may have changed
+
+    Returns:
+        The new or changed files and the known files no more present
+    """
+    changed = set()
+    removed = set()
+    for path in map(os.path.abspath, paths):
+        prefix = os.path.join(path, "")
+        if os.path.isdir(path):
+            below = {entry: known[entry] for entry in known if entry.startswith(prefix)}
+            files_changed, files_removed = diff_files(below, list_files(path))
+            changed.update(files_changed)
+            removed.update(files_removed)
+        elif os.path.isfile(path):
+            if is_music_file(path):
+                entry = known.get(path)
+                changed.update(diff_files({} if entry is None else {path: entry}, [path])[0])
+            elif path in known:
+                removed.add(path)
+        else:
+            removed.update(entry for entry in known if entry == path or entry.startswith(prefix))
+
+    return sorted(changed), sorted(removed - changed)
@@ -0,0 +1,241 @@
+import bisect
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class Histogram:
+    """
+    Fixed buckets histogram, cheap enough to be updated on every request
+    Args:
+        bounds: the upper bounds of the buckets, an overflow bucket is added
+    """
+
+    def __init__(self, bounds: List[float] = None):
+        self.bounds = bounds or LATENCY_BUCKETS
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float) -> None:
+        """
+        Add a value
+        Args:
+            value: the value to add
+
+        Returns:
+            None
+        """
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self) -> dict:
+        labels = [f"<={bound}" for bound in self.bounds] + [f">{self.bounds[-1]}"]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.buckets))
+        }
+
+
+class Metrics:
+    """
+    Thread safe registry of the per-stage timings, counters, histograms and gauges of a run.
+    The report is built by emit, which also calls the registered hooks
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks: List[Callable[[dict], None]] = []
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Forget everything recorded, the hooks are kept
+        Returns:
+            None
+        """
+        with self._lock:
+            self.started = time.time()
+            self.stages: Dict[str, dict] = {}
+            self.counters: Dict[str, int] = {}
+            self.histograms: Dict[str, Histogram] = {}
+            self.gauges: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time a stage. Wall time is the elapsed time, cpu time is the cpu used by the whole process meanwhile.
+        Timing the same stage again adds to it
+        Args:
+            name: the name of the stage
+        """
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self._lock:
+                stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+                stage["wall"] += wall
+                stage["cpu"] += cpu
+                stage["calls"] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        """
+        Increment a counter
+        Args:
+            name: the name of the counter
+            n: the increment
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        Add a value to a histogram
+        Args:
+            name: the name of the histogram
+            value: the value, latencies are in milliseconds
+
+        Returns:
+            None
+        """
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name: str, value: float) -> None:
+        """
+        Set a gauge
+        Args:
+            name: the name of the gauge
+            value: its value
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.gauges[name] = value
+
+    def add_hook(self, hook: Callable[[dict], None]) -> None:
+        """
+        Register a function called with the report every time it is emitted
+        Args:
+            hook: the function
+
+        Returns:
+            None
+        """
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[dict], None]) -> None:
+        self._hooks.remove(hook)
+
+    @staticmethod
+    def peak_memory() -> Optional[float]:
+        """
+        Get the peak resident memory of the process and of its terminated children
+        Returns:
+            The peak in MB, None if it cannot be measured
+        """
+        if resource is None:
+            return None
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        unit = 1 if sys.platform == "darwin" else 1024
+        return max(peak, children) * unit / 2 ** 20
+
+    def report(self) -> dict:
+        """
+        Build the report of the run
+        Returns:
+            A json serializable dict
+        """
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+            counters = dict(self.counters)
+            histograms = {name: histogram.to_dict() for name, histogram in self.histograms.items()}
+            gauges = dict(self.gauges)
+
+        throughput = {}
+        if stages.get("scan", {}).get("wall"):
+            throughput["files_per_second"] = counters.get("files_parsed", 0) / stages["scan"]["wall"]
+        if stages.get("resolve", {}).get("wall"):
+            throughput["songs_resolved_per_second"] = counters.get("songs_resolved", 0) / stages["resolve"]["wall"]
+
+        return {
+            "started": self.started,
+            "duration": time.time() - self.started,
+            "python": platform.python_version(),
+            "pid": os.getpid(),
+            "peak_memory_mb": self.peak_memory(),
+            "stages": stages,
+            "throughput": throughput,
+            "counters": counters,
+            "histograms": histograms,
+            "gauges": gauges
+        }
+
+    def emit(self) -> dict:
+        """
+        Build the report and pass it to the hooks
+        Returns:
+            The report
+        """
+        report = self.report()
+        for hook in self._hooks:
+            try:
+                hook(report)
+            except Exception:
+                logging.exception(f"Metrics hook {hook!r} failed")
+
+        return report
+
+    def write(self, filename: str) -> dict:
+        """
+        Emit the report and save it as json
+        Args:
+            filename: where the report is written
+
+        Returns:
+            The report
+        """
+        report = self.emit()
+        with open(filename, "w", encoding="utf-8") as out:
+            json.dump(report, out, indent=2)
+        logging.info(f"Run report written to {filename}")
+
+        return report
+
+
+# Registry shared by the whole library
+metrics = Metrics()
@@ -0,0 +1,342 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Iterable, List, Tuple
+
+from .albums import AlbumGrouper, AlbumResolver
+from .api import API
+from .dedup import DuplicateIndex
+from .extract import LocalExtractor
+from .metrics import metrics
+from .song import Song
+from .utils import load_files_parallel, load_files_safe
+
+_DONE = object()  # Sentinel closing a queue
+
+
+class Pipeline:
+    """
+    Streaming ingestion: files are parsed, searched on Spotify and their features requested as overlapping stages.
+    Stages are connected by bounded queues, so a slow stage makes the previous ones wait instead of piling up songs.
+    Parsed songs are grouped by album: a whole album is resolved with an album search and its tracklist,
+    only the songs it does not match are searched one by one. Copies of a song already parsed are not resolved,
+    they get the spotify id and the features of the first copy at the end.
+    Songs not found on Spotify, or without Spotify features, are sent to the local extractor as soon as they are
+    known, its processes run alongside the other stages
+    Args:
+        spotipy: the API object used to search and to get the features
+        workers: the number of workers used to parse the files
+        executor: "thread" or "process" to parse the files in parallel, None to parse them one at a time
+        queue_size: the maximum number of songs waiting between two stages
+        batch_size: how many ids are sent with each features request
+        progress_interval: how many seconds between two progress logs
+        albums: resolve the songs album by album, False to search every song on its own
+        album_window: how many songs are parsed after the last song of an album before the album is resolved
+        dedup: resolve only the first copy of duplicate songs, see DuplicateIndex
+        local: a LocalExtractor computing the features of the songs Spotify cannot give, None to leave them out
+    """
+
+    def __init__(self, spotipy: API, workers: int = None, executor: str = None, queue_size: int = 1000,
+                 batch_size: int = API._MAX_IDS, progress_interval: float = 10, albums: bool = True,
+                 album_window: int = 100, dedup: bool = True, local: LocalExtractor = None):
+        self.spotipy = spotipy
+        self.workers = workers
+        self.executor = executor
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.albums = albums
+        self.album_window = album_window
+        self.dedup = dedup
+        self.resolver = AlbumResolver(spotipy)
+        self.local = local
+
+        self.progress = {"parsed": 0, "resolved": 0, "missing": 0, "features": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._error = None
+        self._extracting: List[Tuple[Song, Future]] = []
+
+    def run(self, files: Iterable[str], songs: Iterable[Song] = ()) -> Tuple[List[Song], List[Song]]:
+        """
+        Run the pipeline until every file has gone through every stage
+        Args:
+            files: the files to parse
+            songs: already parsed songs to resolve too
+
+        Returns:
+            The songs found on Spotify and the songs not found
+        """
+        parsed = queue.Queue(self.queue_size)
+        resolved = queue.Queue(self.queue_size)
+        found = []
+        missing = []
+        duplicates = []
+
+        scanner = threading.Thread(target=self._guard, args=(self._scan, files, songs, parsed, duplicates),
+                                   daemon=True)
+        resolvers = [threading.Thread(target=self._guard, args=(self._resolve, parsed, resolved, missing),
+                                      daemon=True)
+                     for _ in range(self.spotipy.workers)]
+        closer = threading.Thread(target=self._guard, args=(self._close, resolvers, resolved), daemon=True)
+
+        for thread in [scanner, *resolvers, closer]:
+            thread.start()
+
+        try:
+            with metrics.stage("features"):
+                self._fetch_features(resolved, found)
+        finally:
+            self._stop.set()
+
+        if self._error is not None:
+            raise self._error
+
+        self._collect_local(found, missing)
+        self._copy_duplicates(duplicates, found, missing)
+        self._log_progress()
+        return found, missing
+
+    def _guard(self, stage, *args) -> None:
+        """
+        Run a stage, stopping the whole pipeline if it fails
+        Args:
+            stage: the stage function
+            *args: the arguments of the stage
+
+        Returns:
+            None
+        """
+        try:
+            stage(*args)
+        except Exception as e:
+            logging.exception(f"Pipeline stage {stage.__name__} failed")
+            self._error = self._error or e
+            self._stop.set()
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """
+        Put an item in a queue, waiting for room unless the pipeline is stopped
+        Args:
+            q: the queue
+            item: the item to put
+
+        Returns:
+            False if the pipeline has been stopped
+        """
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _get(self, q: queue.Queue, timeout: float = None):
+        """
+        Get an item from a queue unless the pipeline is stopped
+        Args:
+            q: the queue
+            timeout: return None after this many seconds without items
+
+        Returns:
+            The item, _DONE if the pipeline has been stopped, None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+
+        return _DONE
+
+    def _count(self, stage: str) -> None:
+        with self._lock:
+            self.progress[stage] += 1
+
+    def _scan(self, files: Iterable[str], songs: Iterable[Song], parsed: queue.Queue,
+              duplicates: List[Tuple[Song, Song]]) -> None:
+        """
+        First stage: parse the files, hold back the duplicates and group the others by album
+        """
+        grouper = AlbumGrouper(self.album_window) if self.albums else None
+        index = DuplicateIndex() if self.dedup else None
+        with metrics.stage("scan"):
+            if self.executor is None:
+                musics = load_files_safe(files)
+            else:
+                musics = load_files_parallel(files, workers=self.workers, executor=self.executor)
+
+            for source in (songs, musics):
+                for music in source:
+                    first = index.add(music) if index is not None else None
+                    if first is not None:
+                        metrics.count("songs_duplicate")
+                        duplicates.append((music, first))
+                        self._count("parsed")
+                        continue
+
+                    for group in (grouper.add(music) if grouper is not None else [[music]]):
+                        if not self._put(parsed, group):
+                            return
+                    self._count("parsed")
+
+            for group in (grouper.flush() if grouper is not None else []):
+                if not self._put(parsed, group):
+                    return
+
+        for _ in range(self.spotipy.workers):
+            self._put(parsed, _DONE)
+
+    def _resolve(self, parsed: queue.Queue, resolved: queue.Queue, missing: List[Song]) -> None:
+        """
+        Second stage: search the songs on Spotify, one worker per API worker.
+        Every item is an album, resolved as a whole first
+        """
+        while True:
+            group = self._get(parsed)
+            if group is _DONE:
+                return
+
+            leftovers = self.resolver.resolve(group) if len(group) > 1 else group
+            unmatched = set(map(id, leftovers))
+            for music in group:
+                if id(music) in unmatched:
+                    found = self.spotipy.search_track(music)
+                else:
+                    found = True
+                    metrics.count("songs_resolved_by_album")
+
+                if found:
+                    metrics.count("songs_resolved")
+                    self._count("resolved")
+                    if not self._put(resolved, music):
+                        return
+                else:
+                    logging.warning(f"{music['title']} - {music['artist']} not found. Skipping {music['path']}")
+                    metrics.count("songs_missing")
+                    self._count("missing")
+                    with self._lock:
+                        missing.append(music)
+                    self._extract(music)
+
+    def _close(self, resolvers: List[threading.Thread], resolved: queue.Queue) -> None:
+        """
+        Close the resolved queue once every resolver is done
+        """
+        with metrics.stage("resolve"):
+            for resolver in resolvers:
+                resolver.join()
+        self._put(resolved, _DONE)
+
+    def _fetch_features(self, resolved: queue.Queue, found: List[Song]) -> None:
+        """
+        Last stage: get the features, cached ones immediately and the others in full batches of ids
+        """
+        batch = []
+        last_log = time.monotonic()
+        while True:
+            music = self._get(resolved, timeout=self.progress_interval)
+            if music is _DONE:
+                break
+
+            if music is not None:
+                found.append(music)
+                if self.spotipy.cached_features(music):
+                    if music["features"] is not None:
+                        self._count("features")
+                    else:
+                        self._extract(music)
+                else:
+                    batch.append(music)
+
+                if len(batch) == self.batch_size:
+                    self._request_features(batch)
+                    batch = []
+
+            if time.monotonic() - last_log >= self.progress_interval:
+                self._log_progress()
+                last_log = time.monotonic()
+
+        if batch and not self._stop.is_set():
+            self._request_features(batch)
+
+    def _request_features(self, batch: List[Song]) -> None:
+        """
+        Request the features of a batch of at most 100 songs
+        """
+        self.spotipy.feature_bulk(batch)
+        with self._lock:
+            self.progress["features"] += sum(1 for music in batch if music["features"] is not None)
+        for music in batch:
+            if music["features"] is None:
+                self._extract(music)
+
+    def _extract(self, music: Song) -> None:
+        """
+        Start computing the features of a song from its audio, if there is a local extractor
+        """
+        if self.local is None:
+            return
+
+        future = self.local.submit(music)
+        with self._lock:
+            self._extracting.append((music, future))
+
+    def _collect_local(self, found: List[Song], missing: List[Song]) -> None:
+        """
+        Wait for the local extractor, the songs not found that got features join the found ones
+        Args:
+            found: the songs found
+            missing: the songs not found
+
+        Returns:
+            None
+        """
+        if not self._extracting:
+            return
+
+        extracted = set()
+        with metrics.stage("local"):
+            for music, future in self._extracting:
+                if self.local.apply(music, future):
+                    extracted.add(id(music))
+        self._extracting = []
+
+        moved = [music for music in missing if id(music) in extracted]
+        missing[:] = [music for music in missing if id(music) not in extracted]
+        found += moved
+        with self._lock:
+            self.progress["features"] += len(extracted)
+        logging.info(f"Computed local features for {len(extracted)} songs ({len(moved)} not found on Spotify)")
+
+    def _copy_duplicates(self, duplicates: List[Tuple[Song, Song]], found: List[Song], missing: List[Song]) -> None:
+        """
+        Give every duplicate the spotify id and the features of the first copy
+        Args:
+            duplicates: the (duplicate, first copy) pairs
+            found: the songs found, the duplicates of found songs are added
+            missing: the songs not found, the other duplicates are added
+
+        Returns:
+            None
+        """
+        found_ids = set(map(id, found))
+        for music, first in duplicates:
+            if id(first) in found_ids:
+                music["spotify_id"] = first["spotify_id"]
+                music["features"] = first["features"]
+                found.append(music)
+            else:
+                missing.append(music)
+
+    def _log_progress(self) -> None:
+        with self._lock:
+            progress = dict(self.progress)
+        logging.info(f"Parsed {progress['parsed']} files, resolved {progress['resolved']} "
+                     f"({progress['missing']} not found), got features for {progress['features']}")
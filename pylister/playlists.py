@@ -0,0 +1,217 @@
+import logging
+import os
+import re
+from pathlib import Path
+from typing import Callable, Dict, List
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+from .song import Song
+
+
+def _title(song: Song) -> str:
+    """
+    Get the display title of a song, "Artist - Title"
+    """
+    if song["artist"] and song["title"]:
+        return f"{song['artist']} - {song['title']}"
+    return song["title"] or os.path.splitext(os.path.basename(song["path"]))[0]
+
+
+def _duration(song: Song) -> int:
+    """
+    Get the length of a song in seconds when it is known without opening the file, -1 otherwise
+    """
+    analysis = song["analysis"]
+    return int(round(analysis.duration)) if analysis is not None and analysis.duration else -1
+
+
+def _line(text: str) -> str:
+    # A new line in a tag would start a new entry
+    return re.sub(r"[\r\n]+", " ", str(text))
+
+
+class PlaylistWriter:
+    """
+    Write playlists only when their content changes, through a temporary file renamed over the old one, so
+    media servers watching the directory never see a partial file and do not rescan untouched playlists.
+    The format follows the extension of the file: .m3u and .m3u8, .pls or .xspf
+    Args:
+        extended: write the #EXTM3U header and an #EXTINF line before every m3u entry
+        relative: write the paths relative to the directory of the playlist, so the library can be moved along
+        encoding: the text encoding, .m3u8 files are always UTF-8
+    """
+    FORMATS = [".m3u", ".m3u8", ".pls", ".xspf"]
+
+    def __init__(self, extended: bool = True, relative: bool = False, encoding: str = "utf-8"):
+        self.extended = extended
+        self.relative = relative
+        self.encoding = encoding
+
+        self._renderers: Dict[str, Callable[[List[Song], str], str]] = {
+            ".m3u": self._m3u,
+            ".m3u8": self._m3u,
+            ".pls": self._pls,
+            ".xspf": self._xspf
+        }
+
+    def _location(self, song: Song, directory: str) -> str:
+        """
+        Get the path written for a song
+        Args:
+            song: the Song object
+            directory: the absolute directory of the playlist
+
+        Returns:
+            The absolute path, or the relative one if relative is set and the song is on the same drive
+        """
+        path = os.path.abspath(song["path"])
+        if self.relative:
+            try:
+                return os.path.relpath(path, directory)
+            except ValueError:
+                # Another drive on Windows
+                pass
+
+        return path
+
+    def _m3u(self, songs: List[Song], directory: str) -> str:
+        lines = ["#EXTM3U\n"] if self.extended else []
+        for song in songs:
+            if self.extended:
+                lines.append(f"#EXTINF:{_duration(song)},{_line(_title(song))}\n")
+            lines.append(f"{self._location(song, directory)}\n")
+
+        return "".join(lines)
+
+    def _pls(self, songs: List[Song], directory: str) -> str:
+        lines = ["[playlist]\n"]
+        for i, song in enumerate(songs, 1):
+            lines.append(f"File{i}={self._location(song, directory)}\n")
+            lines.append(f"Title{i}={_line(_title(song))}\n")
+            lines.append(f"Length{i}={_duration(song)}\n")
+        lines.append(f"NumberOfEntries={len(songs)}\nVersion=2\n")
+
+        return "".join(lines)
+
+    def _xspf(self, songs: List[Song], directory: str) -> str:
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+                 '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n',
+                 "  <trackList>\n"]
+        for song in songs:
+            location = self._location(song, directory)
+            uri = Path(location).as_uri() if os.path.isabs(location) else quote(location.replace(os.sep, "/"))
+            fields = [f"<location>{escape(uri)}</location>"]
+            for tag, key in (("title", "title"), ("creator", "artist"), ("album", "album")):
+                if song[key]:
+                    fields.append(f"<{tag}>{escape(str(song[key]))}</{tag}>")
+            if _duration(song) >= 0:
+                fields.append(f"<duration>{_duration(song) * 1000}</duration>")
+            lines.append(f"    <track>{''.join(fields)}</track>\n")
+        lines.append("  </trackList>\n</playlist>\n")
+
+        return "".join(lines)
+
+    def render(self, songs: List[Song], filename: str) -> bytes:
+        """
+        Build the content of a playlist in memory
+        Args:
+            songs: the Song objects, in order
+            filename: the playlist file, its extension sets the format
+
+        Returns:
+            The encoded content
+
+        Raises:
+            ValueError: the extension is not one of FORMATS
+        """
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in self._renderers:
+            raise ValueError(f"Unsupported playlist format {extension}, expected one of {self.FORMATS}")
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        encoding = "utf-8" if extension in (".m3u8", ".xspf") else self.encoding
+        return self._renderers[extension](songs, directory).encode(encoding, errors="replace")
+
+    def write(self, songs: List[Song], filename: str) -> bool:
+        """
+        Write a playlist if its content changed
+        Args:
+            songs: the Song objects, in order
+            filename: the playlist file
+
+        Returns:
+            True if the file was written, False if it was already up to date
+        """
+        content = self.render(songs, filename)
+        if _unchanged(filename, content):
+            return False
+
+        # Written in one call, then renamed over the old playlist
+        tmp = f"{filename}.tmp"
+        try:
+            with open(tmp, "wb") as file:
+                file.write(content)
+            os.replace(tmp, filename)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return True
+
+    def write_all(self, clusters: List[List[Song]], filename: str) -> List[str]:
+        """
+        Write one numbered playlist per cluster, e.g. playlist.0.m3u for playlist.m3u.
+        Numbered playlists left from an earlier run with more clusters are removed
+        Args:
+            clusters: the lists of Song objects
+            filename: the base filename
+
+        Returns:
+            The playlists written
+        """
+        base, extension = os.path.splitext(filename)
+        written = []
+        for i, cluster in enumerate(clusters):
+            file = f"{base}.{i}{extension}"  # test.4.m3u
+            if self.write(cluster, file):
+                written.append(file)
+
+        for file in _numbered(base, extension):
+            index = int(file[len(base) + 1:-len(extension) or None])
+            if index >= len(clusters):
+                logging.info(f"Removing {file}, there are now {len(clusters)} playlists")
+                os.remove(file)
+
+        if written:
+            logging.info(f"Wrote {len(written)} of {len(clusters)} playlists")
+        return written
+
+
+def _unchanged(filename: str, content: bytes) -> bool:
+    """
+    Check if a file already has the given content, reading it only if its size matches
+    """
+    try:
+        if os.path.getsize(filename) != len(content):
+            return False
+        with open(filename, "rb") as file:
+            return file.read() == content
+    except OSError:
+        return False
+
+
+def _numbered(base: str, extension: str) -> List[str]:
+    """
+    Get the existing numbered playlists of a base filename
+    """
+    directory = os.path.dirname(base) or "."
+    pattern = re.compile(rf"{re.escape(os.path.basename(base))}\.\d+{re.escape(extension)}")
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+
+    return [os.path.join(os.path.dirname(base), name) for name in names if pattern.fullmatch(name)]
+
@@ -0,0 +1,70 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket used to keep the request rate under the API quota
+    Args:
+        rate: how many tokens are added every second
+        capacity: the maximum number of tokens, i.e. the allowed burst
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        """
+        Add the tokens accumulated since the last refill
+        Args:
+            now: the current monotonic time
+
+        Returns:
+            None
+        """
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> None:
+        """
+        Take a token, blocking until one is available
+        Returns:
+            None
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for the given time, e.g. after a 429 with a Retry-After header
+        Args:
+            seconds: how long to pause
+
+        Returns:
+            None
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # Do not let a burst hit the server as soon as the pause ends
+            self._tokens = 0
+            self._updated = self._paused_until
@@ -0,0 +1,119 @@
+import logging
+from typing import List
+
+import numpy as np
+
+from .metrics import metrics
+from .song import Song
+
+MODE = ["tempo", "energy"]  # the features the transitions are smoothed on
+
+
+def sequence(songs: List[Song], mode: list = None, neighbours: int = 16) -> List[Song]:
+    """
+    Order songs along a smooth path through feature space with the nearest neighbour chain heuristic: the playlist
+    starts from the calmest song and always moves to the closest song not played yet.
+    The neighbours of every song are found with a single batched KD-tree query; only when they have all been
+    played is a KD-tree of the songs left queried, and it is rebuilt once half of its songs have been played,
+    so the whole ordering is O(n log n)
+    Args:
+        songs: the Song objects of a playlist, the ones without features are kept at the end
+        mode: the feature(s) used to measure the transitions, MODE by default
+        neighbours: how many neighbours of every song are looked up in the first query
+
+    Returns:
+        The songs in playing order
+    """
+    from scipy.spatial import cKDTree
+
+    mode = MODE if mode is None else mode
+    playable = [music for music in songs if music["features"] is not None]
+    rest = [music for music in songs if music["features"] is None]
+    if len(playable) < 3:
+        return playable + rest
+
+    points = np.array([[music["features"][key] for key in mode] for music in playable], dtype=np.float64)
+    scale = points.std(axis=0)
+    scale[scale == 0] = 1
+    points = (points - points.mean(axis=0)) / scale
+
+    n = len(points)
+    # scipy's tree, sklearn's KDTree validates its input on every call and the fallback queries are one point each
+    _, candidates = cKDTree(points).query(points, k=min(neighbours + 1, n))
+    candidates = candidates.tolist()
+
+    played = [False] * n
+    left = _Remaining(points, played)
+    current = int(points.sum(axis=1).argmin())
+    order = [current]
+    fallbacks = 0
+    for _ in range(n - 1):
+        played[current] = True
+        left.count -= 1
+
+        following = next((j for j in candidates[current] if not played[j]), None)
+        if following is None:
+            following = left.nearest(points[current])
+            fallbacks += 1
+        order.append(following)
+        current = following
+
+    metrics.count("sequencing_fallbacks", fallbacks)
+    logging.debug(f"Sequenced {n} songs, {fallbacks} fallback queries")
+
+    return [playable[i] for i in order] + rest
+
+
+def sequence_clusters(clusters: List[List[Song]], mode: list = None) -> List[List[Song]]:
+    """
+    Order the songs of every cluster, see sequence
+    Args:
+        clusters: a clustered list
+        mode: the feature(s) used to measure the transitions, MODE by default
+
+    Returns:
+        The clustered list, every cluster in playing order
+    """
+    with metrics.stage("sequencing"):
+        return [sequence(songs, mode) for songs in clusters]
+
+
+class _Remaining:
+    """
+    KD-tree over the songs not played yet, rebuilt when half of the songs it holds have been played
+    Args:
+        points: the (songs, features) array
+        played: if every song has been played, updated by the caller
+    """
+
+    def __init__(self, points: np.ndarray, played: List[bool]):
+        self.points = points
+        self.played = played
+        self.count = len(points)  # songs not played yet, updated by the caller
+        self._build()
+
+    def _build(self) -> None:
+        from scipy.spatial import cKDTree
+
+        self._indexes = np.flatnonzero(~np.array(self.played))
+        self._tree = cKDTree(self.points[self._indexes])
+
+    def nearest(self, point: np.ndarray) -> int:
+        """
+        Find the closest song not played yet
+        Args:
+            point: the feature vector of the current song
+
+        Returns:
+            The index of the song
+        """
+        if self.count <= len(self._indexes) // 2:
+            self._build()
+
+        k = min(16, len(self._indexes))
+        while True:
+            _, found = self._tree.query(point, k=k)
+            for j in self._indexes[np.atleast_1d(found)].tolist():
+                if not self.played[j]:
+                    return j
+            k = min(2 * k, len(self._indexes))
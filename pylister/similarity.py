@@ -0,0 +1,122 @@
+import logging
+import os
+import pickle
+from typing import List, Union
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from .collection import SongCollection
+from .song import Song
+
+
+class SimilarityIndex:
+    """
+    KD-tree over the standardized features of a library, answering "songs most similar to this one" queries
+    Args:
+        songs: a list of Song objects or a SongCollection, songs without features are skipped
+        mode: the feature(s) used to measure the similarity
+    """
+
+    def __init__(self, songs: Union[List[Song], SongCollection], mode: list = None):
+        if not isinstance(songs, SongCollection):
+            songs = SongCollection.from_songs(songs)
+        if len(songs) == 0:
+            raise ValueError("Cannot index an empty library")
+
+        self.collection = songs
+        self.mode = mode
+
+        features = songs.features(mode)
+        # Tempo and loudness would dominate the distance otherwise
+        self.mean = features.mean(axis=0)
+        self.scale = features.std(axis=0)
+        self.scale[self.scale == 0] = 1
+        self.tree = KDTree((features - self.mean) / self.scale)
+
+        self._by_path = {path: i for i, path in enumerate(songs.column("path"))}
+        self._by_id = {spotify_id: i for i, spotify_id in enumerate(songs.column("spotify_id"))}
+
+    @classmethod
+    def load(cls, filename: str) -> "SimilarityIndex":
+        """
+        Load an index saved with save
+        Args:
+            filename: the index file
+
+        Returns:
+            A SimilarityIndex
+        """
+        with open(filename, "rb") as data:
+            return pickle.load(data)
+
+    def save(self, filename: str) -> None:
+        """
+        Save the index, so queries do not need to rebuild it
+        Args:
+            filename: the index file
+
+        Returns:
+            None
+        """
+        tmp = f"{filename}.tmp"
+        with open(tmp, "wb") as data:
+            pickle.dump(self, data)
+        os.replace(tmp, filename)
+
+    def __len__(self) -> int:
+        return len(self.collection)
+
+    def __contains__(self, seed: str) -> bool:
+        return seed in self._by_path or seed in self._by_id
+
+    def _seed_vector(self, seed: Union[str, Song]) -> tuple:
+        """
+        Find the standardized features of the seed
+        Args:
+            seed: a file path, a spotify id or a Song object with features
+
+        Returns:
+            The feature vector and the index of the seed in the library, or None if it is not in the library
+        """
+        if isinstance(seed, Song):
+            index = self._by_path.get(seed["path"])
+            if index is None:
+                if seed["features"] is None:
+                    raise ValueError(f"{seed['path']} has no features")
+                collection = SongCollection.from_songs([seed])
+                return (collection.features(self.mode)[0] - self.mean) / self.scale, None
+        else:
+            index = self._by_path.get(os.path.abspath(seed), self._by_id.get(seed))
+            if index is None:
+                logging.warning(f"{seed} not found in the index")
+                raise KeyError(f"{seed} not found in the index")
+
+        return np.asarray(self.tree.data[index]), index
+
+    def query(self, seed: Union[str, Song], n: int = 20, include_seed: bool = False) -> List[Song]:
+        """
+        Get the songs most similar to the seed, closest first
+        Args:
+            seed: a file path, a spotify id or a Song object with features
+            n: how many songs to return, the seed and its other copies excluded
+            include_seed: put the seed first, before the n songs
+
+        Returns:
+            A list of Song objects
+        """
+        vector, index = self._seed_vector(seed)
+        # The other copies of the seed recording are not similar songs, they are the seed
+        ids = self.collection.column("spotify_id")
+        seed_id = seed["spotify_id"] if isinstance(seed, Song) else ids[index]
+        copies = ids.count(seed_id) if seed_id is not None else 0
+
+        k = min(n + 1 + copies, len(self))
+        _, indexes = self.tree.query(vector.reshape(1, -1), k=k)
+        indexes = [i for i in indexes[0] if i != index and (seed_id is None or ids[i] != seed_id)][:n]
+
+        songs = self.collection.songs(indexes)
+        if include_seed:
+            songs.insert(0, seed if isinstance(seed, Song) else self.collection[index])
+
+        return songs
@@ -1,6 +1,7 @@
 import logging
 from typing import Union
 
+from .analysis import Analysis
 from .features import Feature
 
 
@@ -16,6 +17,11 @@ class Song:
 
     _features = None
 
+    _albumartist = None
+    _track = None
+
+    _analysis = None
+
     _keys = [
         "title",
         "artist",
@@ -24,11 +30,14 @@ class Song:
         "isrc",
         "path",
         "spotify_id",
-        "features"
+        "features",
+        "albumartist",
+        "track",
+        "analysis"
     ]
 
     def __init__(self, title: str, artist: str, album: str, year: Union[str, int], isrc: str, path: str,
-                 spotify_id: str = None, features: Feature = None):
+                 spotify_id: str = None, features: Feature = None, albumartist: str = None, track: int = None):
 
         self._title = title
         self._artist = artist
@@ -41,6 +50,9 @@ class Song:
 
         self._features = features
 
+        self._albumartist = albumartist
+        self._track = track
+
     def __doc__(self):
         return "This object is used to store the metadata of music files and their path on the pc and on spotify"
 
@@ -82,7 +94,8 @@ class Song:
         if key not in self._keys:
             return self.__missing__(key)
 
-        return self.__dict__[f"_{key}"]
+        # Songs pickled by older versions miss the newer keys, the class default is used
+        return getattr(self, f"_{key}")
 
     def __setitem__(self, key, value: str) -> None:
         """
@@ -117,7 +130,7 @@ class Song:
             The list containing the items
         """
         for key in self._keys:
-            yield self.__dict__[f"_{key}"]
+            yield getattr(self, f"_{key}")
 
     def set_features(self, data: dict) -> None:
         """
@@ -139,8 +152,16 @@ class Song:
         del data["key"]
         self._features = Feature(**data)
 
-    def set_analysis(self, data: dict) -> None:
-        raise NotImplementedError()
+    def set_analysis(self, data: Union[dict, Analysis]) -> None:
+        """
+        Set the beats, bars and sections from a json object from spotiapi, kept as compact arrays
+        Args:
+            data: a json object of the audio-analysis endpoint, or an Analysis object, e.g. from an AnalysisCache
+
+        Returns:
+            None
+        """
+        self._analysis = data if isinstance(data, Analysis) else Analysis.from_json(data)
 
 
 class MusicIterator:
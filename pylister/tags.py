@@ -0,0 +1,454 @@
+"""
+Fast tag-only reader: the container is sniffed from its magic bytes and only the few tags used by pylister are read.
+Every other frame, block or atom, embedded pictures included, is skipped with a seek instead of being loaded.
+Unknown or malformed files make read_tags return None, so the caller can fall back to mutagen
+"""
+import io
+import logging
+import struct
+import zlib
+from typing import BinaryIO, Dict, List, Optional
+
+Tags = Dict[str, List[str]]
+
+# Names follow mutagen's "easy" interface, so both readers can be used interchangeably
+_VORBIS_KEYS = {"title", "album", "artist", "albumartist", "date", "year", "isrc", "copyright", "tracknumber"}
+
+_ID3_FRAMES = {
+    "TIT2": "title", "TALB": "album", "TPE1": "artist", "TPE2": "albumartist", "TYER": "date", "TDRC": "date",
+    "TSRC": "isrc", "TCOP": "copyright", "TRCK": "tracknumber",
+    # ID3v2.2
+    "TT2": "title", "TAL": "album", "TP1": "artist", "TP2": "albumartist", "TYE": "date", "TRC": "isrc",
+    "TCR": "copyright", "TRK": "tracknumber"
+}
+
+_MP4_ATOMS = {
+    b"\xa9nam": "title", b"\xa9alb": "album", b"\xa9ART": "artist", b"aART": "albumartist", b"\xa9day": "date",
+    b"cprt": "copyright", b"trkn": "tracknumber"
+}
+
+# Vorbis comments are read in full only if they are this short, longer ones are pictures or lyrics
+_MAX_COMMENT = 4096
+
+
+class _Malformed(Exception):
+    pass
+
+
+def read_tags(path: str) -> Optional[Tags]:
+    """
+    Read the tags of a music file without loading the whole tag structure
+    Args:
+        path: the music file
+
+    Returns:
+        A dict of lists of values with mutagen's easy keys, None if the format is not supported or the file is malformed
+    """
+    try:
+        with open(path, "rb") as file:
+            return _sniff(file)
+    except (_Malformed, struct.error, EOFError, UnicodeDecodeError, zlib.error) as e:
+        logging.debug(f"Fast tag reader failed on {path}: {e!r}")
+        return None
+
+
+def _sniff(file: BinaryIO) -> Optional[Tags]:
+    """
+    Choose the reader from the magic bytes
+    """
+    head = file.read(12)
+
+    if head[:3] == b"ID3":
+        file.seek(0)
+        tags = _read_id3v2(file)
+        # Some encoders put an ID3 tag in front of a flac stream
+        if file.read(4) == b"fLaC":
+            return _read_flac(file)
+        return tags
+    if head[:4] == b"fLaC":
+        file.seek(4)
+        return _read_flac(file)
+    if head[:4] == b"OggS":
+        file.seek(0)
+        return _read_ogg(file)
+    if head[4:8] == b"ftyp":
+        file.seek(0)
+        return _read_mp4(file)
+    if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+        return _read_wav(file)
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # Bare mpeg frames, the only place left is an ID3v1 tag at the end
+        return _read_id3v1(file)
+
+    return None
+
+
+def _read(file: BinaryIO, n: int) -> bytes:
+    data = file.read(n)
+    if len(data) != n:
+        raise EOFError(f"Expected {n} bytes, got {len(data)}")
+    return data
+
+
+def _syncsafe(data: bytes) -> int:
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7F)
+    return value
+
+
+def _add(tags: Tags, key: str, values: List[str]) -> None:
+    values = [value for value in values if value]
+    if values:
+        tags.setdefault(key, []).extend(values)
+
+
+# ID3
+
+
+# ID3 text encoding: codec, bytes of the terminator
+_ENCODINGS = {0: ("latin-1", 1), 1: ("utf-16", 2), 2: ("utf-16-be", 2), 3: ("utf-8", 1)}
+
+
+def _decode_text(data: bytes) -> List[str]:
+    """
+    Decode an ID3 text frame, v2.4 frames can hold several null separated values
+    """
+    if not data:
+        return []
+
+    encoding, data = data[0], data[1:]
+    if encoding not in _ENCODINGS:
+        raise _Malformed(f"Unknown text encoding {encoding}")
+    codec, width = _ENCODINGS[encoding]
+
+    # Split before decoding: every UTF-16 value has its own BOM, and a UTF-16 terminator is two null bytes
+    # on a code unit boundary, not any pair of null bytes
+    terminator = b"\x00" * width
+    values, start = [], 0
+    while start < len(data):
+        end = data.find(terminator, start)
+        while end != -1 and (end - start) % width:
+            end = data.find(terminator, end + 1)
+        if end == -1:
+            end = len(data)
+        values.append(data[start:end].decode(codec))
+        start = end + width
+
+    return [value.strip() for value in values]
+
+
+def _read_id3v2(file: BinaryIO) -> Tags:
+    """
+    Read the wanted text frames of an ID3v2 tag, seeking over the others. The file is left after the tag
+    """
+    offset = file.tell()
+    header = _read(file, 10)
+    major, flags, size = header[3], header[5], _syncsafe(header[6:10])
+    end = offset + 10 + size + (10 if major == 4 and flags & 0x10 else 0)  # v2.4 footer
+
+    if major not in (2, 3, 4):
+        raise _Malformed(f"Unsupported ID3v2.{major}")
+
+    body = file
+    if flags & 0x80 and major < 4:
+        # Whole tag unsynchronisation: it must be read in full to be undone
+        body = io.BytesIO(_read(file, size).replace(b"\xff\x00", b"\xff"))
+        size = len(body.getvalue())
+    start = body.tell()
+
+    if flags & 0x40 and major > 2:
+        extended = _read(body, 4)
+        body.seek(_syncsafe(extended) - 4 if major == 4 else struct.unpack(">I", extended)[0], 1)
+
+    tags = {}
+    id_size = 3 if major == 2 else 4
+    header_size = 6 if major == 2 else 10
+    while body.tell() - start + header_size <= size:
+        frame = body.read(header_size)
+        if len(frame) < header_size or frame[0] == 0:
+            break  # Padding
+
+        frame_id = frame[:id_size].decode("latin-1")
+        if major == 2:
+            frame_size, frame_flags = int.from_bytes(frame[3:6], "big"), 0
+        elif major == 3:
+            frame_size, frame_flags = struct.unpack(">IH", frame[4:10])
+        else:
+            frame_size, frame_flags = _syncsafe(frame[4:8]), struct.unpack(">H", frame[8:10])[0]
+
+        key = _ID3_FRAMES.get(frame_id)
+        if key is None:
+            body.seek(frame_size, 1)  # Pictures, lyrics, private frames...
+            continue
+
+        data = _read(body, frame_size)
+        if major == 3:
+            if frame_flags & 0x40:  # Encrypted
+                continue
+            if frame_flags & 0x80:
+                data = zlib.decompress(data[4:])
+        elif major == 4:
+            if frame_flags & 0x04:  # Encrypted
+                continue
+            if frame_flags & 0x01:  # Data length indicator
+                data = data[4:]
+            if frame_flags & 0x02:
+                data = data.replace(b"\xff\x00", b"\xff")
+            if frame_flags & 0x08:
+                data = zlib.decompress(data)
+
+        _add(tags, key, _decode_text(data))
+
+    file.seek(end)
+    return tags
+
+
+def _read_id3v1(file: BinaryIO) -> Tags:
+    """
+    Read the 128 bytes ID3v1 tag at the end of the file
+    """
+    file.seek(0, io.SEEK_END)
+    if file.tell() < 128:
+        return {}
+    file.seek(-128, io.SEEK_END)
+    data = file.read(128)
+    if data[:3] != b"TAG":
+        return {}
+
+    def field(start: int, length: int) -> List[str]:
+        return [data[start:start + length].split(b"\x00")[0].decode("latin-1").strip()]
+
+    tags = {}
+    _add(tags, "title", field(3, 30))
+    _add(tags, "artist", field(33, 30))
+    _add(tags, "album", field(63, 30))
+    _add(tags, "date", field(93, 4))
+    return tags
+
+
+# Vorbis comments: flac, ogg vorbis, opus
+
+
+def _read_comments(stream) -> Tags:
+    """
+    Read a vorbis comment block, long comments (pictures) are skipped without being read
+    Args:
+        stream: an object with read(n) and skip(n) positioned on the vendor string
+    """
+    vendor_length = struct.unpack("<I", stream.read(4))[0]
+    stream.skip(vendor_length)
+
+    tags = {}
+    count = struct.unpack("<I", stream.read(4))[0]
+    for _ in range(count):
+        length = struct.unpack("<I", stream.read(4))[0]
+        if length > _MAX_COMMENT:
+            stream.skip(length)
+            continue
+
+        comment = stream.read(length).decode("utf-8")
+        key, sep, value = comment.partition("=")
+        key = key.lower()
+        if sep and key in _VORBIS_KEYS:
+            _add(tags, key, [value.strip()])
+
+    return tags
+
+
+class _FileStream:
+    """
+    read/skip interface over a file
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+
+    def read(self, n: int) -> bytes:
+        return _read(self.file, n)
+
+    def skip(self, n: int) -> None:
+        self.file.seek(n, 1)
+
+
+class _OggStream:
+    """
+    read/skip interface over the bodies of consecutive ogg pages, page headers are parsed transparently
+    and skipped bytes are seeked over
+    """
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.left = 0  # Bytes left in the current page body
+
+    def _next_page(self) -> None:
+        header = _read(self.file, 27)
+        if header[:4] != b"OggS":
+            raise _Malformed("Lost ogg page sync")
+        lacing = _read(self.file, header[26])
+        self.left = sum(lacing)
+
+    def read(self, n: int) -> bytes:
+        out = []
+        while n:
+            if not self.left:
+                self._next_page()
+            chunk = _read(self.file, min(n, self.left))
+            self.left -= len(chunk)
+            n -= len(chunk)
+            out.append(chunk)
+        return b"".join(out)
+
+    def skip(self, n: int) -> None:
+        while n:
+            if not self.left:
+                self._next_page()
+            step = min(n, self.left)
+            self.file.seek(step, 1)
+            self.left -= step
+            n -= step
+
+
+def _read_flac(file: BinaryIO) -> Tags:
+    """
+    Walk the metadata blocks after the "fLaC" marker, reading only the VORBIS_COMMENT one
+    """
+    while True:
+        header = _read(file, 4)
+        last, block_type, length = header[0] & 0x80, header[0] & 0x7F, int.from_bytes(header[1:4], "big")
+
+        if block_type == 4:
+            return _read_comments(_FileStream(file))
+        if last:
+            return {}
+        file.seek(length, 1)  # STREAMINFO, SEEKTABLE, PICTURE...
+
+
+def _read_ogg(file: BinaryIO) -> Optional[Tags]:
+    """
+    The identification header fills the first page, the comment header starts the second one
+    """
+    stream = _OggStream(file)
+    stream._next_page()
+    identification = stream.read(min(stream.left, 8))
+    stream.skip(stream.left)
+
+    if identification.startswith(b"\x01vorbis"):
+        magic = b"\x03vorbis"
+    elif identification.startswith(b"OpusHead"):
+        magic = b"OpusTags"
+    else:
+        return None  # Ogg flac, speex... left to mutagen
+
+    if stream.read(len(magic)) != magic:
+        raise _Malformed("Comment header not found")
+
+    return _read_comments(stream)
+
+
+# WAV
+
+
+def _read_wav(file: BinaryIO) -> Tags:
+    """
+    Find the ID3v2 tag in the chunks following the RIFF header, seeking over the audio
+    """
+    file.seek(0, io.SEEK_END)
+    end = file.tell()
+    file.seek(12)
+
+    while file.tell() + 8 <= end:
+        kind, size = struct.unpack("<4sI", _read(file, 8))
+        if kind in (b"id3 ", b"ID3 "):
+            return _read_id3v2(file)
+        file.seek(size + size % 2, 1)  # Chunks are padded to an even size
+
+    return {}
+
+
+# MP4
+
+
+def _atoms(file: BinaryIO, end: int):
+    """
+    Iterate the atoms between the current position and end
+    Returns:
+        Tuples (type, start of the data, end of the atom)
+    """
+    while file.tell() + 8 <= end:
+        start = file.tell()
+        size, kind = struct.unpack(">I4s", _read(file, 8))
+        if size == 1:
+            size = struct.unpack(">Q", _read(file, 8))[0]
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            raise _Malformed("Atom smaller than its header")
+
+        yield kind, file.tell(), start + size
+        file.seek(start + size)
+
+
+def _find(file: BinaryIO, end: int, kind: bytes):
+    for atom, data, atom_end in _atoms(file, end):
+        if atom == kind:
+            return data, atom_end
+    return None
+
+
+def _read_mp4(file: BinaryIO) -> Tags:
+    """
+    Follow moov/udta/meta/ilst, seeking over mdat and every other atom
+    """
+    file.seek(0, io.SEEK_END)
+    end = file.tell()
+    file.seek(0)
+
+    path = [b"moov", b"udta", b"meta", b"ilst"]
+    for kind in path:
+        found = _find(file, end, kind)
+        if found is None:
+            return {}
+        start, end = found
+        file.seek(start)
+        if kind == b"meta":
+            # meta is a full atom, but some writers omit version and flags
+            if _read(file, 8)[4:8] == b"hdlr":
+                file.seek(start)
+            else:
+                file.seek(start + 4)
+
+    tags = {}
+    for kind, data, atom_end in list(_atoms(file, end)):
+        key = _MP4_ATOMS.get(kind)
+        if key is None and kind != b"----":
+            continue  # covr and the others are never read
+
+        file.seek(data)
+        name = None
+        values = []
+        for child, child_data, child_end in _atoms(file, atom_end):
+            payload = _read(file, child_end - child_data)
+            if child == b"name":
+                name = payload[4:].decode("utf-8")
+            elif child == b"data":
+                values.append(_mp4_value(kind, payload))
+
+        if kind == b"----":
+            if name is None or name.lower() != "isrc":
+                continue
+            key = "isrc"
+        _add(tags, key, values)
+
+    return tags
+
+
+def _mp4_value(kind: bytes, payload: bytes) -> str:
+    """
+    Decode the payload of a data atom: type and locale, then the value
+    """
+    value = payload[8:]
+    if kind == b"trkn":
+        track, total = struct.unpack(">HH", value[2:6])
+        return f"{track}/{total}" if total else str(track)
+    return value.decode("utf-8").strip()
@@ -0,0 +1,172 @@
+import base64
+import gzip
+import json
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from requests import Session
+from requests.structures import CaseInsensitiveDict
+
+# Only these headers matter to the client, the others are not recorded
+_KEPT_HEADERS = ["Content-Type", "Retry-After"]
+
+
+class ReplayMiss(LookupError):
+    """
+    The replayed archive has no response for a request
+    """
+
+
+class Transport:
+    """
+    Sends the HTTP requests of the API object, see SessionTransport, RecordingTransport and ReplayTransport
+    """
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        Send a request
+        Args:
+            method: the http method
+            url: the url to request
+            **kwargs: the arguments of Session.request
+
+        Returns:
+            A response with status_code, headers, content and json()
+        """
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class SessionTransport(Transport):
+    """
+    Sends the requests over the network
+    Args:
+        session: the requests Session to use
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    def request(self, method: str, url: str, **kwargs):
+        return self.session.request(method, url=url, **kwargs)
+
+
+class RecordedResponse:
+    """
+    A response read from an archive, with the subset of the requests.Response interface used by the API object
+    """
+
+    def __init__(self, status_code: int, headers: dict, content: bytes):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _key(method: str, url: str, data=None) -> Tuple[str, str, str]:
+    """
+    Identify a request regardless of its headers, the token changes between runs,
+    and of its host, so an archive recorded against a stand-in server can be replayed with any base url
+    """
+    if isinstance(data, dict):
+        data = urlencode(sorted(data.items()))
+    parts = urlsplit(url)
+    path = f"{parts.path}?{parts.query}" if parts.query else parts.path
+    return method.upper(), path, data or ""
+
+
+class RecordingTransport(Transport):
+    """
+    Sends the requests through another transport and appends every exchange to a gzipped json lines archive
+    Args:
+        archive: the archive file, new exchanges are appended
+        inner: the transport actually sending the requests
+    """
+
+    def __init__(self, archive: str, inner: Transport):
+        self.archive = archive
+        self.inner = inner
+        self._lock = threading.Lock()
+        self._file = gzip.open(archive, "at", encoding="utf-8")
+
+    def request(self, method: str, url: str, **kwargs):
+        response = self.inner.request(method, url, **kwargs)
+
+        try:
+            content = {"text": response.content.decode("utf-8")}
+        except UnicodeDecodeError:
+            content = {"base64": base64.b64encode(response.content).decode("ascii")}
+
+        method, path, body = _key(method, url, kwargs.get("data"))
+        exchange = {
+            "method": method,
+            "url": path,
+            "body": body,
+            "status": response.status_code,
+            "headers": {key: response.headers[key] for key in _KEPT_HEADERS if key in response.headers},
+            **content
+        }
+        line = json.dumps(exchange, separators=(",", ":"))
+        with self._lock:
+            self._file.write(line + "\n")
+
+        return response
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+        self.inner.close()
+
+
+class ReplayTransport(Transport):
+    """
+    Answers the requests with the exchanges of an archive, without using the network.
+    Identical requests get the recorded responses in order, the last one is repeated once they are exhausted
+    Args:
+        archive: the archive written by RecordingTransport
+        strict: raise ReplayMiss for unknown requests, otherwise answer 404
+        rate_limits: replay the recorded 429 responses too; without them the replay runs at full speed
+    """
+
+    def __init__(self, archive: str, strict: bool = True, rate_limits: bool = True):
+        self.archive = archive
+        self.strict = strict
+        self._lock = threading.Lock()
+        self._exchanges: Dict[Tuple[str, str, str], deque] = defaultdict(deque)
+
+        with gzip.open(archive, "rt", encoding="utf-8") as file:
+            for line in file:
+                exchange = json.loads(line)
+                if exchange["status"] == 429 and not rate_limits:
+                    continue
+
+                if "text" in exchange:
+                    content = exchange["text"].encode("utf-8")
+                else:
+                    content = base64.b64decode(exchange["base64"])
+                response = RecordedResponse(exchange["status"], exchange["headers"], content)
+                self._exchanges[(exchange["method"], exchange["url"], exchange["body"])].append(response)
+
+        logging.debug(f"Loaded {sum(map(len, self._exchanges.values()))} exchanges from {archive}")
+
+    def request(self, method: str, url: str, **kwargs):
+        key = _key(method, url, kwargs.get("data"))
+        with self._lock:
+            responses = self._exchanges.get(key)
+            if not responses:
+                if self.strict:
+                    raise ReplayMiss(f"No recorded response for {key[0]} {key[1]}")
+                return RecordedResponse(404, {}, b"{}")
+
+            return responses.popleft() if len(responses) > 1 else responses[0]
@@ -2,11 +2,20 @@ import os
 import re
 import logging
 import mutagen
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator, List, Optional
 
+from .metrics import metrics
+from .playlists import PlaylistWriter
 from .song import Song
+from .tags import read_tags
 
-FILE_FORMATS = [".mp3", ".flac", ".ogg"]
+FILE_FORMATS = [".mp3", ".flac", ".ogg", ".oga", ".opus", ".m4a", ".wav"]
+
+EXECUTORS = {
+    "thread": ThreadPoolExecutor,  # network mounts, the work is I/O bound
+    "process": ProcessPoolExecutor  # local disks, the work is CPU bound
+}
 
 
 def load_folder(track_dir: str) -> list:
@@ -20,7 +29,119 @@ def load_folder(track_dir: str) -> list:
     """
     files = list_files(track_dir)
     for file in files:
-        yield load_file(file)
+        song = load_file(file)
+        metrics.count("files_parsed")
+        yield song
+
+
+def load_folder_parallel(track_dir: str, workers: int = None, executor: str = "thread") -> Iterator[Song]:
+    """
+    Load and parse all the files in a folder using a pool of workers.
+    Songs are yielded as soon as they are parsed, so the order is not the walk order
+    Args:
+        track_dir: the directory to search in
+        workers: the size of the pool, defaults to the number of cpus
+        executor: "thread" or "process"
+
+    Returns:
+        a generator of Music Objects
+    """
+    files = list_files(track_dir)
+    yield from load_files_parallel(files, workers=workers, executor=executor)
+
+
+def load_files_parallel(files, workers: int = None, executor: str = "thread") -> Iterator[Song]:
+    """
+    Load and parse the given files using a pool of workers.
+    Files that cannot be parsed are logged and skipped
+    Args:
+        files: an iterable of files to parse
+        workers: the size of the pool, defaults to the number of cpus
+        executor: "thread" or "process"
+
+    Returns:
+        a generator of Music Objects
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if executor not in EXECUTORS:
+        raise ValueError(f"executor must be one of {list(EXECUTORS)}")
+
+    files = iter(files)
+    with EXECUTORS[executor](max_workers=workers) as pool:
+        # Keep a bounded number of files in flight so a huge tree is never fully queued
+        in_flight = workers * 4
+        pending = set()
+
+        for file in files:
+            pending.add(pool.submit(_safe_load_file, file))
+            if len(pending) < in_flight:
+                continue
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _completed(done)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from _completed(done)
+
+
+def _completed(futures) -> Iterator[Song]:
+    """
+    Yield the songs of the completed futures, skipping the failed ones
+    Args:
+        futures: a set of done futures
+
+    Returns:
+        a generator of Music Objects
+    """
+    yield from _completed_songs(future.result() for future in futures)
+
+
+def _completed_songs(songs) -> Iterator[Song]:
+    """
+    Count the parsed and the failed files, skipping the failed ones
+    Args:
+        songs: Music Objects or None for the files that could not be parsed
+
+    Returns:
+        a generator of Music Objects
+    """
+    for song in songs:
+        if song is None:
+            metrics.count("files_failed")
+            continue
+
+        metrics.count("files_parsed")
+        yield song
+
+
+def _safe_load_file(track_path: str) -> Optional[Song]:
+    """
+    Like load_file, but logs the error and returns None instead of raising
+    Args:
+        track_path: the path of the music file
+
+    Returns:
+        A Music Object or None
+    """
+    try:
+        return load_file(track_path)
+    except Exception as e:
+        logging.warning(f"Cannot parse {track_path}: {e!r}. Skipping it")
+        return None
+
+
+def is_music_file(path: str) -> bool:
+    """
+    Check if a file has one of the supported extensions
+    Args:
+        path: the path of the file
+
+    Returns:
+        True if the file can be parsed
+    """
+    return os.path.splitext(path)[1].lower() in FILE_FORMATS
 
 
 def list_files(track_dir: str) -> list:
@@ -34,7 +155,7 @@ def list_files(track_dir: str) -> list:
     """
     for path, subdirs, files in os.walk(track_dir):
         for name in files:
-            if os.path.splitext(name)[1] in FILE_FORMATS:
+            if is_music_file(name):
                 yield os.path.join(path, name)
 
 
@@ -48,7 +169,21 @@ def load_files(files: List[str]) -> list:
         a list containing the Music Objects
     """
     for file in files:
-        yield load_file(file)
+        song = load_file(file)
+        metrics.count("files_parsed")
+        yield song
+
+
+def load_files_safe(files) -> Iterator[Song]:
+    """
+    Load and parse all the files one at a time, files that cannot be parsed are logged and skipped
+    Args:
+        files: an iterable of files to parse
+
+    Returns:
+        a generator of Music Objects
+    """
+    yield from _completed_songs(map(_safe_load_file, files))
 
 
 def load_file(track_path: str) -> Song:
@@ -61,7 +196,10 @@ def load_file(track_path: str) -> Song:
         A Music Object created from the file
     """
     path = os.path.abspath(track_path)
-    file = mutagen.File(path)
+    file = read_tags(path)
+    if not file or "title" not in file:
+        # Unknown container or tags the fast reader does not understand
+        file = mutagen.File(path, easy=True)  # Same keys for ID3 and Vorbis comments
 
     title = str(file["title"][0])
 
@@ -78,6 +216,17 @@ def load_file(track_path: str) -> Song:
     except KeyError:
         artist = str(file["albumartist"][0])
 
+    try:
+        albumartist = str(file["albumartist"][0])
+    except KeyError:
+        albumartist = None
+
+    try:
+        # "4" or "4/12"
+        track = int(str(file["tracknumber"][0]).split("/")[0])
+    except (KeyError, ValueError):
+        track = None
+
     try:
         # Extract year from year :)
         year = int(file["year"][0])
@@ -93,26 +242,21 @@ def load_file(track_path: str) -> Song:
             cp = file["copyright"][0]
             year = int(re.search(rx_str, cp).group(0))
 
-    return Song(title=title, artist=artist, album=album, year=year, path=path, isrc=isrc)
+    return Song(title=title, artist=artist, album=album, year=year, path=path, isrc=isrc, albumartist=albumartist,
+                track=track)
 
 
-def create_playlist(clusters: List[List[Song]], filename: str) -> None:
+def create_playlist(clusters: List[List[Song]], filename: str, extended: bool = True,
+                    relative: bool = False) -> List[str]:
     """
-    Create playlists from the clusters list
+    Create playlists from the clusters list, a playlist whose songs did not change is left untouched
     Args:
         clusters: A list of list of song
-        filename: the base filename to use to save the playlists
+        filename: the base filename to use to save the playlists, its extension sets the format (see PlaylistWriter)
+        extended: write extended M3U
+        relative: write the paths relative to the playlists
 
     Returns:
-        None
+        The playlists written
     """
-    # split filename and extension
-    filename, file_extension = os.path.splitext(filename)
-    for i, cluster in enumerate(clusters):
-        file = f"{filename}.{i}{file_extension}"  # test.4.m3u
-        playlist = open(file, "w", encoding="utf-8")
-
-        for music in cluster:
-            playlist.write(f"{music['path']}\n")
-
-        playlist.close()
+    return PlaylistWriter(extended=extended, relative=relative).write_all(clusters, filename)
@@ -0,0 +1,301 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+from .utils import is_music_file
+
+# inotify(7) constants
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+
+# IN_MODIFY is left out: a file being copied is reported once, by IN_CLOSE_WRITE
+_MASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF
+_EVENT = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class Watcher:
+    """
+    Report the files and directories changed below a directory, see InotifyWatcher and PollingWatcher
+    Args:
+        root: the directory to watch
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+
+    def read(self, timeout: Optional[float] = None) -> Set[str]:
+        """
+        Wait for changes
+        Args:
+            timeout: how many seconds to wait, None to wait until something changes
+
+        Returns:
+            The changed paths, empty on timeout. A changed directory must be rescanned
+        """
+        raise NotImplementedError()
+
+    def batches(self, debounce: float = 2.0, max_delay: float = 60.0) -> Iterator[Set[str]]:
+        """
+        Group the changes in bursts: a batch is yielded once nothing changed for debounce seconds,
+        or after max_delay seconds if the changes never stop
+        Args:
+            debounce: the seconds without changes ending a burst
+            max_delay: the maximum seconds between the first change of a burst and its batch
+
+        Returns:
+            An endless iterator of sets of changed paths
+        """
+        while True:
+            paths = self.read()
+            if not paths:
+                continue
+
+            deadline = time.monotonic() + max_delay
+            while True:
+                timeout = min(debounce, deadline - time.monotonic())
+                if timeout <= 0:
+                    break
+                more = self.read(timeout)
+                if not more:
+                    break
+                paths |= more
+
+            logging.debug(f"{len(paths)} paths changed below {self.root}")
+            yield paths
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class PollingWatcher(Watcher):
+    """
+    Find the changes by comparing the mtime and size of every music file at a fixed interval.
+    Works everywhere, including network mounts, at the cost of a full walk per interval
+    Args:
+        root: the directory to watch
+        interval: the seconds between two walks
+    """
+
+    def __init__(self, root: str, interval: float = 30.0):
+        super().__init__(root)
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[float, int]]:
+        """
+        Stat every music file
+        Returns:
+            A dict path: (mtime, size)
+        """
+        snapshot = {}
+        for path, subdirs, files in os.walk(self.root):
+            for name in files:
+                if not is_music_file(name):
+                    continue
+                file = os.path.join(path, name)
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                snapshot[file] = (stat.st_mtime, stat.st_size)
+
+        return snapshot
+
+    def read(self, timeout: Optional[float] = None) -> Set[str]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+
+        snapshot = self._scan()
+        changed = {path for path, stat in snapshot.items() if self._snapshot.get(path) != stat}
+        changed.update(path for path in self._snapshot if path not in snapshot)
+        self._snapshot = snapshot
+
+        return changed
+
+
+class InotifyWatcher(Watcher):
+    """
+    Get the changes from the Linux kernel through inotify, every directory below the root is watched
+    Args:
+        root: the directory to watch
+    Raises:
+        OSError: if inotify is not available or the watch limit is reached
+    """
+
+    def __init__(self, root: str):
+        super().__init__(root)
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            raise _os_error("inotify_init1")
+
+        self._paths: Dict[int, str] = {}  # watch descriptor: directory
+        self._buffer = b""
+        try:
+            self._add_tree(self.root)
+        except OSError:
+            self.close()
+            raise
+
+    def _add(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _MASK | _IN_ONLYDIR)
+        if wd < 0:
+            error = _os_error("inotify_add_watch", directory)
+            if error.errno in (errno.ENOENT, errno.ENOTDIR):  # Gone already
+                return
+            raise error
+        self._paths[wd] = directory
+
+    def _add_tree(self, directory: str) -> None:
+        """
+        Watch a directory and all its subdirectories
+        """
+        self._add(directory)
+        for path, subdirs, files in os.walk(directory):
+            for name in subdirs:
+                self._add(os.path.join(path, name))
+
+    def _forget_tree(self, directory: str) -> None:
+        """
+        Forget the paths of a directory moved away and of its subdirectories.
+        The watches are kept: if the directory is moved back below the root, adding them again returns the same
+        descriptors, while removing them would queue IN_IGNORED events for descriptors in use again
+        """
+        prefix = os.path.join(directory, "")
+        for wd, path in list(self._paths.items()):
+            if path == directory or path.startswith(prefix):
+                del self._paths[wd]
+
+    def read(self, timeout: Optional[float] = None) -> Set[str]:
+        # Events about other files do not count, keep waiting until the timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            changed = self._read_events(remaining)
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def _read_events(self, timeout: Optional[float]) -> Set[str]:
+        """
+        Read the pending events
+        Args:
+            timeout: how many seconds to wait for events, None to wait for ever
+
+        Returns:
+            The changed paths among the events read
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        try:
+            self._buffer += os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset + _EVENT.size <= len(self._buffer):
+            wd, mask, cookie, length = _EVENT.unpack_from(self._buffer, offset)
+            if offset + _EVENT.size + length > len(self._buffer):
+                break
+            name = self._buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b"\0")
+            offset += _EVENT.size + length
+
+            if mask & _IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflowed, rescanning everything")
+                changed.add(self.root)
+                continue
+
+            directory = self._paths.get(wd)
+            if mask & _IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            if directory is None or mask & _IN_DELETE_SELF:
+                continue
+
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            if mask & _IN_ISDIR:
+                if mask & (_IN_CREATE | _IN_MOVED_TO):
+                    self._add_tree(path)
+                elif mask & _IN_MOVED_FROM:
+                    self._forget_tree(path)
+                changed.add(path)
+            elif mask & _IN_CREATE:
+                continue  # Reported by IN_CLOSE_WRITE once written
+            elif is_music_file(path):
+                changed.add(path)
+
+        self._buffer = self._buffer[offset:]
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _libc():
+    """
+    Load the C library exposing the inotify functions
+    Raises:
+        OSError: if it has no inotify support
+    """
+    if not sys.platform.startswith("linux"):
+        raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError(errno.ENOSYS, "libc has no inotify support")
+
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def _os_error(function: str, filename: str = None) -> OSError:
+    code = ctypes.get_errno()
+    return OSError(code, f"{function}: {os.strerror(code)}", filename)
+
+
+def open_watcher(root: str, poll_interval: float = None) -> Watcher:
+    """
+    Get the best watcher for a directory: inotify on Linux, polling elsewhere or when inotify fails
+    Args:
+        root: the directory to watch
+        poll_interval: force polling with this interval, in seconds
+
+    Returns:
+        A Watcher object
+    """
+    if poll_interval is None:
+        try:
+            return InotifyWatcher(root)
+        except OSError as e:
+            logging.warning(f"Cannot use inotify ({e}), polling {root} instead")
+            poll_interval = 30.0
+
+    return PollingWatcher(root, poll_interval)